@@ -0,0 +1,280 @@
+""" Benchmarks of the model pipeline, from importing the model file to multistart optimization.
+
+Each stage is timed a number of times, and the results are appended to a json history file. The timings are compared to the previous run in the history, and stages that have become significantly slower are reported as regressions.
+
+Use cases:
+    python benchmark.py
+    python benchmark.py --repeats 10 --n-starts 20
+    python benchmark.py --skip-amici --sizes 100 1000 10000
+    python benchmark.py --skip-amici --sizes --import-lines 1000000
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy import stats
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import odes2py
+
+HISTORY_FILE = "benchmark_history.json"
+
+def timeit(func, repeats, min_time=0.05):
+    """Returns a list with repeats samples of the wall time (s) of a call to func.
+
+    Fast functions are called several times per sample (at least min_time in total), and the mean time per call is used. This reduces the noise for stages that take less than a millisecond.
+    """
+    tic = time.perf_counter()
+    func()
+    first = time.perf_counter()-tic
+    number = max(1, int(min_time/max(first, 1e-9)))
+    if number == 1 and repeats == 1:
+        return [first]
+
+    times = []
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter()-tic)/number)
+    return times
+
+def write_scaled_model(model, n_copies, filename):
+    """This function writes n_copies independent copies of a model to a file in the [IQM tools / SB toolbox] format.
+
+    All names in copy i get the suffix _i, so the written model has n_copies times as many states as the original.
+
+    Returns:
+        the number of lines written
+    """
+    names = [s[0] for s in model["states"]] + [p[0] for p in model["parameters"]]
+    for key in ["variables", "observables", "reactions"]:
+        names += [name for name, _ in model.get(key, [])]
+    identifier = re.compile(r'\b[A-Za-z_]\w*\b')
+
+    lines = {key: [] for key in ["states", "ics", "parameters", "variables", "reactions"]}
+    for i in range(n_copies):
+        mapping = {name: f"{name}_{i}" for name in names}
+        rename = lambda expr: identifier.sub(lambda m: mapping.get(m.group(0), m.group(0)), str(expr))
+        for state, rhs, ic in model["states"]:
+            lines["states"].append(f"d/dt({mapping[state]}) = {rename(rhs)}")
+            lines["ics"].append(f"{mapping[state]}(0) = {ic}")
+        for name, value in model["parameters"]:
+            lines["parameters"].append(f"{mapping[name]} = {value}")
+        for name, value in model.get("variables", []) + model.get("observables", []):
+            lines["variables"].append(f"{mapping[name]} = {rename(value)}")
+        for name, value in model.get("reactions", []):
+            lines["reactions"].append(f"{mapping[name]} = {rename(value)}")
+
+    with open(filename, 'w') as f:
+        f.write(f"********** MODEL NAME\n{model['name']}_x{n_copies}\n")
+        f.write("********** MODEL STATES\n" + "\n".join(lines["states"]) + "\n\n" + "\n".join(lines["ics"]) + "\n")
+        f.write("********** MODEL PARAMETERS\n" + "\n".join(lines["parameters"]) + "\n")
+        f.write("********** MODEL VARIABLES\n" + "\n".join(lines["variables"]) + "\n")
+        f.write("********** MODEL REACTIONS\n" + "\n".join(lines["reactions"]) + "\n")
+        f.write("********** MODEL FUNCTIONS\n********** MODEL EVENTS\n")
+    return 9 + sum(len(entries) for entries in lines.values())
+
+def exporters(model, out_dir):
+    """Returns the exporters to benchmark, as a dict of name: function"""
+    path = lambda ext: os.path.join(out_dir, model["name"]+ext)
+    return {
+        "export_as_scipy": lambda: odes2py.export_as_scipy(model, path(".py")),
+        "export_as_scipy (no cse)": lambda: odes2py.export_as_scipy(model, path("_plain.py"), cse=False),
+        "export_as_yaml": lambda: odes2py.export_as_yaml(model, path(".yml")),
+        "export_as_antimony": lambda: odes2py.export_as_antimony(model, path("_a.txt")),
+        "export_as_medigit": lambda: odes2py.export_as_medigit(model, path("_mdt.txt")),
+        "export_as_LaTeX": lambda: odes2py.export_as_LaTeX(model, path(".tex")),
+        "export_as_SBML (yaml)": lambda: odes2py.export_as_SBML(model, path(".xml"), route='yaml'),
+        "export_as_SBML (te)": lambda: odes2py.export_as_SBML(model, path("_te.xml"), route='te'),
+        "export_as_SBML (libsbml)": lambda: odes2py.export_as_SBML(model, path("_libsbml.xml"), route='libsbml'),
+    }
+
+def benchmark_conversions(model_file, out_dir, repeats, sizes, scaled_repeats):
+    """Times import_odes and the exporters on the model, and on scaled copies of the model with the given number of states (repeated scaled_repeats times)."""
+    timings = {}
+    model = odes2py.import_odes(model_file)
+    models = [("", model_file, model, repeats)]
+    for size in sizes:
+        n_copies = max(1, size//len(model["states"]))
+        scaled_file = os.path.join(out_dir, f"{model['name']}_x{n_copies}.txt")
+        write_scaled_model(model, n_copies, scaled_file)
+        models.append((f" [{n_copies*len(model['states'])} states]", scaled_file, odes2py.import_odes(scaled_file), scaled_repeats))
+
+    for suffix, filename, imported, repeats in models:
+        timings["import_odes"+suffix] = timeit(lambda: odes2py.import_odes(filename), repeats)
+        for name, export in exporters(imported, out_dir).items():
+            try:
+                timings[name+suffix] = timeit(export, repeats)
+            except ImportError as e:
+                print(f"Skipping {name}{suffix}: {e}")
+    return timings
+
+def benchmark_import(model_file, out_dir, repeats, n_lines):
+    """Times import_odes alone on a scaled copy of the model with at least n_lines lines (e.g. 100000, the size of
+    genome-scale models, which is too large to run all the exporters on in every benchmark)."""
+    model = odes2py.import_odes(model_file)
+    lines_per_copy = 2*len(model["states"]) + sum(len(model.get(key, [])) for key in ["parameters", "variables", "observables", "reactions"])
+    n_copies = max(1, -(-n_lines // lines_per_copy))
+    scaled_file = os.path.join(out_dir, f"{model['name']}_x{n_copies}.txt")
+    write_scaled_model(model, n_copies, scaled_file)
+    return {f"import_odes [{n_lines} lines]": timeit(lambda: odes2py.import_odes(scaled_file), repeats)}
+
+def benchmark_reduction(model_file, out_dir, repeats):
+    """Times odes2py.reduce_model, and a simulation (solve_ivp with the analytic Jacobian) of the exported SciPy model with and without the reduction, and without common subexpression elimination."""
+    import importlib
+
+    timings = {}
+    model = odes2py.import_odes(model_file)
+    timings["reduce_model"] = timeit(lambda: odes2py.reduce_model(model), repeats)
+    reduced = odes2py.reduce_model(model)
+    reduced["name"] = model["name"]+"_reduced"
+    plain = dict(model, name=model["name"]+"_plain")
+    t_eval = np.linspace(0, 2, 201)
+    sys.path.insert(0, out_dir)
+    try:
+        for suffix, m, cse in [("", model, True), (" (reduced)", reduced, True), (" (no cse)", plain, False)]:
+            odes2py.export_as_scipy(m, os.path.join(out_dir, m["name"]+".py"), cse=cse)
+            module = importlib.import_module(m["name"])
+            module.simulate(t_eval) # numba compilation
+            timings["scipy simulate"+suffix] = timeit(lambda: module.simulate(t_eval), repeats)
+    except ImportError as e:
+        print(f"Skipping scipy simulate: {e}")
+    finally:
+        sys.path.remove(out_dir)
+    return timings
+
+def benchmark_amici(model_file, data_file, out_dir, repeats, n_starts, reduce=False):
+    """Times the AMICI compilation, a simulation, a gradient evaluation and a multistart optimization of the model.
+
+    If reduce is True, the model is first reduced with odes2py.reduce_model, and the optimization is skipped.
+    """
+    import amici
+    import pypesto.optimize as optimize
+    from calibration import load_data, setup_model, create_problem
+
+    timings = {}
+    model = odes2py.import_odes(model_file)
+    suffix = ""
+    if reduce:
+        model = odes2py.reduce_model(model)
+        model["name"] += "_reduced"
+        suffix = " (reduced)"
+    sbml_file = os.path.join(out_dir, model["name"]+".xml")
+    odes2py.export_as_SBML(model, sbml_file)
+    observables = {name: {'name': '', 'formula': formula} for name, formula in model.get("observables", [])}
+    build_dir = os.path.join(out_dir, model["name"]+"_amici")
+
+    sbml_importer = amici.SbmlImporter(sbml_file)
+    timings["sbml2amici"+suffix] = timeit(lambda: sbml_importer.sbml2amici(model["name"], build_dir, observables=observables, verbose=0), 1)
+    model_module = amici.import_model_module(model["name"], os.path.abspath(build_dir))
+
+    data, edata = load_data(data_file)
+    amici_model, solver = setup_model(model_module, data, edata, sensitivity_method="forward", solver_settings=None) # fixed, so the runs and models are compared with the same method and tolerances
+    simulation_solver = solver.clone()
+    simulation_solver.setSensitivityOrder(amici.SensitivityOrder_none)
+    timings["runAmiciSimulation"+suffix] = timeit(lambda: amici.runAmiciSimulation(amici_model, simulation_solver, edata), repeats)
+    timings["gradient"+suffix] = timeit(lambda: amici.runAmiciSimulation(amici_model, solver, edata), repeats)
+    if reduce:
+        return timings
+
+    problem = create_problem(amici_model, solver, edata)
+    np.random.seed(0)
+    timings[f"optimization ({n_starts} starts)"] = timeit(lambda: optimize.minimize(problem, optimizer=optimize.FidesOptimizer(), n_starts=n_starts), 1)
+    return timings
+
+def find_regressions(current, baseline, alpha=0.01, min_ratio=1.1):
+    """This function compares the timings of the current run to a baseline run.
+
+    A stage is flagged as a regression if its median time has increased by at least min_ratio, and (if both runs have at least 3 samples) a one-sided Welch's t-test on the log times is significant at level alpha. Stages with fewer samples are flagged only on the ratio, using the stricter limit min_ratio**3.
+
+    Returns:
+        list of (stage, baseline median, current median, p-value)
+    """
+    regressions = []
+    for stage, times in current.items():
+        if stage not in baseline:
+            continue
+        ratio = np.median(times)/np.median(baseline[stage])
+        if len(times) >= 3 and len(baseline[stage]) >= 3:
+            p = stats.ttest_ind(np.log(times), np.log(baseline[stage]), equal_var=False, alternative='greater').pvalue
+            flagged = ratio >= min_ratio and p < alpha
+        else:
+            p = np.nan
+            flagged = ratio >= min_ratio**3
+        if flagged:
+            regressions.append((stage, np.median(baseline[stage]), np.median(times), p))
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the model pipeline and detect performance regressions.")
+    parser.add_argument("--model", default="M1.txt", help="model file in the IQM/SBtoolbox format")
+    parser.add_argument("--data", default="data.json", help="experimental data used for the AMICI stages")
+    parser.add_argument("--repeats", type=int, default=5, help="number of repeats of each stage (compilation and optimization are run once)")
+    parser.add_argument("--n-starts", type=int, default=10, help="number of starts in the optimization stage")
+    parser.add_argument("--scaled-repeats", type=int, default=3, help="number of repeats of each stage for the scaled models")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[100, 1000, 10000], help="number of states of the scaled copies of the model")
+    parser.add_argument("--import-lines", type=int, default=100000, help="number of lines of the scaled model on which import_odes is timed alone (0 to skip)")
+    parser.add_argument("--skip-amici", action="store_true", help="only benchmark the conversions")
+    parser.add_argument("--history", default=HISTORY_FILE, help="json file with the benchmark history")
+    args = parser.parse_args(argv)
+
+    model_file = os.path.abspath(args.model)
+    data_file = os.path.abspath(args.data)
+    history_file = os.path.abspath(args.history)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as out_dir:
+        os.chdir(out_dir) # keeps any files written by the tools (e.g. AMICI) out of the working directory
+        try:
+            timings = benchmark_conversions(model_file, out_dir, args.repeats, args.sizes, args.scaled_repeats)
+            if args.import_lines:
+                timings.update(benchmark_import(model_file, out_dir, args.scaled_repeats, args.import_lines))
+            timings.update(benchmark_reduction(model_file, out_dir, args.repeats))
+            if not args.skip_amici:
+                timings.update(benchmark_amici(model_file, data_file, out_dir, args.repeats, args.n_starts))
+                timings.update(benchmark_amici(model_file, data_file, out_dir, args.repeats, args.n_starts, reduce=True))
+        finally:
+            os.chdir(cwd)
+
+    history = []
+    if os.path.exists(history_file):
+        with open(history_file, 'r') as f:
+            history = json.load(f)
+
+    print(f"\n{'Stage':<50} {'median (s)':>12} {'baseline (s)':>14}")
+    baseline = history[-1]["timings"] if history else {}
+    for stage, times in timings.items():
+        base = f"{np.median(baseline[stage]):14.4g}" if stage in baseline else f"{'-':>14}"
+        print(f"{stage:<50} {np.median(times):12.4g} {base}")
+
+    regressions = find_regressions(timings, baseline)
+    for stage, base, current, p in regressions:
+        print(f"Regression: {stage} went from {base:.4g} s to {current:.4g} s (p = {p:.3g})")
+
+    history.append({
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "timings": timings,
+        "regressions": [r[0] for r in regressions],
+    })
+    with open(history_file, 'w') as f:
+        json.dump(history, f, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+import json
+import os
+from multiprocessing import Pool
+
+import amici
+import numpy as np
+import pypesto
+from pypesto.C import RDATAS
+
+from evaluation import SENSITIVITY_METHODS, apply_solver_settings, current_solver_settings, rdata_chi2, select_sensitivity_method, tune_solver_settings
+from model_cache import model_id, module_location, use_build
+from objective_cache import CachedObjective
+import result_store
+
+def load_data(data_file="data.json"):
+    """This function loads the experimental data and creates the corresponding AMICI ExpData object.
+
+    Args:
+        data_file:
+            path to a json file with the fields ["time", "mean", "SEM"]
+    Returns:
+        data (dict) and edata (amici.ExpData)
+    """
+    with open(data_file,'r') as f:
+        data = json.load(f)
+
+    edata = amici.ExpData(1,0,0,data["time"]) #specifies the size of the experimental data
+    edata.setObservedData(data["mean"])
+    edata.setObservedDataStdDev(data["SEM"])
+    return data, edata
+
+def set_parameters(model, values):
+    """This function sets the parameters of a model by name, both the free parameters and the fixed (constant) parameters.
+
+    Args:
+        model:
+            The AMICI model
+        values:
+            dict of name: value. Names that are not parameters of the model are ignored.
+    """
+    free = set(model.getParameterIds())
+    fixed = set(model.getFixedParameterIds())
+    for name, value in values.items():
+        if name in free:
+            model.setParameterById(name, value)
+        elif name in fixed:
+            model.setFixedParameterById(name, value)
+
+def setup_model(model_module, data, edata, sensitivity_method='auto', fixed_parameters=None, solver_settings='auto'):
+    """This function creates a model and solver set up for optimization (first order sensitivities at the data time points).
+
+    Parameters compiled as constant parameters (see model_cache.compile_model) are fixed, and sensitivities are only
+    computed for the free parameters.
+
+    Args:
+        model_module:
+            The compiled AMICI model module
+        data, edata:
+            The experimental data, as returned by load_data
+        sensitivity_method:
+            'forward', 'adjoint' or 'auto'. With 'auto', the fastest accurate method is selected with
+            evaluation.select_sensitivity_method, and the choice is cached next to the compiled model.
+        fixed_parameters:
+            Optional dict of name: value for the fixed parameters. Fixed parameters not given keep the values from the model file.
+        solver_settings:
+            'auto', None or a dict with "rtol", "atol", "linear_solver" and "max_steps". With 'auto', the loosest
+            tolerances that meet an accuracy budget are selected with evaluation.tune_solver_settings (after the
+            sensitivity method, and using it), and cached next to the compiled model, so the objective (also in worker
+            processes) reuses them. With None, the AMICI defaults are used.
+    Returns:
+        model and solver
+    """
+    model = model_module.getModel()
+    model.setTimepoints(data["time"])
+    if fixed_parameters:
+        set_parameters(model, fixed_parameters)
+    solver = model.getSolver()
+
+    model.requireSensitivitiesForAllParameters()
+    solver.setSensitivityOrder(amici.SensitivityOrder_first)
+    if sensitivity_method == 'auto':
+        sensitivity_method = select_sensitivity_method(model, solver, edata, module_location(model_module))
+    solver.setSensitivityMethod(SENSITIVITY_METHODS[sensitivity_method])
+    if solver_settings == 'auto': # tuned with the selected sensitivity method, so the gradient budget holds for the method that is used
+        solver_settings = tune_solver_settings(model, solver, edata, cache_dir=module_location(model_module))
+    if solver_settings:
+        apply_solver_settings(solver, solver_settings)
+    return model, solver
+
+def create_problem(model, solver, edata, lb=1e-6, ub=1e7, x_guesses=None, cache_size=0, cache_file=None, lean=True, model_id=None):
+    """This function creates the pypesto problem used for the parameter estimation.
+
+    With lean, AMICI only reports the likelihood and its gradient to the objective (no trajectories, observables or
+    residuals), also when the objective is called with return_dict=True.
+
+    If cache_size is larger than 0, the objective is wrapped in an objective_cache.CachedObjective, so that parameter
+    vectors that have already been evaluated are not simulated again.
+
+    Args:
+        model, solver, edata:
+            The AMICI objects used by the objective
+        lb, ub:
+            Lower and upper bounds, either a scalar (used for all parameters) or one value per parameter
+        x_guesses:
+            Optional list of start guesses
+        cache_size:
+            Maximum number of cached evaluations of the objective, 0 disables the cache
+        cache_file:
+            Optional HDF5 file used to keep the cache between runs (requires h5py), see CachedObjective.save
+        model_id:
+            Identifies the compiled model in the fingerprint of the cache file, typically model_cache.model_id(model_module).
+            Should be given with cache_file, so that the stored cache is not reused after the model has been changed.
+        lean:
+            Set to False to let pypesto choose what AMICI reports, e.g. for least squares optimizers that need the residuals
+    Returns:
+        pypesto.Problem
+    """
+    n_par = len(model.getParameters())
+    objective = pypesto.AmiciObjective(model, solver, [edata], amici_reporting=amici.RDataReporting.likelihood if lean else None)
+    if cache_size > 0:
+        if cache_file and model_id is None:
+            print("Warning, no model_id is given for the objective cache file, so changes to the model equations are not detected.")
+        objective = CachedObjective(objective, max_size=cache_size, filename=cache_file, model_id=model_id)
+    lb = np.broadcast_to(lb, (1, n_par)).copy()
+    ub = np.broadcast_to(ub, (1, n_par)).copy()
+    scales = ['log10']*n_par
+    return pypesto.Problem(objective=objective, lb=lb, ub=ub, x_guesses=x_guesses, x_scales=scales)
+
+def problem_chi2(problem, x):
+    """Returns chi2 of the parameter vector x for a problem from create_problem, looked up in the objective cache if the problem has one."""
+    if isinstance(problem.objective, CachedObjective):
+        return problem.objective.chi2(x)
+    result = problem.objective(np.asarray(x, dtype=float), sensi_orders=(0,), return_dict=True)
+    return sum(rdata_chi2(rdata, edata) for rdata, edata in zip(result[RDATAS], problem.objective.edatas))
+
+def uniform_startpoints(problem, n_starts, seed=None):
+    """Samples n_starts start points uniformly between the bounds of the problem (same as pypesto's default)."""
+    rng = np.random.default_rng(seed)
+    return rng.uniform(problem.lb, problem.ub, size=(n_starts, problem.dim))
+
+def screened_startpoints(problem, model, solver, edata, n_starts, n_samples=4096, method="sobol", min_distance=1.0, seed=None, num_threads=1):
+    """This function selects start points by pre-screening a space-filling sample of parameter vectors.
+
+    A Sobol or Latin hypercube sample of n_samples parameter vectors is drawn in log10 space between the bounds of the
+    problem, and chi2 of all samples is evaluated in batches with AMICI (likelihood only, no sensitivities, see
+    global_optimization.BatchCost). The n_starts best samples that are at least min_distance apart (in log10 space)
+    are returned, so the local optimizations start from good but diverse points instead of hopeless ones.
+
+    Examples:
+        Screen 4096 Sobol points and start 30 Fides runs from the best, diverse ones
+            startpoints = screened_startpoints(problem, model, solver, edata, 30, seed=0)
+            result = parallel_minimize(problem, optimize.FidesOptimizer(), 30, model_module, startpoints=startpoints)
+
+    Args:
+        problem:
+            The pypesto problem, whose bounds (which must be positive) are sampled
+        model, solver, edata:
+            The AMICI objects used to evaluate the samples
+        n_starts:
+            Number of start points to select
+        n_samples:
+            Number of screened samples. For Sobol, this is rounded up to a power of 2.
+        method:
+            "sobol" or "lhs" (Latin hypercube)
+        min_distance:
+            Minimal Euclidean distance (in log10 space) between the selected start points, where possible
+        seed:
+            Seed of the (scrambled) sample
+        num_threads:
+            as in evaluation.evaluate_batch
+    Returns:
+        array (n_starts, n_par) of start points, in the scale of the problem
+    """
+    from scipy.stats import qmc
+    from global_optimization import BatchCost
+
+    lb, ub = np.ravel(problem.lb), np.ravel(problem.ub)
+    if np.any(lb <= 0):
+        raise ValueError("The bounds must be positive for sampling in log10 space.")
+    if method == "sobol":
+        sample = qmc.Sobol(problem.dim, seed=seed).random_base2(int(np.ceil(np.log2(n_samples))))
+    elif method == "lhs":
+        sample = qmc.LatinHypercube(problem.dim, seed=seed).random(n_samples)
+    else:
+        raise ValueError(f"Unknown sampling method {method}, use 'sobol' or 'lhs'.")
+    sample = qmc.scale(sample, np.log10(lb), np.log10(ub))
+
+    cost = BatchCost(model, solver, edata, num_threads)
+    cost(sample.T)
+    x, selected_chi2 = cost.best(n_starts, min_distance)
+    print(f"Screened {len(sample)} start points ({cost.n_failed} failed simulations), "
+          f"selected {len(x)} with chi2 from {selected_chi2.min():.4g} to {selected_chi2.max():.4g}")
+    return 10**x
+
+# State of a worker process, created once by _init_worker and reused by all starts run in that process
+_worker = {}
+
+def worker_problem(model_name, model_path, data_file, lb, ub, fixed_parameters, sensitivity_method='auto', solver_settings='auto'):
+    """Creates the problem of a worker process from the compiled model module (in model_path) and the data file.
+    The sensitivity method and solver settings are passed on to setup_model, typically those of the main process
+    (see solver_options), so that the workers optimize the same objective."""
+    use_build(model_path) # the build is not evicted while the worker runs
+    model_module = amici.import_model_module(model_name, model_path)
+    data, edata = load_data(data_file)
+    model, solver = setup_model(model_module, data, edata, sensitivity_method, fixed_parameters, solver_settings)
+    return create_problem(model, solver, edata, lb, ub)
+
+def fixed_parameter_values(problem):
+    """Returns the fixed parameters of the AMICI model of a problem, as a dict of name: value."""
+    amici_model = getattr(problem.objective, "objective", problem.objective).amici_model # unwraps a CachedObjective
+    return dict(zip(amici_model.getFixedParameterIds(), amici_model.getFixedParameters()))
+
+def solver_options(problem):
+    """Returns the sensitivity method ('forward' or 'adjoint') and the solver settings (as a dict) of the AMICI solver of a problem."""
+    solver = getattr(problem.objective, "objective", problem.objective).amici_solver # unwraps a CachedObjective
+    sensitivity_method = next((name for name, value in SENSITIVITY_METHODS.items() if value == solver.getSensitivityMethod()), 'forward')
+    return sensitivity_method, current_solver_settings(solver)
+
+def _init_worker(model_name, model_path, data_file, lb, ub, optimizer, fixed_parameters, sensitivity_method, solver_settings):
+    _worker["problem"] = worker_problem(model_name, model_path, data_file, lb, ub, fixed_parameters, sensitivity_method, solver_settings)
+    _worker["optimizer"] = optimizer
+
+def _run_start(task):
+    start_id, x0 = task
+    opts = pypesto.optimize.OptimizeOptions(allow_failed_starts=True)
+    return _worker["optimizer"].minimize(_worker["problem"], x0, str(start_id), optimize_options=opts)
+
+def run_fingerprint(model_module, data_file):
+    """Returns the model id and the hash of the data file, stored in the header of a store so that a run is only
+    resumed with the same model and data."""
+    return {"model_id": model_id(model_module), "data_hash": result_store.file_hash(data_file)}
+
+def start_run(problem, n_starts, startpoints=None, seed=None, store=None, resume=False, fingerprint=None):
+    """This function prepares a multistart run: the start points, the starts left to run and the store.
+
+    With resume, the starts already in the store are read back into the result, and the seed of the stored run is
+    used so that the remaining starts get the same start points as the original run. If the stored run is for another
+    model, data, number of starts, parameters or start points, it is not resumed: the old store is moved to
+    store + ".old" and a new run is started.
+
+    Args:
+        fingerprint:
+            Optional dict (e.g. from run_fingerprint) saved in the header, which must match to resume the run
+    Returns:
+        the start points, the starts to run (list of (start_id, x0)), the pypesto.Result with the finished starts, and
+        the opened store (None without a store)
+    """
+    fingerprint = fingerprint or {}
+    done = {}
+    stored = None
+    if store and resume and os.path.exists(store):
+        stored, done = result_store.read_store(store)
+        if stored is not None:
+            settings = {"n_starts": n_starts, "parameter_ids": list(problem.x_names), **fingerprint}
+            if any(stored.get(key) != value for key, value in settings.items()):
+                stored = None
+            elif seed is None:
+                seed = stored["seed"]
+    if store and seed is None and startpoints is None:
+        seed = int(np.random.SeedSequence().entropy % 2**63)
+    if startpoints is None:
+        startpoints = uniform_startpoints(problem, n_starts, seed)
+    if stored is not None and result_store.startpoints_hash(startpoints) != stored["startpoints_hash"]:
+        stored = None
+    if store and resume and os.path.exists(store):
+        if stored is None:
+            print(f"The run in {store} has another model, data or settings and is not resumed: it is moved to {store}.old and a new run is started")
+            os.replace(store, store + ".old")
+            done = {}
+            resume = False
+        else:
+            print(f"Resuming the multistart in {store}: {len(done)} of {n_starts} starts are finished")
+    tasks = [(start_id, x0) for start_id, x0 in enumerate(startpoints) if start_id not in done]
+
+    result = pypesto.Result(problem)
+    for record in done.values():
+        result.optimize_result.append(result_store.record_to_result(record), sort=False)
+
+    f = None
+    if store:
+        header = {"n_starts": n_starts, "seed": seed, "startpoints_hash": result_store.startpoints_hash(startpoints),
+                  "parameter_ids": list(problem.x_names), **fingerprint}
+        f = result_store.open_store(store, header, resume)
+
+    return startpoints, tasks, result, f
+
+def parallel_minimize(problem, optimizer, n_starts, model_module, data_file="data.json", n_procs=None, startpoints=None, seed=None, store=None, resume=False):
+    """This function runs a multistart optimization with the starts spread over a pool of worker processes.
+
+    Each worker imports the compiled model module and sets up its own model, solver, ExpData and problem once, so only
+    the start points and the optimizer results are sent between the processes. The fixed parameters of the workers are
+    set to the values in the model of the problem.
+
+    If a store is given, each finished start is appended to it as soon as it finishes (see result_store.py), so the
+    progress can be followed while the optimization runs. With resume, the starts already in the store are read back
+    instead of being run again, and the remaining starts use the same start points as the original run (from the seed
+    in the store).
+
+    Examples:
+        Run 300 starts on all available cores
+            result = parallel_minimize(problem, optimize.FidesOptimizer(), 300, model_module)
+        Run 300 starts, storing each start, and continue where a previous (stopped) run ended
+            result = parallel_minimize(problem, optimize.FidesOptimizer(), 300, model_module, store="starts.jsonl", resume=True)
+
+    Args:
+        problem:
+            The pypesto problem (in the main process), used for the bounds and start points, and stored in the result
+        optimizer:
+            The pypesto optimizer to use for each start
+        n_starts:
+            Number of starts
+        model_module:
+            The compiled AMICI model module (e.g. from model_cache.compile_model)
+        data_file:
+            path to the experimental data, loaded by each worker
+        n_procs:
+            Number of worker processes, defaults to the number of cores. With 1, the starts are run in this process
+            using problem directly.
+        startpoints:
+            Optional array (n_starts, n_par) of start points. If None, start points are sampled uniformly within the bounds
+        seed:
+            Seed for the sampling of start points. If None and a store is used, a seed is drawn and saved in the store.
+        store:
+            Optional path to a JSON lines file where the finished starts are written
+        resume:
+            Set to True to continue the run in store
+    Returns:
+        pypesto.Result, with all starts merged into result.optimize_result
+    """
+    startpoints, tasks, result, f = start_run(problem, n_starts, startpoints, seed, store, resume,
+                                              run_fingerprint(model_module, data_file))
+    try:
+        if n_procs == 1:
+            opts = pypesto.optimize.OptimizeOptions(allow_failed_starts=True)
+            results = (optimizer.minimize(problem, x0, str(start_id), optimize_options=opts) for start_id, x0 in tasks)
+            _collect(results, result, f)
+        else:
+            init_args = (model_module.__name__, module_location(model_module), data_file, problem.lb, problem.ub, optimizer,
+                         fixed_parameter_values(problem), *solver_options(problem))
+            with Pool(n_procs, initializer=_init_worker, initargs=init_args) as pool:
+                _collect(pool.imap_unordered(_run_start, tasks), result, f)
+    finally:
+        if f:
+            f.close()
+    result.optimize_result.sort()
+    return result
+
+def _collect(optimizer_results, result, store_file):
+    for optimizer_result in optimizer_results:
+        result.optimize_result.append(optimizer_result, sort=False)
+        if store_file:
+            result_store.append_start(store_file, optimizer_result.id, optimizer_result)
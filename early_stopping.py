@@ -0,0 +1,288 @@
+""" Multistart optimization that stops when more starts are unlikely to find a better optimum.
+
+Most starts of a multistart optimization end up in the same few local minima. adaptive_minimize launches the starts
+one at a time (per worker), and after each finished start it counts how often the best objective value has been
+reached (within a tolerance), and how many distinct local minima have been found. From these, the probability that
+a new start would end up in a basin of attraction that has not been found yet is estimated with the Bayesian estimate
+of Boender & Rinnooy Kan (1987): with n starts that found w distinct minima, the expected relative size of the
+unobserved basins is w(w+1)/(n(n-1)). No more starts are launched once the best value has been reached min_hits times
+and this probability is below a threshold.
+
+Starts that are clearly heading to a worse local minimum are also stopped while they run: the objective of each start
+is wrapped in a StoppingObjective, which stops the start if its objective value has stagnated (over a window of
+evaluations) while still being more than a margin above the best value found by any start.
+"""
+import copy
+import os
+import queue
+from multiprocessing import Pool, Value
+
+import numpy as np
+import pypesto
+from pypesto.C import FVAL
+from pypesto.objective import ObjectiveBase
+
+import calibration
+from calibration import fixed_parameter_values, run_fingerprint, solver_options, start_run
+from model_cache import module_location
+import result_store
+
+STOPPED = "Stopped early"
+
+class StartStopped(Exception):
+    """Raised by a StoppingObjective to stop a running start."""
+
+class StoppingObjective(ObjectiveBase):
+    """This class wraps an objective, and stops the start (by raising StartStopped) when it is clearly heading to a worse local minimum.
+
+    The best objective value over all starts is shared between the processes in best, and the lowest value of this
+    start is written to it. A start is stopped when its lowest objective value has improved by less than progress_tol
+    (relative) over the last window evaluations, while it is more than margin above best. Once stop is set (no new
+    starts are launched), starts more than margin above best are stopped at their next evaluation.
+
+    Args:
+        objective:
+            The objective to wrap
+        best, stop:
+            Shared values (multiprocessing.Value) with the best objective value of all starts, and a flag that is
+            set when no new starts are launched
+        margin:
+            How much worse than the best value (in objective units, i.e. negative log-likelihood) a start must be to be stopped
+        window:
+            Number of evaluations over which the progress is measured
+        progress_tol:
+            Relative improvement over window evaluations below which a start counts as stagnated
+    """
+
+    def __init__(self, objective, best, stop, margin=1.0, window=20, progress_tol=1e-3):
+        super().__init__(x_names=objective.x_names)
+        self.objective = objective
+        self.best = best
+        self.stop = stop
+        self.margin = margin
+        self.window = window
+        self.progress_tol = progress_tol
+        self.reset()
+
+    def __deepcopy__(self, memodict=None):
+        # the shared values are shared with the copy (pypesto.Problem copies its objective)
+        return StoppingObjective(copy.deepcopy(self.objective, memodict), self.best, self.stop, self.margin, self.window, self.progress_tol)
+
+    def reset(self):
+        """Forgets the evaluations of the previous start."""
+        self.trace = [] # lowest objective value of the start after each evaluation
+        self.x_min = None
+        self.reason = None
+
+    def initialize(self):
+        self.objective.initialize()
+
+    def check_mode(self, mode):
+        return self.objective.check_mode(mode)
+
+    def check_sensi_orders(self, sensi_orders, mode):
+        return self.objective.check_sensi_orders(sensi_orders, mode)
+
+    def call_unprocessed(self, x, sensi_orders, mode, **kwargs):
+        result = self.objective.call_unprocessed(x, sensi_orders, mode, **kwargs)
+        fval = result.get(FVAL)
+        if fval is None or not np.isfinite(fval):
+            return result
+        if not self.trace or fval < self.trace[-1]:
+            self.x_min = np.array(x, dtype=float)
+            self.trace.append(float(fval))
+            with self.best.get_lock():
+                self.best.value = min(self.best.value, float(fval))
+        else:
+            self.trace.append(self.trace[-1])
+        self.check()
+        return result
+
+    def check(self):
+        """Raises StartStopped if the start is clearly heading to a worse local minimum."""
+        f_min = self.trace[-1]
+        if f_min <= self.best.value + self.margin:
+            return
+        if self.stop.value:
+            self.reason = f"{STOPPED}: no new starts are launched and the objective value is {f_min - self.best.value:.3g} above the best value"
+        elif len(self.trace) > self.window and self.trace[-self.window-1] - f_min < self.progress_tol*max(1.0, abs(f_min)):
+            self.reason = f"{STOPPED}: the objective value stagnated {f_min - self.best.value:.3g} above the best value"
+        if self.reason:
+            raise StartStopped(self.reason)
+
+def distinct_optima(fvals, tol):
+    """Returns the number of distinct local minima among the objective values of finished starts (values closer than tol are the same minimum)."""
+    fvals = np.sort(np.asarray(fvals, dtype=float))
+    return int(len(fvals) > 0) + int(np.sum(np.diff(fvals) > tol))
+
+def unobserved_basin_probability(n, w):
+    """Returns the probability that a new start ends up in a basin of attraction that has not been found yet.
+
+    This is the Bayesian estimate of Boender & Rinnooy Kan (1987) of the relative size of the unobserved basins, after
+    n starts that found w distinct local minima. A better minimum can only be in an unobserved basin, so this is an
+    upper bound of the probability that a new start finds a better minimum.
+    """
+    if n <= w + 1:
+        return 1.0
+    return w*(w + 1)/(n*(n - 1))
+
+def projected_gradient(x, grad, lb, ub, bound_tol=1e-6):
+    """Returns the gradient in log10 scale (d f / d log10(x)), with the components of parameters at an active bound set to 0.
+
+    A bound is active when the parameter is within bound_tol (relative) of it, and the gradient points out of the
+    bounds, i.e. the objective would only decrease by leaving them.
+    """
+    x, grad = np.asarray(x, dtype=float), np.asarray(grad, dtype=float)
+    lb, ub = np.ravel(lb), np.ravel(ub)
+    active = ((x <= lb + bound_tol*np.abs(lb)) & (grad > 0)) | ((x >= ub - bound_tol*np.abs(ub)) & (grad < 0))
+    return np.where(active, 0.0, grad*np.abs(x)*np.log(10))
+
+def converged(optimizer_result, lb, ub, gtol=1e-2):
+    """Returns True if a start ended in a local minimum: the norm of its projected gradient (see projected_gradient) is at most gtol*max(1, |fval|).
+
+    Starts without a gradient are counted as converged. On M1, starts that end in a minimum have a projected gradient
+    norm below 1, and starts that stop on a plateau of the objective (fval 1e4-1e5) one above 1e5.
+    """
+    r = optimizer_result
+    if r.grad is None or r.x is None:
+        return True
+    return np.linalg.norm(projected_gradient(r.x, r.grad, lb, ub)) <= gtol*max(1.0, abs(r.fval))
+
+def stopping_statistics(result, tol=0.01, gtol=1e-2):
+    """Returns the statistics used to stop a multistart: the best objective value, how often it was reached within tol, the number of distinct minima and the probability of an unobserved basin.
+
+    Only starts that ended in a local minimum are counted: starts that failed, were stopped early, or did not converge
+    within gtol (see converged, e.g. on a plateau of the objective where the optimizer stopped making progress) are not.
+    """
+    problem = result.problem
+    lb, ub = getattr(problem, "lb_full", problem.lb), getattr(problem, "ub_full", problem.ub)
+    fvals = [r.fval for r in result.optimize_result.list
+             if r.fval is not None and np.isfinite(r.fval) and not str(r.message).startswith(STOPPED)
+             and converged(r, lb, ub, gtol)]
+    if not fvals:
+        return {"n": 0, "best": np.inf, "hits": 0, "minima": 0, "p_unobserved": 1.0}
+    best = min(fvals)
+    w = distinct_optima(fvals, tol)
+    return {"n": len(fvals), "best": best, "hits": sum(f <= best + tol for f in fvals), "minima": w,
+            "p_unobserved": unobserved_basin_probability(len(fvals), w)}
+
+def _stopping_problem(problem, best, stop, settings):
+    objective = StoppingObjective(problem.objective, best, stop, **settings)
+    return pypesto.Problem(objective=objective, lb=problem.lb, ub=problem.ub, x_names=problem.x_names, x_scales=problem.x_scales)
+
+def _minimize(optimizer, problem, start_id, x0):
+    """Runs one start on a problem with a StoppingObjective, and returns the best point of the start if it was stopped."""
+    objective = problem.objective
+    objective.reset()
+    opts = pypesto.optimize.OptimizeOptions(allow_failed_starts=True)
+    result = optimizer.minimize(problem, x0, str(start_id), optimize_options=opts)
+    if objective.reason:
+        result.x = problem.get_full_vector(objective.x_min)
+        result.fval = objective.trace[-1]
+        result.n_fval = len(objective.trace)
+        result.message = objective.reason
+    return result
+
+def _init_worker(best, stop, settings, *init_args):
+    calibration._init_worker(*init_args)
+    calibration._worker["problem"] = _stopping_problem(calibration._worker["problem"], best, stop, settings)
+
+def _run_start(task):
+    start_id, x0 = task
+    return _minimize(calibration._worker["optimizer"], calibration._worker["problem"], start_id, x0)
+
+def adaptive_minimize(problem, optimizer, max_starts, model_module, data_file="data.json", n_procs=None, startpoints=None,
+                      seed=None, store=None, resume=False, tol=0.01, gtol=1e-2, threshold=0.01, min_hits=3, margin=1.0, window=20, progress_tol=1e-3):
+    """This function runs a multistart optimization that stops when more starts are unlikely to find a better optimum.
+
+    The starts are run in a pool of worker processes as in calibration.parallel_minimize, but only one start per
+    worker is launched at a time. No more starts are launched once the best objective value has been reached min_hits
+    times (within tol), and the estimated probability that a new start ends up in a basin that has not been found yet
+    is below threshold (see unobserved_basin_probability). Running starts that stagnate more than margin above the
+    best value are stopped (see StoppingObjective), and are returned with the best point they reached and the message
+    "Stopped early: ...".
+
+    Examples:
+        Run at most 300 starts on all available cores
+            result = adaptive_minimize(problem, optimize.FidesOptimizer(), 300, model_module)
+        Require that the best value was found 5 times, and that the probability of an unobserved basin is below 0.1 %
+            result = adaptive_minimize(problem, optimize.FidesOptimizer(), 300, model_module, min_hits=5, threshold=1e-3)
+
+    Args:
+        problem, optimizer, model_module, data_file, n_procs, startpoints, seed, store, resume:
+            as in calibration.parallel_minimize. With resume, the stored starts are included in the statistics.
+        max_starts:
+            Maximum number of starts
+        tol:
+            Tolerance (in objective units) within which two objective values are counted as the same minimum
+        gtol:
+            Starts that end with a larger (relative, projected) gradient norm are not counted as local minima (see converged)
+        threshold:
+            No new starts are launched when the probability of an unobserved basin is below threshold
+        min_hits:
+            Number of times the best value must have been reached before the run can stop
+        margin, window, progress_tol:
+            When to stop a running start, see StoppingObjective
+    Returns:
+        pypesto.Result, with all finished (and stopped) starts in result.optimize_result
+    """
+    startpoints, tasks, result, f = start_run(problem, max_starts, startpoints, seed, store, resume,
+                                              run_fingerprint(model_module, data_file))
+    best = Value('d', np.inf)
+    stop = Value('b', False)
+    stats = None
+    settings = {"margin": margin, "window": window, "progress_tol": progress_tol}
+    tasks = iter(tasks)
+
+    def update():
+        """Updates the statistics with the finished starts, and decides if more starts should be launched."""
+        nonlocal stats
+        stats = stopping_statistics(result, tol, gtol)
+        best.value = min(best.value, stats["best"])
+        if stats["hits"] >= min_hits and stats["p_unobserved"] < threshold:
+            stop.value = True
+
+    def finished(optimizer_result):
+        result.optimize_result.append(optimizer_result, sort=False)
+        if f:
+            result_store.append_start(f, optimizer_result.id, optimizer_result)
+        update()
+
+    update()
+
+    try:
+        if n_procs == 1:
+            local_problem = _stopping_problem(problem, best, stop, settings)
+            for start_id, x0 in tasks:
+                if stop.value:
+                    break
+                finished(_minimize(optimizer, local_problem, start_id, x0))
+        else:
+            init_args = (model_module.__name__, module_location(model_module), data_file, problem.lb, problem.ub, optimizer,
+                         fixed_parameter_values(problem), *solver_options(problem))
+            done = queue.Queue()
+            with Pool(n_procs, initializer=_init_worker, initargs=(best, stop, settings) + init_args) as pool:
+                def launch():
+                    task = None if stop.value else next(tasks, None)
+                    if task is None:
+                        return 0
+                    pool.apply_async(_run_start, (task,), callback=done.put, error_callback=done.put)
+                    return 1
+                running = sum(launch() for _ in range(n_procs or os.cpu_count()))
+                while running:
+                    optimizer_result = done.get()
+                    running -= 1
+                    if isinstance(optimizer_result, Exception):
+                        raise optimizer_result
+                    finished(optimizer_result)
+                    running += launch()
+    finally:
+        if f:
+            f.close()
+
+    n_stopped = sum(str(r.message).startswith(STOPPED) for r in result.optimize_result.list)
+    print(f"Multistart: {len(result.optimize_result)} of {max_starts} starts ({n_stopped} stopped early), "
+          f"best value reached {stats['hits']} times, {stats['minima']} distinct minima, "
+          f"probability of an unobserved basin {stats['p_unobserved']:.2g}")
+    result.optimize_result.sort()
+    return result
@@ -0,0 +1,338 @@
+import json
+import os
+import time
+
+import amici
+import numpy as np
+
+def rdata_chi2(rdata, edata):
+    """Returns chi2 of an AMICI ReturnData.
+
+    With likelihood-only reporting (see simulate), AMICI does not report chi2 or the residuals. chi2 is then computed
+    from the log-likelihood and the standard deviations of the data (assuming normally distributed noise).
+    """
+    chi2 = rdata["chi2"]
+    if np.isfinite(chi2):
+        return chi2
+    if rdata["res"] is not None and len(rdata["res"]):
+        return float(np.sum(np.asarray(rdata["res"])**2))
+    return float(-2*rdata["llh"] - chi2_offset(edata))
+
+def chi2_offset(edata):
+    """Returns the difference between -2*log-likelihood and chi2 for the data in edata (the normalization of the normal distributions, sum(log(2*pi*sigma^2)))."""
+    observed = np.isfinite(np.asarray(edata.getObservedData()))
+    sigma = np.asarray(edata.getObservedDataStdDev())[observed]
+    return float(np.sum(np.log(2*np.pi*sigma**2)))
+
+def simulate(model, solver, edata, full=False):
+    """This function simulates a model, by default reporting only the likelihood (and its gradient, if the solver computes sensitivities).
+
+    With likelihood-only reporting, AMICI does not store the state trajectories, observables, residuals or their
+    sensitivities in the ReturnData, which makes evaluating the cost cheaper. Use rdata_chi2 to get chi2.
+
+    Examples:
+        Print the cost
+            rdata = simulate(model, solver, edata)
+            print(rdata_chi2(rdata, edata))
+        Simulate the trajectories for plotting
+            rdata = simulate(model, solver, edata, full=True)
+
+    Args:
+        model, solver, edata:
+            The AMICI objects to simulate. The reporting mode of the solver is restored afterwards.
+        full:
+            Set to True to report everything (trajectories, observables, residuals), e.g. for plotting
+    Returns:
+        amici ReturnData
+    """
+    mode = solver.getReturnDataReportingMode()
+    solver.setReturnDataReportingMode(amici.RDataReporting.full if full else amici.RDataReporting.likelihood)
+    try:
+        return amici.runAmiciSimulation(model, solver, edata)
+    finally:
+        solver.setReturnDataReportingMode(mode)
+
+def evaluate_batch(model, solver, edata, parameters, num_threads=1, batch_size=1000, sensitivities=False):
+    """This function evaluates the cost of many parameter sets using AMICI's multithreaded runAmiciSimulations.
+
+    The parameter sets are simulated in batches of batch_size, each parameter set as its own copy of edata. Only the
+    likelihood is reported back from AMICI, and the values are collected into arrays, so no ReturnData objects are
+    kept after a batch has been evaluated. Failed simulations are given nan.
+
+    Examples:
+        Evaluate 10000 parameter sets on 8 threads
+            res = evaluate_batch(model, solver, edata, parameters, num_threads=8)
+            best = parameters[np.nanargmin(res["chi2"])]
+
+    Args:
+        model, solver, edata:
+            The AMICI objects to simulate. The solver is cloned and not modified.
+        parameters:
+            array (N, n_par) of parameter sets, in the parameter scale of the model
+        num_threads:
+            Number of threads used by runAmiciSimulations (requires AMICI compiled with OpenMP)
+        batch_size:
+            Number of parameter sets simulated per call to runAmiciSimulations
+        sensitivities:
+            Set to True to also compute the gradient of the log-likelihood (sllh)
+    Returns:
+        dict with the arrays "chi2" (N), "llh" (N), "status" (N) and, if sensitivities is True, "sllh" (N, n_par)
+    """
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    n_sets, n_par = parameters.shape
+    if num_threads > 1 and not amici.compiledWithOpenMP():
+        print("Warning, AMICI is not compiled with OpenMP. The parameter sets will be simulated on a single thread.")
+
+    solver = solver.clone()
+    solver.setReturnDataReportingMode(amici.RDataReporting.likelihood)
+    if sensitivities:
+        solver.setSensitivityOrder(amici.SensitivityOrder_first)
+    else:
+        solver.setSensitivityOrder(amici.SensitivityOrder_none)
+
+    res = {"chi2": np.full(n_sets, np.nan), "llh": np.full(n_sets, np.nan), "status": np.zeros(n_sets, dtype=int)}
+    if sensitivities:
+        res["sllh"] = np.full((n_sets, n_par), np.nan)
+
+    for start in range(0, n_sets, batch_size):
+        edatas = []
+        for p in parameters[start:start+batch_size]:
+            e = amici.ExpData(edata)
+            e.parameters = p
+            edatas.append(e)
+        rdatas = amici.runAmiciSimulations(model, solver, edatas, num_threads=num_threads)
+        for i, rdata in enumerate(rdatas, start):
+            res["status"][i] = rdata.status
+            if rdata.status != amici.AMICI_SUCCESS:
+                continue
+            res["chi2"][i] = rdata_chi2(rdata, edata)
+            res["llh"][i] = rdata.llh
+            if sensitivities:
+                res["sllh"][i] = rdata.sllh
+        del rdatas, edatas
+    return res
+
+SENSITIVITY_METHODS = {"forward": amici.SensitivityMethod_forward, "adjoint": amici.SensitivityMethod_adjoint}
+SENSITIVITY_CACHE = "sensitivity_method.json"
+
+def finite_difference_gradient(model, solver, edata, rel_step=1e-6):
+    """Computes the gradient of the log-likelihood with central finite differences, in the parameter scale of the model."""
+    solver = solver.clone()
+    solver.setSensitivityOrder(amici.SensitivityOrder_none)
+    p0 = np.array(model.getParameters())
+    grad = np.zeros(len(p0))
+    try:
+        for i in range(len(p0)):
+            h = rel_step*max(abs(p0[i]), 1e-8)
+            llh = []
+            for sign in [1, -1]:
+                p = p0.copy()
+                p[i] += sign*h
+                model.setParameters(p)
+                llh.append(amici.runAmiciSimulation(model, solver, edata)["llh"])
+            grad[i] = (llh[0]-llh[1])/(2*h)
+    finally:
+        model.setParameters(p0)
+    return grad
+
+def time_gradient(model, solver, edata, method, n_repeats=5):
+    """Returns the fastest time (s) of n_repeats gradient evaluations with the given sensitivity method, and the gradient."""
+    solver = solver.clone()
+    solver.setSensitivityOrder(amici.SensitivityOrder_first)
+    solver.setSensitivityMethod(SENSITIVITY_METHODS[method])
+    times = []
+    for _ in range(n_repeats):
+        tic = time.perf_counter()
+        rdata = amici.runAmiciSimulation(model, solver, edata)
+        times.append(time.perf_counter()-tic)
+    return min(times), np.array(rdata["sllh"])
+
+def select_sensitivity_method(model, solver, edata, cache_dir=None, tol=1e-2, n_repeats=5):
+    """This function selects the fastest sensitivity method (forward or adjoint) with an accurate gradient.
+
+    Both methods, and a finite difference gradient (with tight tolerances) as the baseline, are timed on the actual model and data. The fastest
+    method whose gradient agrees with the finite differences within tol (relative error of the gradient norm) is
+    selected. The choice is stored in cache_dir (typically the build directory of the model) and reused as long as the
+    time points and parameters of the model, and the tolerances of the solver, are unchanged.
+
+    Examples:
+        Select the method, and cache it next to the compiled model
+            method = select_sensitivity_method(model, solver, edata, module_location(model_module))
+            solver.setSensitivityMethod(SENSITIVITY_METHODS[method])
+
+    Args:
+        model, solver, edata:
+            The AMICI objects to evaluate. The sensitivities are computed for the parameters of the model.
+        cache_dir:
+            Directory where the choice is stored. If None, the choice is not cached.
+        tol:
+            Accepted relative error of the gradient, compared to finite differences
+        n_repeats:
+            Number of repeated evaluations per method, the fastest is used
+    Returns:
+        the name of the selected method, 'forward' or 'adjoint'
+    """
+    key = {"timepoints": list(edata.getTimepoints()), "parameter_ids": list(model.getParameterIds()),
+           "plist": list(model.getParameterList()), "solver_settings": current_solver_settings(solver)}
+    cache_file = os.path.join(cache_dir, SENSITIVITY_CACHE) if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return cached["method"]
+
+    reference_solver = solver.clone() # finite differences need tight tolerances, also when the solver has been tuned
+    apply_solver_settings(reference_solver, REFERENCE_SETTINGS)
+    tic = time.perf_counter()
+    grad_fd = finite_difference_gradient(model, reference_solver, edata)
+    timings = {"finite differences": time.perf_counter()-tic}
+    errors = {}
+    for method in SENSITIVITY_METHODS:
+        timings[method], grad = time_gradient(model, solver, edata, method, n_repeats)
+        grad_fd_free = grad_fd[list(model.getParameterList())]
+        errors[method] = np.linalg.norm(grad-grad_fd_free)/max(np.linalg.norm(grad_fd_free), 1e-12)
+
+    accurate = [m for m in SENSITIVITY_METHODS if errors[m] <= tol]
+    if accurate:
+        method = min(accurate, key=timings.get)
+    else:
+        method = min(errors, key=errors.get)
+        print(f"Warning, no sensitivity method agrees with finite differences within {tol}. Using the most accurate one ({method}).")
+    print(f"Selected {method} sensitivities. Gradient times (s): {timings}, relative errors: {errors}")
+
+    if cache_file:
+        with open(cache_file, 'w') as f:
+            json.dump({"key": key, "method": method, "timings": timings, "errors": errors}, f, indent=4)
+    return method
+
+SOLVER_SETTINGS_CACHE = "solver_settings.json"
+LINEAR_SOLVERS = {"dense": amici.LinearSolver_dense, "KLU": amici.LinearSolver_KLU}
+REFERENCE_SETTINGS = {"rtol": 1e-12, "atol": 1e-14, "linear_solver": "dense", "max_steps": 1000000}
+RTOLS = [1e-3, 1e-4, 1e-5, 1e-6, 1e-7, 1e-8, 1e-10]
+ATOLS = [1e-6, 1e-8, 1e-10, 1e-12, 1e-14, 1e-16]
+
+def current_solver_settings(solver):
+    """Returns the tolerances, linear solver and maximum number of steps of a solver, as a dict."""
+    linear_solver = next((name for name, value in LINEAR_SOLVERS.items() if value == solver.getLinearSolver()), "dense")
+    return {"rtol": solver.getRelativeTolerance(), "atol": solver.getAbsoluteTolerance(),
+            "linear_solver": linear_solver, "max_steps": solver.getMaxSteps()}
+
+def apply_solver_settings(solver, settings):
+    """Sets the tolerances, linear solver and maximum number of steps of a solver from a dict (as returned by tune_solver_settings)."""
+    solver.setRelativeTolerance(settings["rtol"])
+    solver.setAbsoluteTolerance(settings["atol"])
+    solver.setLinearSolver(LINEAR_SOLVERS[settings["linear_solver"]])
+    solver.setMaxSteps(int(settings["max_steps"]))
+
+def tuning_sample(model, n_samples=16, lb=1e-6, ub=1e7, seed=0):
+    """Returns a representative sample of parameter vectors for tune_solver_settings: the current parameters of the model and a Sobol sample in log10 space between lb and ub."""
+    from scipy.stats import qmc
+    n_par = len(model.getParameters())
+    sample = qmc.scale(qmc.Sobol(n_par, seed=seed).random(n_samples), np.log10(lb), np.log10(ub))
+    return np.vstack([np.array(model.getParameters()), 10**sample])
+
+def tune_solver_settings(model, solver, edata, parameters=None, cache_dir=None, chi2_tol=1e-6, grad_tol=1e-4, max_steps=10000, n_repeats=3):
+    """This function selects the loosest solver tolerances (and the fastest linear solver) that meet an accuracy budget.
+
+    chi2 and its gradient are evaluated on a sample of parameter vectors for a grid of relative and absolute
+    tolerances, with the dense and the KLU linear solver, and compared to a reference with very tight tolerances. For
+    each linear solver, the loosest tolerances whose largest relative errors of chi2 and of the gradient are within
+    chi2_tol and grad_tol are taken (a failed simulation counts as inaccurate), and of these (and the current settings
+    of the solver, if they meet the budget) the fastest is selected.
+    The gradients are computed with the sensitivity method of the solver, so the budget holds for that method.
+    Parameter vectors where the reference simulation fails are not used. The choice is stored in cache_dir (typically
+    the build directory of the model) and reused as long as the time points, parameters and budget are unchanged.
+
+    Examples:
+        Tune the solver, and cache the settings next to the compiled model
+            settings = tune_solver_settings(model, solver, edata, cache_dir=module_location(model_module))
+            apply_solver_settings(solver, settings)
+
+    Args:
+        model, solver, edata:
+            The AMICI objects to evaluate. The model and solver are not modified.
+        parameters:
+            array (N, n_par) of parameter vectors (in the parameter scale of the model). Defaults to tuning_sample(model).
+        cache_dir:
+            Directory where the choice is stored. If None, the choice is not cached.
+        chi2_tol, grad_tol:
+            Accepted relative errors of chi2 and of the gradient of the log-likelihood
+        max_steps:
+            Maximum number of solver steps of the selected settings
+        n_repeats:
+            Number of repeated evaluations per setting, the fastest is used
+    Returns:
+        dict with "rtol", "atol", "linear_solver" and "max_steps"
+    """
+    if parameters is None:
+        parameters = tuning_sample(model)
+    parameters = np.atleast_2d(np.asarray(parameters, dtype=float))
+    key = {"timepoints": list(edata.getTimepoints()), "parameter_ids": list(model.getParameterIds()),
+           "parameters": parameters.tolist(), "chi2_tol": chi2_tol, "grad_tol": grad_tol, "max_steps": max_steps,
+           "sensitivity_method": int(solver.getSensitivityMethod())}
+    cache_file = os.path.join(cache_dir, SOLVER_SETTINGS_CACHE) if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return cached["settings"]
+
+    solver = solver.clone()
+    default = current_solver_settings(solver)
+
+    def evaluate(settings):
+        apply_solver_settings(solver, settings)
+        times = []
+        for _ in range(n_repeats):
+            tic = time.perf_counter()
+            res = evaluate_batch(model, solver, edata, parameters, sensitivities=True)
+            times.append(time.perf_counter()-tic)
+        return res, min(times)/len(parameters)
+
+    reference, _ = evaluate(REFERENCE_SETTINGS)
+    valid = reference["status"] == amici.AMICI_SUCCESS
+    if not np.any(valid):
+        print("Warning, the reference simulations failed for all parameter vectors. The solver settings are not tuned.")
+        return default
+
+    candidates = []
+    def check(settings):
+        """Evaluates settings, and returns True if they meet the accuracy budget."""
+        res, t = evaluate(settings)
+        if np.any(res["status"][valid] != amici.AMICI_SUCCESS):
+            errors = {"chi2": np.inf, "gradient": np.inf}
+        else:
+            chi2_error = np.abs(res["chi2"]-reference["chi2"])/np.maximum(np.abs(reference["chi2"]), 1)
+            grad_error = (np.linalg.norm(res["sllh"]-reference["sllh"], axis=1)
+                          / np.maximum(np.linalg.norm(reference["sllh"], axis=1), 1e-12))
+            errors = {"chi2": float(np.max(chi2_error[valid])), "gradient": float(np.max(grad_error[valid]))}
+        accurate = errors["chi2"] <= chi2_tol and errors["gradient"] <= grad_tol
+        candidates.append({"settings": settings, "time": t, "errors": errors, "accurate": accurate})
+        return accurate
+
+    check(default)
+    for linear_solver in LINEAR_SOLVERS:
+        # the loosest tolerances (largest rtol, then largest atol) that meet the budget
+        found = False
+        for rtol in RTOLS:
+            for atol in ATOLS:
+                found = check({"rtol": rtol, "atol": atol, "linear_solver": linear_solver, "max_steps": max_steps})
+                if found:
+                    break
+            if found:
+                break
+
+    accurate = [c for c in candidates if c["accurate"]]
+    if accurate:
+        selected = min(accurate, key=lambda c: c["time"])
+    else:
+        print("Warning, no solver settings meet the accuracy budget. Using the reference settings.")
+        selected = {"settings": REFERENCE_SETTINGS, "time": evaluate(REFERENCE_SETTINGS)[1]}
+    settings = selected["settings"]
+    print(f"Selected solver settings {settings}, time per evaluation: {selected['time']*1e3:.3g} ms "
+          f"(current settings: {candidates[0]['time']*1e3:.3g} ms, relative errors {candidates[0]['errors']})")
+
+    if cache_file:
+        with open(cache_file, 'w') as f:
+            json.dump({"key": key, "settings": settings, "candidates": candidates}, f, indent=4)
+    return settings
@@ -0,0 +1,128 @@
+""" Global parameter search with differential evolution, evaluating each generation as one batch of AMICI simulations.
+
+The search runs in log10 space between the bounds of the pypesto problem. Each generation of the population is
+simulated with evaluation.evaluate_batch (AMICI's multithreaded runAmiciSimulations), so there is one call to AMICI per
+generation instead of one per parameter vector. Simulations that fail (e.g. for extreme parameter values) are not
+exceptions, but valid results with an infinite cost, and are counted. The best (distinct) parameter vectors found can
+then be polished with a local optimizer, such as Fides.
+"""
+import amici
+import numpy as np
+import pypesto
+from scipy.optimize import differential_evolution as scipy_differential_evolution
+
+from evaluation import evaluate_batch
+
+class BatchCost:
+    """This class evaluates chi2 for a population of parameter vectors (in log10 space) as one batch, for scipy's vectorized differential_evolution.
+
+    All evaluated parameter vectors and their costs are kept, so that the best ones can be polished afterwards.
+    Failed simulations get the cost failed_cost (infinite by default).
+
+    Args:
+        model, solver, edata:
+            The AMICI objects to simulate. The model is cloned, with log10 parameters (the solver is cloned by evaluate_batch).
+        num_threads, batch_size:
+            as in evaluation.evaluate_batch
+        failed_cost:
+            The cost of parameter vectors where the simulation failed
+    """
+
+    def __init__(self, model, solver, edata, num_threads=1, batch_size=1000, failed_cost=np.inf):
+        self.model = model.clone()
+        self.model.setParameterScale(amici.ParameterScaling_log10)
+        self.solver = solver
+        self.edata = edata
+        self.num_threads = num_threads
+        self.batch_size = batch_size
+        self.failed_cost = failed_cost
+        self.x = []
+        self.cost = []
+        self.n_failed = 0
+
+    def __call__(self, x):
+        population = np.atleast_2d(np.asarray(x, dtype=float).T) # scipy passes the population as (n_par, S)
+        res = evaluate_batch(self.model, self.solver, self.edata, population, self.num_threads, self.batch_size)
+        failed = (res["status"] != amici.AMICI_SUCCESS) | ~np.isfinite(res["chi2"])
+        cost = np.where(failed, self.failed_cost, res["chi2"])
+        self.n_failed += int(np.sum(failed))
+        self.x.append(population)
+        self.cost.append(cost)
+        return cost
+
+    @property
+    def n_evaluations(self):
+        return sum(len(cost) for cost in self.cost)
+
+    def best(self, n, min_distance=0.1):
+        """Returns the n best evaluated parameter vectors (log10) that are at least min_distance apart (Euclidean distance in log10 space).
+
+        If fewer than n parameter vectors are that far apart, the remaining ones are the best of the others. Parameter
+        vectors where the simulation failed are never returned.
+        """
+        x = np.concatenate(self.x)
+        cost = np.concatenate(self.cost)
+        ranked = [i for i in np.argsort(cost, kind="stable") if np.isfinite(cost[i])]
+        selected = []
+        for i in ranked:
+            if len(selected) == n:
+                break
+            if all(np.linalg.norm(x[i] - x[j]) >= min_distance for j in selected):
+                selected.append(i)
+        selected += [i for i in ranked if i not in selected][:n - len(selected)]
+        return x[selected], cost[selected]
+
+def differential_evolution(problem, model, solver, edata, optimizer=None, n_polish=3, popsize=15, maxiter=1000, tol=0.01,
+                           strategy='best1bin', seed=None, num_threads=1, batch_size=1000, disp=False):
+    """This function searches the parameters globally with differential evolution in log10 space, and optionally polishes the best parameter vectors with a local optimizer.
+
+    scipy.optimize.differential_evolution is used with a vectorized cost function (BatchCost), so that each generation
+    is simulated as one batch with AMICI. Simulations that fail are given an infinite cost.
+
+    Examples:
+        Search globally, and polish the 3 best distinct parameter vectors with Fides
+            result = differential_evolution(problem, model, solver, edata, optimize.FidesOptimizer(), seed=0)
+            x = result.optimize_result.list[0].x
+        Use a larger population and a more exploring strategy, simulated on 8 threads
+            result = differential_evolution(problem, model, solver, edata, popsize=30, strategy='rand1bin', num_threads=8)
+
+    Args:
+        problem:
+            The pypesto problem (see calibration.create_problem). Its bounds (which must be positive) are the search
+            space, and it is used to compute the objective values and for polishing.
+        model, solver, edata:
+            The AMICI objects used for the batch simulations
+        optimizer:
+            Optional pypesto optimizer used to polish the best parameter vectors, e.g. optimize.FidesOptimizer()
+        n_polish:
+            Number of distinct best parameter vectors that are polished
+        popsize, maxiter, tol, strategy, seed, disp:
+            passed to scipy.optimize.differential_evolution (the population has popsize*n_par members)
+        num_threads, batch_size:
+            as in evaluation.evaluate_batch
+    Returns:
+        pypesto.Result, with the best parameter vector of the differential evolution (id "differential_evolution")
+        and the polished parameter vectors (ids "polish_<i>") in result.optimize_result
+    """
+    lb, ub = np.ravel(problem.lb), np.ravel(problem.ub)
+    if np.any(lb <= 0):
+        raise ValueError("The bounds must be positive for a search in log10 space.")
+    bounds = list(zip(np.log10(lb), np.log10(ub)))
+    cost = BatchCost(model, solver, edata, num_threads, batch_size)
+    de = scipy_differential_evolution(cost, bounds, popsize=popsize, maxiter=maxiter, tol=tol, strategy=strategy, seed=seed, disp=disp,
+                                      polish=False, vectorized=True, updating='deferred')
+    print(f"Differential evolution: chi2 {de.fun} after {de.nit} generations, "
+          f"{cost.n_failed} of {cost.n_evaluations} simulations failed")
+
+    result = pypesto.Result(problem)
+    x = 10**de.x
+    result.optimize_result.append(pypesto.OptimizerResult(
+        id="differential_evolution", x=x, fval=float(problem.objective(x)), n_fval=cost.n_evaluations,
+        exitflag=int(de.success), message=f"{de.message} ({cost.n_failed} failed simulations)"), sort=False)
+
+    if optimizer is not None:
+        opts = pypesto.optimize.OptimizeOptions(allow_failed_starts=True)
+        for i, x0 in enumerate(cost.best(n_polish)[0]):
+            result.optimize_result.append(optimizer.minimize(problem, 10**x0, f"polish_{i}", optimize_options=opts), sort=False)
+    result.optimize_result.sort()
+    return result
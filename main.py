@@ -5,16 +5,21 @@ import amici.plotting
 import numpy as np
 import json
 import matplotlib.pyplot as plt
-from scipy.optimize import dual_annealing as dh
 import pypesto
 import pypesto.optimize as optimize
 import pypesto.visualize as visualize
 sys.path.append('.')# for odes2py
 from odes2py import odes2py
+from model_cache import compile_model, model_id
+from calibration import load_data, set_parameters, setup_model, create_problem, parallel_minimize, problem_chi2, screened_startpoints
+from work_queue import distributed_minimize
+from evaluation import rdata_chi2, simulate
+from global_optimization import differential_evolution
+from early_stopping import adaptive_minimize
 
 # %% Supress stderr
 from contextlib import contextmanager, redirect_stderr
-from os import devnull
+from os import cpu_count, devnull
 
 @contextmanager
 def silent_errors(): # Note: might no longer work
@@ -42,80 +47,70 @@ fileName = "M1.txt"
 imported_model = odes2py("M1.txt", 'M1.xml','sbml-yaml')
 model_name = imported_model["name"]
 observables = imported_model["observables"]
-x0 = [p[1] for p in imported_model["parameters"]]
+parameter_names = [p[0] for p in imported_model["parameters"]]
 
 
-# %% Import the sbml file and convert/compile to AMICI
+# %% Parameters that are fixed during the optimization, as name: value
+# They are compiled as constant parameters in AMICI, so sensitivities (and the pypesto problem) only cover the free parameters.
+fixed_parameters = {} # e.g. {"k4": 1e-5}, k4 is at the lower bound in the known optimum
+
+
+# %% Import the sbml file and convert/compile to AMICI (or reuse a cached build if the model is unchanged)
+# The C++ files are compiled in parallel, and only files that changed since a previous build are recompiled
 observables_tuple=observables.copy()
 observables = {} 
 for name, formula in observables_tuple:
     observables[name]={'name': '', 'formula': formula}
 print(f"Observables: {observables}")
-sbml_importer = amici.SbmlImporter(model_name+".xml")
-sbml_importer.sbml2amici(model_name, model_name+"_amici", observables=observables, verbose=0)
+model_module = compile_model(model_name+".xml", model_name, observables, constant_parameters=list(fixed_parameters))
 
 
 # %% Import the AMICI model
-model_module = amici.import_model_module(model_name, model_name+"_amici")
 model = model_module.getModel() 
+set_parameters(model, fixed_parameters)
 
 
 # %% Define the experimental data
-with open("data.json",'r') as f:
-    data = json.load(f)
-
-edata = amici.ExpData(1,0,0,data["time"]) #specifies the size of the experimental data
-edata.setObservedData(data["mean"])
-edata.setObservedDataStdDev(data["SEM"])
+data, edata = load_data("data.json")
 
 
 #%% Simulate using the default parameters (should be bad). 
 solver = model.getSolver()
 model.setTimepoints(np.linspace(0, 2, 201)) 
-rdata = amici.runAmiciSimulation(model, solver, edata)
-print(f"Cost using the initial guess: {rdata['chi2']} (should be ~701)")
+rdata = simulate(model, solver, edata, full=plot) # only the likelihood is reported, unless the trajectories are plotted
+print(f"Cost using the initial guess: {rdata_chi2(rdata, edata)} (should be ~701)")
 if plot:
   plot_agreement(data, rdata, model)
 
 
 # %% Simulate with a set of known "optimal" parameters
 with open("M1(13.316).json", "r") as f: 
-    x_opt = json.load(f)
+    x_opt = dict(zip(parameter_names, json.load(f)))
 
-model.setParameters(x_opt)
-rdata = amici.runAmiciSimulation(model, solver, edata)
-print(f"Cost using optimal parameters: {rdata['chi2']} (should be around ~13.3)")
+set_parameters(model, x_opt)
+rdata = simulate(model, solver, edata, full=plot)
+print(f"Cost using optimal parameters: {rdata_chi2(rdata, edata)} (should be around ~13.3)")
 if plot:
   plot_agreement(data, rdata, model)
 
 
 # %% Setup the model for optimization
-model = model_module.getModel()
-model.setTimepoints(data["time"])
+model, solver = setup_model(model_module, data, edata, fixed_parameters=fixed_parameters) # selects forward or adjoint sensitivities, whichever is fastest, and tunes the solver tolerances for it
 x0 = np.array(model.getParameters())
-solver = model.getSolver()
 
-model.requireSensitivitiesForAllParameters()
-solver.setSensitivityMethod(amici.SensitivityMethod_adjoint)
-solver.setSensitivityOrder(amici.SensitivityOrder_first)
-
-rdata = amici.runAmiciSimulation(model, solver, edata)
-assert(np.floor(rdata["chi2"])==701, "The original cost does not correspond to the known cost of the initial parameter set")
+rdata = simulate(model, solver, edata)
+if not fixed_parameters:
+    assert np.floor(rdata_chi2(rdata, edata))==701, "The original cost does not correspond to the known cost of the initial parameter set"
 
 
 #%% Optimization settings
-objective = pypesto.AmiciObjective(model, solver, [edata])
 options = {"disp": True}
 optimizer = optimize.ScipyOptimizer(options=options)
 # optimizer = optimize.PyswarmOptimizer()
 # optimizer = optimize.IpoptOptimizer()
 optimizer = optimize.FidesOptimizer()
 
-lb = np.tile(1e-6, (1, len(model.getParameters())))
-ub = np.tile(1e7, (1, len(model.getParameters())))
-scales = ['log10']*5
-problem = pypesto.Problem(objective=objective,
-                        lb=lb, ub=ub, x_guesses=[x0], x_scales=scales)
+problem = create_problem(model, solver, edata, lb=1e-6, ub=1e7, x_guesses=[x0], cache_size=10000, cache_file="objective_cache.h5", model_id=model_id(model_module)) # evaluations are cached, also between runs
 
 
 # %% Optimize one time using the defined optimizer
@@ -127,16 +122,37 @@ with silent_errors():
 # %% Print the single run optimization results
 print(result)
 x = result["x"]
-model.setParameters(x)
-rdata = amici.runAmiciSimulation(model, solver, edata)
-print(f"optimized cost: {rdata['chi2']} (optima ~13.3)")
+print(f"optimized cost: {problem_chi2(problem, x)} (optima ~13.3)") # with the objective cache, the optimum is already evaluated and is looked up
 if plot:
+  model.setParameters(x)
+  rdata = simulate(model, solver, edata, full=True)
   plot_agreement(data, rdata, model)
 
 
 # %% Multistart optimization, no start guess
+n_procs = None # number of worker processes for the multistart, None uses all cores, 1 runs the starts in this process
+# Each finished start is written to starts.jsonl (follow the progress with 'python result_store.py starts.jsonl'). 
+# With resume (off by default), a stopped run continues from the finished starts in starts.jsonl, with the same start points. A store for another model, data or settings is moved to starts.jsonl.old and a new run is started. 
+# To spread the starts over several nodes, set queue_dir to a directory on a shared file system, and start workers on the other nodes with 'python work_queue.py worker <queue_dir>'. 
+# With early_stopping (off by default), no more starts are launched once the best optimum has been found a few times and a better optimum is unlikely, and starts heading to a worse optimum are stopped. 
+# With prescreen (off by default), 4096 Sobol points in log10 space are evaluated (chi2 only), and the optimizations start from the best diverse ones instead of uniformly drawn points. 
+queue_dir = None
+resume = False
+early_stopping = False
+prescreen = False
+if prescreen:
+    n_starts = 50
+    startpoints = screened_startpoints(problem, model, solver, edata, n_starts, n_samples=4096, seed=0, num_threads=n_procs or cpu_count())
+else:
+    n_starts = 300 # 200
+    startpoints = None
 with silent_errors():
-    result = optimize.minimize(problem,optimizer=optimizer,n_starts=300) # 200
+    if queue_dir:
+        result = distributed_minimize(problem, optimizer, n_starts, model_module, "data.json", broker=queue_dir, startpoints=startpoints, seed=0, n_local_workers=n_procs or 1, store="starts.jsonl", resume=resume)
+    elif early_stopping:
+        result = adaptive_minimize(problem, optimizer, n_starts, model_module, "data.json", n_procs=n_procs, startpoints=startpoints, seed=0, store="starts.jsonl", resume=resume) # at most n_starts starts
+    else:
+        result = parallel_minimize(problem, optimizer, n_starts, model_module, "data.json", n_procs=n_procs, startpoints=startpoints, seed=0, store="starts.jsonl", resume=resume)
 print(result.optimize_result.as_dataframe())
 if plot:
     visualize.waterfall(result)
@@ -146,36 +162,21 @@ if plot:
 # %%  Print the results of the multistart optimization  
 x = result.optimize_result.as_dataframe()["x"].values[0]
 
-model.setParameters(x)
-rdata = amici.runAmiciSimulation(model, solver, edata)
-print(f"optimized cost: {rdata['chi2']} (optima ~13.3)")
+print(f"optimized cost: {problem_chi2(problem, x)} (optima ~13.3)")
 if plot:
+    model.setParameters(x)
+    rdata = simulate(model, solver, edata, full=True)
     plot_agreement(data, rdata, model)
-
-
-# %% Optimize using a custom cost function and scipys dual anealing algorithm (unused)
-# def cost(param, model, solver, edata):
-#   try:
-#     model.setParameters(param)
-#     rdata = amici.runAmiciSimulation(model, solver, edata)
-#     cost = rdata["chi2"]
-#   except: 
-#     cost=1e90
-#   return cost
-
-# iter=0
-# def callback(x,f,c):
-#     global iter
-#     if iter%50==0:
-#         print("Iter: {0:4d}, obj:{1:3.6f}".format(iter, f))
-#     iter+=1
-
-# bounds = np.array([[1.0e-5, 1.0e5]]*5)
-
-# iter=0
-# res = dh(func = cost,bounds = bounds ,args=(model,solver, edata), x0 = x0, callback = callback)
-
-# print(f"Cost from the opimization: {res.fun}")
-# model.setParameters(res.x)
-# rdata = amici.runAmiciSimulation(model, solver, edata)
-# print(f"Cost from the simulation of the optimized parameters: {rdata['chi2']} (should be the same)")
+print(f"Objective cache: {problem.objective.stats}")
+problem.objective.save()
+
+
+# %% Optional global search with differential evolution in log10 space. Each generation is simulated as one batch (on num_threads threads, if AMICI is compiled with OpenMP),
+# failed simulations are given an infinite cost, and the 3 best distinct parameter sets are polished with Fides.
+global_search = False # set to True to also run the global search after the multistart
+if global_search:
+    with silent_errors():
+        result_de = differential_evolution(problem, model, solver, edata, optimizer, n_polish=3, seed=0, num_threads=n_procs or cpu_count())
+    print(result_de.optimize_result.as_dataframe(["id", "fval", "n_fval", "message"]))
+    x = result_de.optimize_result.list[0].x
+    print(f"Cost from the global search: {problem_chi2(problem, x)} (optima ~13.3, differential evolution can also end in the local optimum ~17.2)")
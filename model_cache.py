@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows, the builds are not locked
+    fcntl = None
+
+import amici
+
+from object_cache import compiler_environment, evict_objects, read_log
+
+CACHE_DIR = "amici_models"
+COMPLETE_MARKER = ".complete"
+LOCK_FILE = ".lock"
+
+_builds_in_use = {} # build directory: open lock file, held until this process exits
+
+def model_hash(sbml_file, observables, from_file=True, **kwargs):
+    """This function computes the cache key of a compiled AMICI model.
+
+    The key covers everything that changes the generated code: the SBML file content, the observables, any further
+    arguments to sbml2amici and the installed AMICI version.
+
+    Args:
+        sbml_file:
+            path to the SBML file (including file extension), or the SBML itself if from_file is False
+        observables:
+            dict of observables, as passed to sbml2amici
+        from_file:
+            Set to False if sbml_file is an SBML string (e.g. from odes2py.sbml_string)
+        kwargs:
+            any additional arguments that are passed to sbml2amici
+    Returns:
+        hex digest (str) identifying the compiled model
+    """
+    h = hashlib.sha256()
+    if from_file:
+        with open(sbml_file, 'rb') as f:
+            h.update(f.read())
+    else:
+        h.update(sbml_file.encode())
+    h.update(json.dumps(observables, sort_keys=True).encode())
+    h.update(json.dumps(kwargs, sort_keys=True, default=str).encode())
+    h.update(amici.__version__.encode())
+    return h.hexdigest()
+
+def model_dir(model_name, key, cache_dir=CACHE_DIR):
+    """Returns the build directory of a model with a given cache key."""
+    return os.path.join(cache_dir, f"{model_name}_{key[:16]}")
+
+def module_location(model_module):
+    """Returns the directory from which model_module can be imported with amici.import_model_module (the build directory)."""
+    return os.path.dirname(os.path.dirname(os.path.abspath(model_module.__file__)))
+
+def model_id(model_module):
+    """Returns the name of the build directory of a compiled model (<model name>_<hash>), which identifies the compiled code (see model_hash)."""
+    return os.path.basename(module_location(model_module))
+
+def cached_builds(model_name, cache_dir=CACHE_DIR):
+    """Returns the build directories of model_name in cache_dir, sorted with the most recently used first."""
+    if not os.path.isdir(cache_dir):
+        return []
+    prefix = model_name + "_"
+    builds = [os.path.join(cache_dir, d) for d in os.listdir(cache_dir)
+              if d.startswith(prefix) and len(d) == len(prefix)+16]
+    builds = [d for d in builds if os.path.isdir(d)]
+    return sorted(builds, key=os.path.getmtime, reverse=True)
+
+def use_build(build_dir):
+    """This function marks a complete build as used by this process, until the process exits.
+
+    A shared lock is taken on the build, so that evict_stale (in any process) does not remove it while this process
+    (or its worker processes) may import it. Locking requires fcntl, and is skipped on systems without it.
+
+    Args:
+        build_dir:
+            the build directory of a model
+    Returns:
+        True, or False if there is no complete build in build_dir (e.g. if it was just removed by evict_stale)
+    """
+    build_dir = os.path.abspath(build_dir)
+    if build_dir in _builds_in_use:
+        return True
+    try:
+        f = open(os.path.join(build_dir, LOCK_FILE), 'a')
+    except FileNotFoundError:
+        return False
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_SH)
+    if not os.path.exists(os.path.join(build_dir, COMPLETE_MARKER)):
+        f.close()
+        return False
+    _builds_in_use[build_dir] = f
+    os.utime(build_dir) # mark as recently used
+    return True
+
+def evict_stale(model_name, cache_dir=CACHE_DIR, keep=2):
+    """This function removes old build directories of a model from the cache.
+
+    Builds that are in use by a process (see use_build) are not removed.
+
+    Args:
+        model_name:
+            name of the model
+        cache_dir:
+            directory holding the cached builds
+        keep:
+            number of most recently used builds to keep
+    """
+    for build_dir in cached_builds(model_name, cache_dir)[keep:]:
+        if os.path.abspath(build_dir) in _builds_in_use:
+            continue
+        try:
+            f = open(os.path.join(build_dir, LOCK_FILE), 'a')
+        except FileNotFoundError: # removed by another process
+            continue
+        with f:
+            if fcntl:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError: # in use
+                    continue
+            trash = f"{build_dir}.{uuid.uuid4().hex}.old"
+            try:
+                os.rename(build_dir, trash) # the build disappears at once, processes that use it next build it again
+            except FileNotFoundError:
+                continue
+        shutil.rmtree(trash, ignore_errors=True)
+
+@contextmanager
+def _environment(variables):
+    old = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in old.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def compile_model(sbml_file, model_name, observables, cache_dir=CACHE_DIR, keep=2, verbose=0, from_file=True, n_jobs=None, object_cache=True, **kwargs):
+    """This function compiles an SBML model with AMICI, reusing a previous build if nothing has changed.
+
+    Builds are stored in cache_dir/<model_name>_<hash>, where the hash is computed by model_hash. On a cache hit the
+    model module is imported directly, skipping code generation and compilation.
+
+    Otherwise, the generated C++ files are compiled in parallel, and object files of generated files that are unchanged
+    since a previous build (of any model) are taken from the object cache in cache_dir/objects (see object_cache.py).
+    After changing a single rate law, only the functions that depend on it are compiled again.
+
+    Examples:
+        Compile 'M1.xml' (or load it from the cache)
+            model_module = compile_model('M1.xml', 'M1', observables)
+        Compile 'M1.xml' with k4 as a fixed (constant) parameter, excluded from the parameters and sensitivities
+            model_module = compile_model('M1.xml', 'M1', observables, constant_parameters=['k4'])
+        Compile a converted model without writing the SBML to a file
+            model_module = compile_model(odes2py.sbml_string(model), 'M1', observables, from_file=False)
+
+    Args:
+        sbml_file:
+            path to the SBML file (including file extension), or the SBML itself if from_file is False
+        model_name:
+            name of the model, used as the name of the generated python module
+        observables:
+            dict of observables, as passed to sbml2amici
+        cache_dir:
+            directory holding the cached builds
+        keep:
+            number of builds of the model to keep in the cache, older builds are removed
+        verbose:
+            verbosity passed to sbml2amici
+        from_file:
+            Set to False if sbml_file is an SBML string
+        n_jobs:
+            number of C++ files compiled in parallel, defaults to the number of cores
+        object_cache:
+            Set to False to compile all files, without the object cache
+        kwargs:
+            any additional arguments to sbml2amici, e.g. constant_parameters (list of parameter ids that are fixed)
+    Returns:
+        the imported model module
+    """
+    key = model_hash(sbml_file, observables, from_file, **kwargs)
+    build_dir = model_dir(model_name, key, cache_dir)
+
+    if use_build(build_dir):
+        print(f"Using cached AMICI model in {build_dir}")
+    else:
+        if os.path.exists(build_dir) and not os.path.exists(os.path.join(build_dir, COMPLETE_MARKER)):
+            shutil.rmtree(build_dir, ignore_errors=True) # left over from an interrupted build (of an older version of this function)
+        # The model is built in a directory of its own and renamed to build_dir when it is complete, so that processes
+        # compiling the same model at the same time do not overwrite each other's files
+        tmp_dir = f"{build_dir}.{uuid.uuid4().hex}.tmp"
+        try:
+            sbml_importer = amici.SbmlImporter(sbml_file, from_file=from_file)
+            read_log(cache_dir) # clears the log of an interrupted build
+            with _environment(compiler_environment(cache_dir, n_jobs, object_cache=object_cache)):
+                sbml_importer.sbml2amici(model_name, tmp_dir, observables=observables, verbose=verbose, **kwargs)
+            open(os.path.join(tmp_dir, COMPLETE_MARKER), 'w').close()
+            try:
+                os.rename(tmp_dir, build_dir)
+            except OSError: # another process finished the same build first, use that one
+                pass
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        hits, misses = read_log(cache_dir)
+        if hits + misses:
+            print(f"Compiled {misses} of {hits + misses} C++ files, the others are unchanged and were taken from the object cache")
+        evict_objects(cache_dir)
+        if not use_build(build_dir):
+            raise RuntimeError(f"The build of {model_name} in {build_dir} was removed before it could be used")
+
+    evict_stale(model_name, cache_dir, keep)
+    return amici.import_model_module(model_name, os.path.abspath(build_dir))
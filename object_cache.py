@@ -0,0 +1,181 @@
+""" A cache of compiled object files for the C++ code generated by AMICI, so that only changed files are recompiled.
+
+AMICI writes each model function (xdot, dwdx, Jy, ...) to its own .cpp file. When a rate law is changed, most of
+these files are unchanged, but the model is built in a new directory and every file is compiled again. This module
+is a compiler launcher (like ccache): the build calls "python object_cache.py <cache_dir> <compiler> <arguments>" instead of the
+compiler. For each compiled file, the key is a hash of the preprocessed source (i.e. including the content of all
+headers) and the compiler flags that change the generated code (include paths and output paths are not part of the
+key, as their effect is covered by the preprocessed source). If an object file with the same key is in the cache, it
+is copied instead of compiling the file. Linking and other calls are passed on to the compiler unchanged.
+
+compiler_environment returns the environment variables that make the AMICI build (CMake based or setuptools based,
+depending on the AMICI version) use the launcher, and compile the files in parallel.
+
+Use cases:
+    python object_cache.py <cache_dir> <compiler> <arguments>     (called by the build)
+"""
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+OBJECT_DIR = "objects"
+LOG_FILE = "object_cache.log"
+
+# Arguments that are followed by a path that does not change the compiled code
+_PATH_ARGS = {"-o", "-MF", "-MT", "-MQ", "-I", "-isystem", "-iquote", "-idirafter"}
+_PATH_PREFIXES = ("-I", "-MF", "-MT", "-MQ", "-D", "-U", "-isystem", "-iquote")
+_DEPENDENCY_ARGS = {"-MD", "-MMD", "-MP", "-c"}
+
+def _split_arguments(args):
+    """Returns the source file, the object file and the arguments that are part of the key, or None if args is not a compilation of a single file."""
+    if "-c" not in args or "-o" not in args:
+        return None
+    sources = [a for a in args if not a.startswith("-") and os.path.splitext(a)[1] in (".c", ".cc", ".cpp", ".cxx")]
+    if len(sources) != 1:
+        return None
+    obj = args[args.index("-o") + 1]
+    key_args = []
+    skip = False
+    for a in args:
+        if skip:
+            skip = False
+        elif a in _PATH_ARGS or a in ("-D", "-U"):
+            skip = True
+        elif a.startswith(_PATH_PREFIXES) or a in _DEPENDENCY_ARGS or a == sources[0]:
+            continue
+        else:
+            key_args.append(a)
+    return sources[0], obj, key_args
+
+def _compiler_id(compiler):
+    """Identifies the compiler by its path, size and modification time."""
+    path = shutil.which(compiler) or compiler
+    stat = os.stat(path)
+    return f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime}"
+
+def object_key(compiler, args):
+    """This function computes the cache key of a compilation.
+
+    The file is preprocessed with the same arguments (which also writes the dependency file, if the build asks for
+    one), and the key is the hash of the preprocessed source, the compiler and the flags that change the generated code.
+
+    Args:
+        compiler:
+            The compiler executable
+        args:
+            The arguments of the compiler
+    Returns:
+        hex digest (str), or None if the call is not a compilation of a single file
+    """
+    split = _split_arguments(args)
+    if split is None:
+        return None
+    source, obj, key_args = split
+    preprocessed = obj + ".i"
+    pre_args = [a for a in args if a != "-c"]
+    pre_args[pre_args.index("-o") + 1] = preprocessed
+    subprocess.run([compiler, "-E", "-P"] + pre_args, check=True)
+    h = hashlib.sha256()
+    h.update(_compiler_id(compiler).encode())
+    h.update("\0".join(key_args).encode())
+    with open(preprocessed, 'rb') as f:
+        h.update(f.read())
+    os.remove(preprocessed)
+    return h.hexdigest()
+
+def compile_cached(cache_dir, compiler, args):
+    """This function compiles a file, or copies the object file from the cache if the same code has been compiled before.
+
+    Args:
+        cache_dir:
+            directory with the cached object files (in cache_dir/objects)
+        compiler, args:
+            The compiler executable and its arguments, as passed by the build
+    Returns:
+        the exit code of the compiler
+    """
+    key = object_key(compiler, args)
+    if key is None:
+        return subprocess.run([compiler] + args).returncode
+    obj = args[args.index("-o") + 1]
+    cached = os.path.join(cache_dir, OBJECT_DIR, key[:2], key + ".o")
+    if os.path.exists(cached):
+        shutil.copyfile(cached, obj)
+        os.utime(cached) # mark as recently used
+        _log(cache_dir, "hit", obj)
+        return 0
+    returncode = subprocess.run([compiler] + args).returncode
+    if returncode == 0:
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmp = f"{cached}.{os.getpid()}.tmp"
+        shutil.copyfile(obj, tmp)
+        os.replace(tmp, cached) # atomic, other processes see either no file or the complete object file
+        _log(cache_dir, "miss", obj)
+    return returncode
+
+def _log(cache_dir, status, obj):
+    with open(os.path.join(cache_dir, LOG_FILE), 'a') as f:
+        f.write(f"{status} {obj}\n")
+
+def read_log(cache_dir):
+    """Returns the number of object files taken from the cache (hits) and compiled (misses) since the log was last cleared, and clears it."""
+    filename = os.path.join(cache_dir, LOG_FILE)
+    if not os.path.exists(filename):
+        return 0, 0
+    with open(filename, 'r') as f:
+        status = [line.split(" ", 1)[0] for line in f]
+    os.remove(filename)
+    return status.count("hit"), status.count("miss")
+
+def evict_objects(cache_dir, max_size_mb=1000):
+    """This function removes the least recently used object files when the object cache is larger than max_size_mb."""
+    objects = []
+    for root, _, files in os.walk(os.path.join(cache_dir, OBJECT_DIR)):
+        objects += [os.path.join(root, name) for name in files if name.endswith(".o")]
+    objects.sort(key=os.path.getmtime, reverse=True)
+    size = 0
+    for obj in objects:
+        size += os.path.getsize(obj)
+        if size > max_size_mb*1e6:
+            os.remove(obj)
+
+def _cmake_build():
+    """Returns True if the installed AMICI builds models with CMake (otherwise with setuptools)."""
+    import amici # not needed by the launcher itself, which is started for every compiled file
+    template = os.path.join(os.path.dirname(amici.__file__), "setup.template.py")
+    with open(template, 'r') as f:
+        return "CMakeExtension" in f.read()
+
+def compiler_environment(cache_dir, n_jobs=None, object_cache=True):
+    """This function returns the environment variables that make AMICI compile a model in parallel, using the object cache.
+
+    Args:
+        cache_dir:
+            directory of the object cache
+        n_jobs:
+            number of files compiled in parallel, defaults to the number of cores
+        object_cache:
+            Set to False to only compile in parallel
+    Returns:
+        dict of environment variables, to be set while sbml2amici builds the model
+    """
+    env = {"AMICI_PARALLEL_COMPILE": str(n_jobs or os.cpu_count())}
+    if not object_cache:
+        return env
+    launcher = [sys.executable, os.path.abspath(__file__), os.path.abspath(cache_dir)]
+    if _cmake_build():
+        for lang in ["C", "CXX"]:
+            env[f"CMAKE_{lang}_COMPILER_LAUNCHER"] = ";".join(launcher)
+    else:
+        import sysconfig
+        cc = os.environ.get("CC", sysconfig.get_config_var("CC") or "gcc")
+        cxx = os.environ.get("CXX", sysconfig.get_config_var("CXX") or "g++")
+        env["CC"] = shlex.join(launcher) + " " + cc # the compiler may already be a command with arguments, e.g. "gcc -pthread"
+        env["CXX"] = shlex.join(launcher) + " " + cxx
+    return env
+
+if __name__ == '__main__':
+    sys.exit(compile_cached(sys.argv[1], sys.argv[2], sys.argv[3:]))
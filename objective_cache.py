@@ -0,0 +1,201 @@
+import copy
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+from pypesto.C import FVAL, GRAD, HESS, MODE_FUN, RDATAS
+from pypesto.objective import ObjectiveBase
+
+from evaluation import chi2_offset, current_solver_settings, rdata_chi2
+
+CACHE_FILE = "objective_cache.h5"
+CHI2 = "chi2"
+_ORDERS = {0: FVAL, 1: GRAD, 2: HESS}
+
+class CachedObjective(ObjectiveBase):
+    """This class caches the evaluations of an objective (typically a pypesto.AmiciObjective).
+
+    The cache is keyed on the parameter vector, rounded to a number of significant digits, and stores the objective
+    value, the gradient, the Hessian (if computed) and chi2 of each evaluated parameter vector. A repeated evaluation of
+    a parameter vector, e.g. by the optimizer or when the cost of the optimum is printed, is then looked up instead of
+    simulated. The least recently used entries are evicted when the cache holds max_size entries.
+
+    The cache can optionally be stored to disk with h5py (see save), and is then loaded again when a CachedObjective
+    is created with the same file, model, data and solver settings (see fingerprint). A stored cache that does not
+    match is not used, and is overwritten by the next save.
+
+    Examples:
+        Cache the objective of a problem, and print the hit rate after the optimization
+            objective = CachedObjective(pypesto.AmiciObjective(model, solver, [edata]), max_size=10000)
+            problem = pypesto.Problem(objective=objective, lb=lb, ub=ub)
+            ...
+            print(objective.stats)
+        Keep the cache between runs
+            objective = CachedObjective(amici_objective, filename="objective_cache.h5", model_id=model_id(model_module))
+            ...
+            objective.save()
+
+    Args:
+        objective:
+            The objective to cache
+        max_size:
+            Maximum number of cached parameter vectors
+        digits:
+            Number of significant digits of the parameters used in the key. Parameter vectors that are equal to
+            this precision share an entry.
+        filename:
+            Optional path to an HDF5 file with a stored cache. Requires h5py.
+        model_id:
+            Identifies the compiled model, e.g. model_cache.model_id(model_module). It is part of the fingerprint of a
+            stored cache, so that the cache is not reused after the equations of the model have been changed.
+    """
+
+    def __init__(self, objective, max_size=10000, digits=12, filename=None, model_id=None):
+        super().__init__(x_names=objective.x_names)
+        self.objective = objective
+        self.max_size = max_size
+        self.digits = digits
+        self.filename = filename
+        self.model_id = model_id
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if filename and os.path.exists(filename):
+            self.load(filename)
+
+    def __deepcopy__(self, memodict=None):
+        other = CachedObjective(copy.deepcopy(self.objective, memodict), self.max_size, self.digits, model_id=self.model_id)
+        other.filename = self.filename
+        other.entries = OrderedDict((key, dict(entry)) for key, entry in self.entries.items())
+        return other
+
+    def initialize(self):
+        self.objective.initialize()
+
+    def check_mode(self, mode):
+        return self.objective.check_mode(mode)
+
+    def check_sensi_orders(self, sensi_orders, mode):
+        return self.objective.check_sensi_orders(sensi_orders, mode)
+
+    def key(self, x):
+        """Returns the cache key of the parameter vector x."""
+        return np.array([float(f"{v:.{self.digits}g}") for v in np.asarray(x, dtype=float)]).tobytes()
+
+    def call_unprocessed(self, x, sensi_orders, mode, **kwargs):
+        if mode != MODE_FUN or any(order not in _ORDERS for order in sensi_orders):
+            return self.objective.call_unprocessed(x, sensi_orders, mode, **kwargs)
+
+        key = self.key(x)
+        entry = self.entries.get(key)
+        if entry is not None and all(_ORDERS[order] in entry for order in sensi_orders):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return {_ORDERS[order]: entry[_ORDERS[order]] for order in sensi_orders}
+
+        self.misses += 1
+        result = self.objective.call_unprocessed(x, sensi_orders, mode, **kwargs)
+        self.store(key, result, sensi_orders)
+        return result
+
+    def store(self, key, result, sensi_orders):
+        """Adds the result of an evaluation to the cache, evicting the least recently used entry if the cache is full."""
+        entry = self.entries.pop(key, {})
+        for order in sensi_orders:
+            value = result.get(_ORDERS[order])
+            if value is not None:
+                entry[_ORDERS[order]] = float(value) if order == 0 else np.copy(value)
+        edatas = getattr(self.objective, "edatas", None)
+        if result.get(RDATAS) and edatas:
+            entry[CHI2] = sum(rdata_chi2(rdata, edata) for rdata, edata in zip(result[RDATAS], edatas))
+        elif FVAL in entry and edatas:
+            entry[CHI2] = 2*entry[FVAL] - sum(chi2_offset(edata) for edata in edatas) # the objective value is -log-likelihood
+        self.entries[key] = entry
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def chi2(self, x):
+        """Returns chi2 of the parameter vector x, from the cache if possible.
+
+        chi2 is stored with each cached objective value, so a simulation is only needed for parameter vectors that are
+        not in the cache (the result is then added to the cache).
+        """
+        key = self.key(x)
+        entry = self.entries.get(key, {})
+        if CHI2 in entry:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[CHI2]
+        self.misses += 1
+        result = self.objective(np.asarray(x, dtype=float), sensi_orders=(0,), return_dict=True)
+        self.store(key, result, (0,))
+        if CHI2 not in self.entries[key]:
+            raise ValueError("chi2 cannot be computed, the objective has no AMICI data (edatas)")
+        return self.entries[key][CHI2]
+
+    @property
+    def stats(self):
+        """Statistics of the cache: hits, misses, hit rate, evictions and the number of cached parameter vectors."""
+        calls = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits/calls if calls else 0.0,
+                "evictions": self.evictions, "size": len(self.entries)}
+
+    def fingerprint(self):
+        """Returns a hash identifying the compiled model, the data and the solver settings of the objective, used to validate a stored cache."""
+        h = hashlib.sha256()
+        h.update(repr(self.model_id).encode())
+        model = getattr(self.objective, "amici_model", None)
+        if model is not None:
+            h.update(repr((model.getName(), model.getParameterIds(), model.getFixedParameters(),
+                           list(model.getParameterScale()))).encode())
+        solver = getattr(self.objective, "amici_solver", None)
+        if solver is not None:
+            h.update(repr((sorted(current_solver_settings(solver).items()), int(solver.getSensitivityMethod()))).encode())
+        for edata in getattr(self.objective, "edatas", []):
+            h.update(np.asarray(edata.getTimepoints()).tobytes())
+            h.update(np.asarray(edata.getObservedData()).tobytes())
+            h.update(np.asarray(edata.getObservedDataStdDev()).tobytes())
+        return h.hexdigest()
+
+    def save(self, filename=None):
+        """This function stores the cache in an HDF5 file (requires h5py).
+
+        Args:
+            filename:
+                path to the HDF5 file. Defaults to the file given when the cache was created, or CACHE_FILE.
+        """
+        import h5py
+        filename = filename or self.filename or CACHE_FILE
+        keys = list(self.entries)
+        dim = len(np.frombuffer(keys[0])) if keys else 0
+        fields = {name: np.full((len(keys),) + shape, np.nan) for name, shape in
+                  [(FVAL, ()), (GRAD, (dim,)), (HESS, (dim, dim)), (CHI2, ())]}
+        for i, key in enumerate(keys):
+            for name, value in self.entries[key].items():
+                fields[name][i] = value
+        with h5py.File(filename, 'w') as f:
+            f.attrs["fingerprint"] = self.fingerprint()
+            f.attrs["digits"] = self.digits
+            f.create_dataset("x", data=np.array([np.frombuffer(key) for key in keys]).reshape(len(keys), dim))
+            for name, values in fields.items():
+                if not np.all(np.isnan(values)):
+                    f.create_dataset(name, data=values, compression="gzip" if values.ndim > 1 else None)
+
+    def load(self, filename):
+        """This function loads a cache stored with save. The cache is ignored if it was stored for another model, other data, other solver settings or another rounding."""
+        import h5py
+        with h5py.File(filename, 'r') as f:
+            if f.attrs.get("fingerprint") != self.fingerprint() or f.attrs.get("digits") != self.digits:
+                print(f"Warning, the objective cache in {filename} is for another model, other data or other solver settings. It is not used, and is overwritten when the cache is saved.")
+                return
+            xs = f["x"][()]
+            fields = {name: f[name][()] for name in [FVAL, GRAD, HESS, CHI2] if name in f}
+        for i, x in enumerate(xs[-self.max_size:], start=max(0, len(xs)-self.max_size)):
+            entry = {}
+            for name, values in fields.items():
+                if not np.all(np.isnan(values[i])):
+                    entry[name] = values[i] if values[i].ndim else float(values[i])
+            self.entries[x.tobytes()] = entry
@@ -1,9 +1,27 @@
 # Code written by William Lövfors.
 
 from logging import error
+import importlib.util
+import io
 import sys
 import re
 
+# Precompiled patterns used by import_odes
+_FILE_NAME = re.compile(r'([\w,-]+)\.')
+_SECTION = re.compile(r'model (name|states|parameters|variables|reactions|event)', re.IGNORECASE)
+_SECTIONS = {'name': 'name', 'states': 'states', 'parameters': 'parameters', 'variables': 'variables', 'reactions': 'reactions', 'event': 'events'}
+_ODE = re.compile(r'.*?d/dt\((\w+)\)\s*=\s*(.+)', re.IGNORECASE)
+_IC = re.compile(r'.*?(\w+)\(0\)\s*=\s*(.+)')
+_ASSIGNMENT = re.compile(r'(\w+)\s*=\s*(.+)')
+_EVENT = re.compile(r"(\w+)\s*=\s*(\w+)\s*\((\w+)\s*,\s*([\w\.]+)\s*\)\s*,\s*(\w+)\s*,\s*([\w\.]+)\s*%*")
+_TOKEN = re.compile(r'(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)|([A-Za-z_]\w*)') # numbers or names
+_EVENT_SIGNS = {'eq': '==', 'lt': '<', 'gt': '>', 'le': '<=', 'ge': '>='}
+
+def _write_output(filename, buffer):
+    """Writes the contents of an in-memory buffer to filename with a single write."""
+    with open(filename, 'w') as f:
+        f.write(buffer.getvalue())
+
 def import_odes(filename, do_print=False):
     """This function imports a model from the [IQM tools / SB toolbox] format. 
 
@@ -23,76 +41,88 @@ def import_odes(filename, do_print=False):
          A dict containing the fields ["name", "states", "parameters", "variables", "observables", "reactions", events"]
     """
 
-    modelName=re.search('([\w,-]+)\.',filename).group(1)
-    states={}
+    modelName=_FILE_NAME.search(filename).group(1)
+    state_index={} # state name -> position in the arrays below
+    state_names=[]
+    state_rhs=[]
+    state_ics=[]
     params=[]
     variables=[]
     reactions=[]
     events=[]
     observables=[]
+    intern=sys.intern
+    inputType='none'
     with open(filename) as f:
         for line in f:
-            if len(line.strip())>1 and not line.strip()[0]=='%':
-                line=line.rstrip()
-                if line[0] == '*': #can most likely be updated to work with our python toolbox format as well
-                    # switch list
-                    if re.search('model name', line, re.IGNORECASE):
-                        inputType='name'
-                    elif re.search('model states', line, re.IGNORECASE):
-                        inputType='states'
-                    elif re.search('model parameters', line, re.IGNORECASE):
-                        inputType='parameters'
-                    elif re.search('model variables', line, re.IGNORECASE):
-                        inputType='variables'
-                    elif re.search('model reactions', line, re.IGNORECASE):
-                        inputType='reactions'
-                    elif re.search('model event', line, re.IGNORECASE):
-                        inputType='events'
-                    else:
-                        inputType='none'
+            stripped=line.strip()
+            if len(stripped)<=1 or stripped[0]=='%':
+                continue
+            if stripped[0] == '*': #can most likely be updated to work with our python toolbox format as well
+                match=_SECTION.search(stripped)
+                inputType=_SECTIONS[match.group(1).lower()] if match else 'none'
+                continue
+            if inputType=='none':
+                continue
+            line, *comment=stripped.split('%')
+            if comment: print('Warning: comments are not yet implemented. Removing comment.') #TODO: implement comments
+            if inputType=='name':
+                modelName=line.strip()
+                continue
+            if inputType=='events':
+                match=_EVENT.search(line)
+                sign=_EVENT_SIGNS.get(match.group(2))
+                if sign is None:
+                    print('Unknown event format: '+line)
+                events.append((intern(match.group(1)), match.group(3), sign, match.group(4), match.group(5), match.group(6)))
+                continue
+
+            # Tokenize as "lhs = rhs". Lines that do not have the simple forms "name = ...", "d/dt(name) = ..." or "name(0) = ..." are parsed with the slower regular expressions. 
+            lhs, _, rhs=line.partition('=')
+            lhs=lhs.strip()
+            rhs=rhs.strip()
+            if inputType=='states':
+                if lhs[:5].lower()=='d/dt(' and lhs[-1:]==')' and lhs[5:-1].isidentifier():
+                    name, value=lhs[5:-1], rhs
+                elif lhs[-3:]=='(0)' and lhs[:-3].isidentifier():
+                    state_ics[state_index[lhs[:-3]]]=float(rhs)
+                    continue
+                else:
+                    match=_ODE.match(line)
+                    if not match:
+                        match=_IC.match(line)
+                        if match:
+                            state_ics[state_index[match.group(1)]]=float(match.group(2))
+                        continue
+                    name, value=match.group(1), match.group(2).strip()
+                name=intern(name)
+                if name in state_index:
+                    state_rhs[state_index[name]]=value
+                else:
+                    state_index[name]=len(state_names)
+                    state_names.append(name)
+                    state_rhs.append(value)
+                    state_ics.append(None)
+            else:
+                if lhs.isidentifier() and rhs:
+                    name, value=intern(lhs), rhs
                 else:
-                    line=line.split('%')
-                    if len(line)>1: comment = line[1], print('Warning: comments are not yet implemented. Removing comment.') #TODO: implement comments
-                    line=line[0].strip()
-                    if inputType=='name':
-                        modelName=line
-                    elif inputType=='states':
-                        if re.search('d/dt\(',line,re.IGNORECASE):
-                            match=re.search('d/dt\((\w+)\)\s*=\s*(.+)%*',line,re.IGNORECASE)
-                            states[match.group(1)]=(match.group(2),)
-                        elif re.search('(\w+)\(0\)',line,re.IGNORECASE):
-                            match=re.search('(\w+)\(0\)\s*=\s*(.+)%*',line,re.IGNORECASE)
-                            states[match.group(1)]+=(float(match.group(2)),)
-                    elif inputType=='parameters':
-                        match=re.search('(\w+)\s*=\s*(.+)%*',line,re.IGNORECASE)
-                        params.append((match.group(1), float(match.group(2))))
-                    elif inputType=='variables':
-                        match=re.search('(\w+)\s*=\s*(.+)%*',line,re.IGNORECASE)
-                        if line.startswith("y_"):
-                            observables.append((match.group(1), match.group(2)))
-                        else:
-                            variables.append((match.group(1), match.group(2)))
-                    elif inputType=='reactions':
-                        match=re.search('(\w+)\s*=\s*(.+)%*',line,re.IGNORECASE)
-                        reactions.append((match.group(1), match.group(2)))               
-                    elif inputType=='events':
-                        match=re.search("(\w+)\s*=\s*(\w+)\s*\((\w+)\s*,\s*([\w\.]+)\s*\)\s*,\s*(\w+)\s*,\s*([\w\.]+)\s*%*", line)
-                        if match.group(2)=='eq':
-                            sign='=='
-                        elif match.group(2)=='lt':
-                            sign='<'
-                        elif match.group(2)=='gt':
-                            sign='>'
-                        elif match.group(2)=='le':
-                            sign='<='
-                        elif match.group(2)=='ge':
-                            sign='>='
-                        else:
-                            print('Unknown event format: '+line)
-                        events.append((match.group(1), match.group(3), sign, match.group(4), match.group(5), match.group(6)))
-
-
-    states=[(k,*v) for k,v in states.items()]
+                    match=_ASSIGNMENT.search(line)
+                    name, value=intern(match.group(1)), match.group(2).strip()
+                if inputType=='parameters':
+                    params.append((name, float(value)))
+                elif inputType=='variables':
+                    if name.startswith("y_"):
+                        observables.append((name, value))
+                    else:
+                        variables.append((name, value))
+                elif inputType=='reactions':
+                    reactions.append((name, value))
+
+    for name, ic in zip(state_names, state_ics):
+        if ic is None:
+            print(f"Warning, the state {name} has no initial value. Assuming it to be 0")
+    states=[(name, rhs, ic if ic is not None else 0.0) for name, rhs, ic in zip(state_names, state_rhs, state_ics)]
     if events: 
         print("Warning, events are not fully supported. E.g. only one thing can be changed per event")
 
@@ -126,28 +156,259 @@ def import_odes(filename, do_print=False):
     if observables: model["observables"]=observables
     if reactions: model["reactions"]=reactions
     if events: model["events"]=events
-    f.close()
     return model
 
-def export_as_scipy(model, filename = None):
+def sympify_model(model):
+    """This function parses the equations of a model into SymPy expressions. 
+
+    Reactions and variables are substituted into the ODEs, so that the right hand sides only depend on the states, the parameters and t. 
+
+    Examples:
+        Derive the Jacobian of a model
+            sym = sympify_model(model)
+            jac = sparse_jacobian(sym["rhs"], sym["states"])
+
+    Args: 
+        model: 
+            An model (typically imported) to be parsed
+    Returns: 
+        A dict containing the fields ["t", "states", "parameters", "rhs", "observables"], where "states" and "parameters" are lists of symbols, "rhs" is a list with one expression per state, and "observables" is a list of (name, expression) pairs.
+    """
+    import sympy
+    from sympy.parsing.sympy_parser import parse_expr
+
+    names = ["t"] + [s[0] for s in model["states"]] + [p[0] for p in model["parameters"]]
+    for key in ["variables", "observables", "reactions"]:
+        names += [name for name, _ in model.get(key, [])]
+    symbols = {name: sympy.Symbol(name) for name in names} # Avoids names such as S, E and I being parsed as SymPy objects
+
+    def parse(expr):
+        return parse_expr(str(expr).replace('^','**'), local_dict=symbols)
+
+    definitions = {}
+    for key in ["variables", "reactions"]:
+        for name, value in model.get(key, []):
+            definitions[symbols[name]] = parse(value)
+
+    # Resolve variables and reactions that depend on other variables and reactions
+    for _ in range(len(definitions)+1):
+        if not any(expr.free_symbols & definitions.keys() for expr in definitions.values()):
+            break
+        definitions = {name: expr.xreplace(definitions) for name, expr in definitions.items()}
+    else:
+        error("The variables and reactions of the model contain circular definitions")
+
+    sym=dict()
+    sym["t"] = symbols["t"]
+    sym["states"] = [symbols[s[0]] for s in model["states"]]
+    sym["parameters"] = [symbols[p[0]] for p in model["parameters"]]
+    sym["rhs"] = [parse(s[1]).xreplace(definitions) for s in model["states"]]
+    sym["observables"] = [(name, parse(value).xreplace(definitions)) for name, value in model.get("observables", [])]
+    return sym
+
+def sparse_jacobian(exprs, variables):
+    """Returns the non-zero elements of the Jacobian of exprs with respect to variables, as a dict {(row, col): expression}. 
+
+    Only the variables that appear in each expression are differentiated, so the cost scales with the number of non-zero elements rather than with the size of the full Jacobian. 
+    """
+    index = {var: i for i, var in enumerate(variables)}
+    jac = {}
+    for row, expr in enumerate(exprs):
+        for var in sorted(expr.free_symbols & index.keys(), key=index.get):
+            value = expr.diff(var)
+            if value != 0:
+                jac[(row, index[var])] = value
+    return jac
+
+def reduce_model(model, constants_as_parameters=False, do_print=False):
+    """This function removes redundant states from a model, using conservation laws and states with a zero derivative. 
+
+    The right hand sides are expanded (with reactions and variables substituted) into a sum of fluxes, each with a numeric coefficient, which gives the stoichiometry of the states. A state with no fluxes (e.g. d/dt(S) = 0) is constant, and is replaced by its initial value. A linear combination of states with no net flux (e.g. R+Rp) is a conservation law, and one state in each law is replaced by the total (given by the initial values) minus the other states. The states are grouped into independent blocks that share fluxes, so that the conservation laws can be found also for large models. 
+    The removed states are added as variables, so that they can still be used in the variables, reactions and observables. 
+
+    Examples:
+        Reduce a model before exporting it to SBML
+            model = reduce_model(import_odes('model.txt'))
+            export_as_SBML(model, 'model.xml')
+
+    Args: 
+        model: 
+            An model (typically imported) to be reduced. The model is not modified. 
+        constants_as_parameters: 
+            Set to True to add the values of the constant states and the conservation totals as parameters instead of as variables. Note that this changes the parameters of the model. 
+        do_print: 
+            Set to True to print the removed states. 
+    Returns: 
+        The reduced model (dict), with the same fields as the input model
+    """
+    import sympy
+
+    sym = sympify_model(model)
+    states = sym["states"]
+    ics = [sympy.Float(ic) for ic in _initial_values(model)]
+    names = {s[0] for s in model["states"]} | {p[0] for p in model["parameters"]}
+    for key in ["variables", "observables", "reactions"]:
+        names |= {name for name, _ in model.get(key, [])}
+
+    # Stoichiometry: the coefficient of each flux in the right hand side of each state
+    stoichiometry = []
+    for rhs in sym["rhs"]:
+        row = {}
+        for term in sympy.Add.make_args(sympy.expand(rhs)):
+            coeff, flux = term.as_coeff_Mul()
+            row[flux] = row.get(flux, 0) + sympy.nsimplify(coeff, rational=True)
+        stoichiometry.append({flux: coeff for flux, coeff in row.items() if coeff != 0})
+    constant = [i for i, row in enumerate(stoichiometry) if not row]
+
+    # Group the states that share fluxes into blocks (union-find)
+    parent = list(range(len(states)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    first = {}
+    for i, row in enumerate(stoichiometry):
+        for flux in row:
+            parent[find(i)] = find(first.setdefault(flux, i))
+    blocks = {}
+    for i, row in enumerate(stoichiometry):
+        if row:
+            blocks.setdefault(find(i), []).append(i)
+
+    # Find the conservation laws of each block. States with the largest initial values are eliminated first, to avoid cancellation errors for small states. 
+    laws = [] # (eliminated state, {state: coefficient})
+    for block in blocks.values():
+        if len(block) < 2:
+            continue
+        block = sorted(block, key=lambda i: abs(ics[i]), reverse=True)
+        fluxes = list({flux: None for i in block for flux in stoichiometry[i]})
+        N = sympy.Matrix([[stoichiometry[i].get(flux, 0) for flux in fluxes] for i in block])
+        basis = N.T.nullspace()
+        if not basis:
+            continue
+        reduced, pivots = sympy.Matrix.hstack(*basis).T.rref()
+        for row, pivot in enumerate(pivots):
+            laws.append((block[pivot], {block[j]: reduced[row, j] for j in range(len(block)) if reduced[row, j] != 0}))
+
+    def unique(name):
+        while name in names:
+            name += '_'
+        names.add(name)
+        return name
+    constants = [(model["states"][i][0], float(ics[i])) for i in constant]
+    assignments = []
+    for eliminated, law in laws:
+        name = model["states"][eliminated][0]
+        total = unique(name+"_total")
+        constants.append((total, float(sum(c*ics[i] for i, c in law.items()))))
+        others = sum(c*states[i] for i, c in law.items() if i != eliminated)
+        assignments.append((name, sympy.sstr(sympy.Symbol(total) - others).replace('**', '^')))
+
+    removed = set(constant) | {eliminated for eliminated, _ in laws}
+    reduced_model = dict(model)
+    reduced_model["states"] = [s for i, s in enumerate(model["states"]) if i not in removed]
+    if constants_as_parameters:
+        reduced_model["parameters"] = model["parameters"] + constants
+        constants = []
+    variables = [(name, str(value)) for name, value in constants] + assignments + model.get("variables", [])
+    if variables:
+        reduced_model["variables"] = variables
+
+    if do_print:
+        print(f"Removed {len(removed)} of {len(states)} states")
+        for i in constant:
+            print(f"  {model['states'][i][0]} is constant")
+        for name, value in assignments:
+            print(f"  {name} = {value}")
+    return reduced_model
+
+def optimize_expressions(exprs, prefix="_cse"):
+    """This function optimizes a list of SymPy expressions before they are written as code, by constant folding and common subexpression elimination (CSE). 
+
+    Literal arithmetic is folded by SymPy when the expressions are created (e.g. after the variables and reactions are substituted by sympify_model), and floats with integer values are replaced by integers so that factors such as 1.0 vanish. Subexpressions that occur more than once are then extracted into temporaries, so that they are only computed once. 
+
+    Examples:
+        Write the right hand side of a model with temporaries
+            sym = sympify_model(model)
+            temporaries, rhs = optimize_expressions(sym["rhs"])
+            _write_assignments(f, "  ", temporaries + [(f"out[{i}]", value) for i, value in enumerate(rhs)])
+
+    Args: 
+        exprs: 
+            list of SymPy expressions
+        prefix: 
+            prefix of the names of the temporaries
+    Returns: 
+        temporaries (list of (name, expression), in the order they must be computed) and the optimized expressions (list)
+    """
+    import sympy
+
+    def fold(expr):
+        return expr.xreplace({x: sympy.Integer(int(x)) for x in expr.atoms(sympy.Float) if float(x).is_integer()})
+    temporaries, reduced = sympy.cse([fold(expr) for expr in exprs], symbols=sympy.numbered_symbols(prefix), order='none')
+    return [(name.name, value) for name, value in temporaries], reduced
+
+def _initial_values(model):
+    """Returns the initial values of the states of a model. States without an initial value (e.g. in models that are not imported from a file) start at 0. """
+    return [s[2] if len(s) > 2 and s[2] is not None else 0.0 for s in model["states"]]
+
+def _write_assignments(f, indent, assignments):
+    """Writes a list of (target, expression) as python code, with the given indentation. """
+    from sympy.printing.pycode import pycode
+    for target, value in assignments:
+        f.write(f"{indent}{target} = {pycode(value)}\n")
+
+def export_as_scipy(model, filename = None, jacobian = True, batch = False, cse = True):
     """This function exports a model to the SciPy (odeint) format. 
 
+    If jacobian is True, an analytic Jacobian ('<name>_jac') derived with SymPy is also exported, together with a simulate() function that integrates the model with solve_ivp using the Jacobian. This is much faster for stiff models, since the implicit solvers otherwise approximate the Jacobian using finite differences. 
+
+    The Jacobian and cse (both on by default) require SymPy. If SymPy is not installed, a warning is printed, and the model is exported as with jacobian=False and cse=False. 
+
+    If batch is True, a batched right hand side ('<name>_batch(state, t, param, out)') is also exported. It takes states and parameters of shape (n_batch, n_states) and (n_batch, n_params), writes the derivatives into the preallocated array out of shape (n_batch, n_states), and runs in parallel over the batch using numba's prange. 
+
+    If cse is True, the variables and reactions are substituted into the ODEs, and the expressions are optimized with optimize_expressions (constant folding and common subexpression elimination) before they are written. Otherwise, the equations are written as in the model file. 
+
     Examples:
         Exporting a model to SciPy with file name 'model.py'
             export_as_scipy('model.txt', 'model.py')
+        Simulating the exported model (after importing it)
+            sol = model.simulate(t_eval, param, method='BDF')
+        Evaluating the batched right hand side of the exported model (after importing it)
+            model.model_batch(states, t, params, out)
 
     Args: 
         model: 
             An model (typically imported) to be converted
         filename:
             Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a .py extension.
+        jacobian: 
+            Set to True to also export the Jacobian and the simulate() function (requires SymPy). 
+        batch: 
+            Set to True to also export the batched right hand side. 
+        cse: 
+            Set to True to optimize the generated expressions (requires SymPy). 
     
     """
-    if filename:
-        f=open(filename, "w")
-    else:
-        f=open(model["name"]+'.py','w')
+    if not filename:
+        filename=model["name"]+'.py'
+    if (cse or jacobian) and importlib.util.find_spec("sympy") is None:
+        print("Warning, SymPy is not installed. Exporting without the Jacobian and without optimizing the expressions")
+        cse = jacobian = False
+    if cse or jacobian:
+        sym = sympify_model(model)
+    if cse:
+        temporaries, rhs = optimize_expressions(sym["rhs"])
+
+    f=io.StringIO()
+    f.write("import math\n")
     f.write("from math import exp as exp\n")
+    if jacobian:
+        f.write("import numpy as np\n")
+        f.write("from scipy.integrate import solve_ivp\n")
+    if batch:
+        f.write("from numba import njit, prange\n")
     f.write("from numba import jit\n\n")
     f.write("@jit\n")
     f.write("def {0}(state,t, param):\n".format(model["name"]))
@@ -161,29 +422,36 @@ def export_as_scipy(model, filename = None):
     for i,param in enumerate([p[0] for p in model["parameters"]]):
         f.write("  {0} = param[{1}]\n".format(param,i))
 
-    if any(key in model for key in ["variables", "observables", "reactions"]):
-        f.write("\n#Defining variables\n")
+    if cse:
+        if temporaries:
+            f.write("\n#Defining common subexpressions\n")
+            _write_assignments(f, "  ", temporaries)
+        f.write("\n#Defining ODEs\n")
+        _write_assignments(f, "  ", [(f"{state}_d", value) for state, value in zip(state_names, rhs)])
+    else:
+        if any(key in model for key in ["variables", "observables", "reactions"]):
+            f.write("\n#Defining variables\n")
+
+        if "variables" in model:
+            for var, val in model["variables"]:
+                f.write(f"  {var} = {val}".replace('^','**')+"\n")
 
-    if "variables" in model:
-        for var, val in model["variables"]:
-            f.write(f"      {var} = {val}".replace('^','**')+"\n")
+        if "observables" in model:
+            print("Observables are not yet implemented, writing it as a variable.")
+            for var, val in model["observables"]:
+                f.write(f"  {var} = {val}".replace('^','**')+"\n")
 
-    if "observables" in model:
-        print("Observables are not yet implemented, writing it as a variable.")
-        for var, val in model["observables"]:
-            f.write(f"      {var} = {val}".replace('^','**')+"\n")
+        if "reactions" in model:
+            f.write("\n#Defining reactions\n")
+            for reaction, val in model["reactions"]:
+                f.write(f"  {reaction} = {val}".replace('^','**')+"\n")
 
-    if "reactions" in model:
-        f.write("\n#Defining reactions\n")
-        for reaction, val in model["reactions"]:
-            f.write(f"      {reaction} = {val}".replace('^','**')+"\n")
+        f.write("\n#Defining ODEs\n")
+        for state, rhs, *_ in model["states"]:
+            f.write(f"  {state}_d = {rhs}".replace('^','**')+"\n")
 
     if "events" in model:
         print("Events are not yet implemented")
-     
-    f.write("\n#Defining ODEs\n")
-    for state, rhs,_ in model["states"]:
-        f.write(f"      {state}_d = {rhs}".replace('^','**')+"\n")
 
     f.write("\n#Return ODE values\n")
     f.write("  return[")
@@ -191,10 +459,297 @@ def export_as_scipy(model, filename = None):
 
     for state in state_names[1:]:
         f.write(f"    , {state}_d")
-    f.write("]")
-    f.close()
+    f.write("]\n")
+
+    if jacobian:
+        from sympy.printing.pycode import pycode
+        jac = sparse_jacobian(sym["rhs"], sym["states"])
+
+        f.write("\n@jit\n")
+        f.write("def {0}_jac(state,t, param):\n".format(model["name"]))
+        f.write("\n#Defining starting values\n")
+        for i,state in enumerate(state_names):
+            f.write("  {0} = state[{1}]\n".format(state,i))
+        f.write("\n#Defining parameter values\n")
+        for i,param in enumerate([p[0] for p in model["parameters"]]):
+            f.write("  {0} = param[{1}]\n".format(param,i))
+        if cse:
+            jac_temporaries, values = optimize_expressions(list(jac.values()))
+            jac = dict(zip(jac, values))
+            if jac_temporaries:
+                f.write("\n#Defining common subexpressions\n")
+                _write_assignments(f, "  ", jac_temporaries)
+        f.write("\n#Defining the non-zero elements of the Jacobian\n")
+        f.write(f"  jac = np.zeros(({len(state_names)}, {len(state_names)}))\n")
+        for (row, col), value in jac.items():
+            f.write(f"  jac[{row}, {col}] = {pycode(value)}\n")
+        f.write("  return jac\n")
+
+        f.write("\ninitial_values = [{0}]\n".format(", ".join(str(ic) for ic in _initial_values(model))))
+        f.write("parameter_values = [{0}]\n".format(", ".join(str(p[1]) for p in model["parameters"])))
+        f.write("\ndef simulate(t_eval, param=parameter_values, state0=initial_values, method='BDF', rtol=1e-6, atol=1e-8):\n")
+        f.write("  \"\"\"Simulates the model from t=0 with solve_ivp using the analytic Jacobian. method should be an implicit solver, e.g. 'BDF', 'LSODA' or 'Radau'.\"\"\"\n")
+        f.write("  param = np.asarray(param, dtype=np.float64)\n")
+        f.write("  state0 = np.asarray(state0, dtype=np.float64)\n")
+        f.write(f"  return solve_ivp(lambda t, state: {model['name']}(state, t, param), (0.0, t_eval[-1]), state0, method=method, t_eval=t_eval,\n")
+        f.write(f"                   jac=lambda t, state: {model['name']}_jac(state, t, param), rtol=rtol, atol=atol)\n")
+
+    if batch:
+        f.write("\n@njit(parallel=True)\n")
+        f.write("def {0}_batch(state,t, param, out):\n".format(model["name"]))
+        f.write("  for b in prange(state.shape[0]):\n")
+        f.write("\n#Defining starting values\n")
+        for i,state in enumerate(state_names):
+            f.write("    {0} = state[b, {1}]\n".format(state,i))
+        f.write("\n#Defining parameter values\n")
+        for i,param in enumerate([p[0] for p in model["parameters"]]):
+            f.write("    {0} = param[b, {1}]\n".format(param,i))
+        if cse:
+            if temporaries:
+                f.write("\n#Defining common subexpressions\n")
+                _write_assignments(f, "    ", temporaries)
+            f.write("\n#Writing ODE values\n")
+            _write_assignments(f, "    ", [(f"out[b, {i}]", value) for i, value in enumerate(rhs)])
+        else:
+            if "variables" in model:
+                f.write("\n#Defining variables\n")
+                for var, val in model["variables"]:
+                    f.write(f"    {var} = {val}".replace('^','**')+"\n")
+            if "reactions" in model:
+                f.write("\n#Defining reactions\n")
+                for reaction, val in model["reactions"]:
+                    f.write(f"    {reaction} = {val}".replace('^','**')+"\n")
+            f.write("\n#Writing ODE values\n")
+            for i, entry in enumerate(model["states"]): # (name, rhs) or (name, rhs, initial value)
+                f.write(f"    out[b, {i}] = {entry[1]}".replace('^','**')+"\n")
+        f.write("  return out\n")
+    _write_output(filename, f)
     print(f'Converted {model["name"]} to SciPy model')
 
+# Integrator used by export_as_scipy_ensemble, written as is to the generated module.
+# A Rosenbrock method of order 2(3) (the method of MATLAB's ode23s, Shampine & Reichelt 1997), which is L-stable and suitable for stiff models.
+ENSEMBLE_INTEGRATOR = '''
+@njit
+def _lu_factor(A, piv):
+  n = A.shape[0]
+  for k in range(n):
+    p = k
+    amax = abs(A[k, k])
+    for i in range(k+1, n):
+      if abs(A[i, k]) > amax:
+        amax = abs(A[i, k])
+        p = i
+    piv[k] = p
+    if amax == 0.0:
+      return False
+    if p != k:
+      for j in range(n):
+        tmp = A[k, j]
+        A[k, j] = A[p, j]
+        A[p, j] = tmp
+    for i in range(k+1, n):
+      A[i, k] /= A[k, k]
+      for j in range(k+1, n):
+        A[i, j] -= A[i, k]*A[k, j]
+  return True
+
+@njit
+def _lu_solve(LU, piv, b):
+  n = LU.shape[0]
+  for k in range(n):
+    p = piv[k]
+    if p != k:
+      tmp = b[k]
+      b[k] = b[p]
+      b[p] = tmp
+  for i in range(n):
+    for j in range(i):
+      b[i] -= LU[i, j]*b[j]
+  for i in range(n-1, -1, -1):
+    for j in range(i+1, n):
+      b[i] -= LU[i, j]*b[j]
+    b[i] /= LU[i, i]
+
+@njit
+def _integrate(t_eval, param, state0, out, rtol, atol, max_steps):
+  """Integrates the model from t=0 and writes the observables at t_eval to out. Returns 0 on success, 1 if max_steps was reached and 2 if the step size became too small."""
+  n = state0.shape[0]
+  d = 1.0/(2.0+math.sqrt(2.0))
+  e32 = 6.0+math.sqrt(2.0)
+  y = state0.copy()
+  y_new = np.empty(n)
+  tmp = np.empty(n)
+  F0 = np.empty(n)
+  F1 = np.empty(n)
+  F2 = np.empty(n)
+  k1 = np.empty(n)
+  k2 = np.empty(n)
+  k3 = np.empty(n)
+  T = np.empty(n)
+  J = np.empty((n, n))
+  W = np.empty((n, n))
+  piv = np.empty(n, dtype=np.int64)
+
+  t = 0.0
+  h = 1e-6*max(abs(t_eval[-1]), 1.0)
+  steps = 0
+  for i_out in range(t_eval.shape[0]):
+    t_next = t_eval[i_out]
+    while t < t_next:
+      if steps >= max_steps:
+        return 1
+      steps += 1
+      last = t + h >= t_next
+      h_step = t_next - t if last else h
+
+      rhs(y, t, param, F0)
+      jac(y, t, param, J)
+      dfdt(y, t, param, T)
+      hd = h_step*d
+      for i in range(n):
+        for j in range(n):
+          W[i, j] = -hd*J[i, j]
+        W[i, i] += 1.0
+      if not _lu_factor(W, piv):
+        h = 0.5*h_step
+        continue
+
+      for i in range(n):
+        k1[i] = F0[i] + hd*T[i]
+      _lu_solve(W, piv, k1)
+      for i in range(n):
+        tmp[i] = y[i] + 0.5*h_step*k1[i]
+      rhs(tmp, t+0.5*h_step, param, F1)
+      for i in range(n):
+        k2[i] = F1[i] - k1[i]
+      _lu_solve(W, piv, k2)
+      for i in range(n):
+        k2[i] += k1[i]
+        y_new[i] = y[i] + h_step*k2[i]
+      rhs(y_new, t+h_step, param, F2)
+      for i in range(n):
+        k3[i] = F2[i] - e32*(k2[i]-F1[i]) - 2.0*(k1[i]-F0[i]) + hd*T[i]
+      _lu_solve(W, piv, k3)
+
+      err = 0.0
+      for i in range(n):
+        scale = atol + rtol*max(abs(y[i]), abs(y_new[i]))
+        err = max(err, abs(h_step/6.0*(k1[i] - 2.0*k2[i] + k3[i]))/scale)
+
+      if not math.isfinite(err):
+        h = 0.1*h_step
+      elif err <= 1.0:
+        t = t_next if last else t + h_step
+        y[:] = y_new
+        h_new = h_step*min(5.0, 0.8*err**(-1.0/3.0)) if err > 0.0 else 5.0*h_step
+        if not last or h_new < h:
+          h = h_new
+      else:
+        h = h_step*max(0.2, 0.8*err**(-1.0/3.0))
+      if h < 1e-14*max(1.0, abs(t)):
+        return 2
+    observables(y, t, param, out[i_out])
+  return 0
+
+@njit(parallel=True)
+def _simulate_ensemble(t_eval, params, state0, rtol, atol, max_steps):
+  out = np.empty((params.shape[0], t_eval.shape[0], n_observables))
+  status = np.zeros(params.shape[0], dtype=np.int64)
+  for i in prange(params.shape[0]):
+    status[i] = _integrate(t_eval, params[i], state0, out[i], rtol, atol, max_steps)
+    if status[i] != 0:
+      out[i, :, :] = np.nan
+  return out, status
+
+def simulate_ensemble(t_eval, params=None, state0=None, rtol=1e-6, atol=1e-8, max_steps=100000):
+  """Simulates the model for all parameter sets in params (n_sets, n_params) in parallel.
+
+  Returns an array (n_sets, len(t_eval), n_observables) with the observables at t_eval, and the status (n_sets) of each simulation (0 means success). The observables of failed simulations are nan.
+  """
+  t_eval = np.ascontiguousarray(t_eval, dtype=np.float64)
+  params = np.ascontiguousarray(np.atleast_2d(parameter_values if params is None else params), dtype=np.float64)
+  state0 = np.ascontiguousarray(initial_values if state0 is None else state0, dtype=np.float64)
+  return _simulate_ensemble(t_eval, params, state0, rtol, atol, max_steps)
+'''
+
+def export_as_scipy_ensemble(model, filename=None, cse=True):
+    """This function exports a model to a self-contained numba module for simulating ensembles of parameter sets. 
+
+    The module contains a stiff integrator (a Rosenbrock method using the analytic Jacobian) and the function simulate_ensemble(t_eval, params), which simulates all parameter sets in parallel using numba's prange and returns the observables at t_eval as one contiguous array. If the model has no observables, the states are returned. Requires SymPy for deriving the Jacobian. 
+
+    Examples:
+        Exporting a model to an ensemble module with file name 'model_ensemble.py'
+            export_as_scipy_ensemble(model, 'model_ensemble.py')
+        Simulating 10000 parameter sets with the exported model (after importing it)
+            y, status = model_ensemble.simulate_ensemble(data["time"], params)
+
+    Args: 
+        model: 
+            An model (typically imported) to be converted
+        filename:
+            Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a _ensemble.py extension.
+        cse: 
+            Set to True to optimize the generated expressions with optimize_expressions (constant folding and common subexpression elimination). 
+    
+    """
+    sym = sympify_model(model)
+    jac = sparse_jacobian(sym["rhs"], sym["states"])
+    dfdt = [rhs.diff(sym["t"]) for rhs in sym["rhs"]]
+    observables = sym["observables"] if sym["observables"] else list(zip([s[0] for s in model["states"]], sym["states"]))
+
+    if not filename:
+        filename=model["name"]+'_ensemble.py'
+    f=io.StringIO()
+    f.write(f"# Ensemble simulation module for the model {model['name']}, generated by odes2py\n")
+    f.write("import math\n")
+    f.write("from math import exp as exp\n")
+    f.write("import numpy as np\n")
+    f.write("from numba import njit, prange\n\n")
+
+    f.write("state_names = [{0}]\n".format(", ".join(f"'{s[0]}'" for s in model["states"])))
+    f.write("parameter_names = [{0}]\n".format(", ".join(f"'{p[0]}'" for p in model["parameters"])))
+    f.write("observable_names = [{0}]\n".format(", ".join(f"'{name}'" for name, _ in observables)))
+    f.write("initial_values = np.array([{0}])\n".format(", ".join(str(ic) for ic in _initial_values(model))))
+    f.write("parameter_values = np.array([{0}])\n".format(", ".join(str(p[1]) for p in model["parameters"])))
+    f.write(f"n_observables = {len(observables)}\n")
+
+    def write_header(name):
+        f.write(f"\n@njit\ndef {name}(state, t, param, out):\n")
+        for i, (state, *_) in enumerate(model["states"]):
+            f.write(f"  {state} = state[{i}]\n")
+        for i, (param, _) in enumerate(model["parameters"]):
+            f.write(f"  {param} = param[{i}]\n")
+
+    def write_body(targets, exprs):
+        temporaries = []
+        if cse:
+            temporaries, exprs = optimize_expressions(exprs)
+        _write_assignments(f, "  ", temporaries + list(zip(targets, exprs)))
+
+    write_header("rhs")
+    if cse:
+        write_body([f"out[{i}]" for i in range(len(sym["rhs"]))], sym["rhs"])
+    else:
+        for key in ["variables", "reactions"]:
+            for name, value in model.get(key, []):
+                f.write(f"  {name} = {value}".replace('^','**')+"\n")
+        for i, entry in enumerate(model["states"]):
+            f.write(f"  out[{i}] = {entry[1]}".replace('^','**')+"\n")
+
+    write_header("jac")
+    f.write("  out[:, :] = 0.0\n")
+    write_body([f"out[{row}, {col}]" for row, col in jac], list(jac.values()))
+
+    write_header("dfdt")
+    write_body([f"out[{i}]" for i in range(len(dfdt))], dfdt)
+
+    write_header("observables")
+    write_body([f"out[{i}]" for i in range(len(observables))], [value for _, value in observables])
+
+    f.write(ENSEMBLE_INTEGRATOR)
+    _write_output(filename, f)
+    print(f'Converted {model["name"]} to a SciPy ensemble model')
+
 def export_as_yaml(model, filename=None):
     """This function exports a model to the yaml format. 
 
@@ -209,10 +764,9 @@ def export_as_yaml(model, filename=None):
             Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a .yaml extension.
     
     """
-    if filename:
-        f=open(filename, "w")
-    else:
-        f=open(model["name"]+'.yml','w')
+    if not filename:
+        filename=model["name"]+'.yml'
+    f=io.StringIO()
     f.write("time:  \n  variable: t\n\n") #not sure if t or time is the variable? 
 
     f.write("odes:  \n")
@@ -244,7 +798,7 @@ def export_as_yaml(model, filename=None):
             f.write(f"        - observableId: {obs} \n")
             f.write(f"          observableFormula: \"{val}\" \n")
             f.write(f"          noiseFormula: 0.0 \n\n")
-    f.close()
+    _write_output(filename, f)
     print(f'Converted {model["name"]} to a YAML model')
 
 def export_as_antimony(model, filename=None):
@@ -261,52 +815,77 @@ def export_as_antimony(model, filename=None):
             Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a .txt extension.
     
     """
-    if filename:
-        f=open(filename, "w")
-    else:
-        f=open(model["name"]+'.txt','w')
-
-    def reduce_equations(rhs, model):
-        if "reactions" in model:
-            reactions = dict(model["reactions"])
-            for key, value in reactions.items():
-                rhs = rhs.replace(key, value)
-        if "variables" in model:
-            variables = dict(model["variables"])
-            for key, value in variables.items():
-                rhs = rhs.replace(key, value)
-        return rhs.replace(" ", "")
+    if not filename:
+        filename=model["name"]+'.txt'
+    with open(filename, 'w') as f:
+        f.write(antimony_string(model))
+
+def _is_exponent_sign(eq, i):
+    """Returns True if the +/- at position i is the sign of an exponent, e.g. in '1e-5' (but not in 'k1e-5'). Only the number before the sign is scanned. """
+    if i < 2 or eq[i-1] not in "eE":
+        return False
+    j = i-1
+    while j > 0 and (eq[j-1].isdigit() or eq[j-1] == "."):
+        j -= 1
+    return j < i-1 and (j == 0 or not (eq[j-1].isalnum() or eq[j-1] in "_."))
+
+def _split_terms(eq):
+    """Splits an expression into its terms at the +/- signs outside of parentheses. Returns a list of (sign, term). """
+    terms = []
+    depth = 0
+    start = 0
+    sign = "+"
+    for i, c in enumerate(eq):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c in "+-" and depth == 0 and not _is_exponent_sign(eq, i):
+            if eq[start:i]:
+                terms.append((sign, eq[start:i]))
+            sign = c
+            start = i+1
+    if eq[start:]:
+        terms.append((sign, eq[start:]))
+    return terms
+
+def antimony_string(model):
+    """This function converts a model to the antimony format, and returns it as a string (see export_as_antimony). """
+    f=io.StringIO()
+
+    # Reactions and variables are inlined into the ODEs token by token, using a symbol table of their (recursively inlined) definitions
+    definitions = dict(model.get("variables", []))
+    definitions.update(model.get("reactions", []))
+    inlined = {}
+    def inline(name):
+        if name not in inlined:
+            inlined[name] = name # guards against circular definitions
+            inlined[name] = reduce_equations(definitions[name])
+        return inlined[name]
+
+    def reduce_equations(rhs):
+        return _TOKEN.sub(lambda m: parenthesize(inline(m.group(2))) if m.group(2) in definitions else m.group(0), rhs).replace(" ", "")
+
+    def parenthesize(expr):
+        return f"({expr})" if len(_split_terms(expr)) > 1 else expr
     
     outbound = []
     inbound = []
     for state,rhs,_ in model["states"]: 
-        eq = reduce_equations(rhs, model)
-        reactions =  re.split('(\+|\-)',eq)
-        direction = "+"
-        for reaction in reactions: 
-            if reaction[0] == "-":
-                direction = '-'
-            elif reaction[0] == "+":
-                direction = "+"
-            else:
-                if direction == "+":
-                    inbound.append((state, reaction))
-                elif direction =="-":
-                    outbound.append((state, reaction))
-
+        for direction, reaction in _split_terms(reduce_equations(rhs)):
+            if direction == "+":
+                inbound.append((state, reaction))
+            elif direction =="-":
+                outbound.append((state, reaction))
+
+    # Index the producing state of each flux expression, so that each consumed flux is paired with its producer in constant time
+    producers = {}
+    for state_in, eq_in in inbound:
+        producers.setdefault(eq_in, state_in)
     reactions=[]
     for state_out, eq_out in outbound:
-        found = False
-        for state_in, eq_in in inbound: 
-            if eq_out == eq_in:
-                reaction = (state_out, state_in, eq_out)
-                found=True
-                break
-        if found:
-            reactions.append(reaction)
-        else:
-            reactions.append((state_out, "", eq_out))
-    eqs_out = [o[1] for o in outbound]
+        reactions.append((state_out, producers.get(eq_out, ""), eq_out))
+    eqs_out = {o[1] for o in outbound}
     for state_in, eq_in in inbound:
         if eq_in not in eqs_out:
             reactions.append(("", state_in, eq_in))
@@ -318,7 +897,7 @@ def export_as_antimony(model, filename=None):
     f.write("\n")
     for name, _ ,value in model["states"]:
         f.write(f"    {name} = {value};\n")
-    f.close()
+    return f.getvalue()
 
 def export_as_medigit(model, filename=None):
     """This function exports a model to the MeDigiT format. 
@@ -336,10 +915,9 @@ def export_as_medigit(model, filename=None):
             Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a .txt extension.
     
     """
-    if filename:
-        f=open(filename, "w")
-    else:
-        f=open(model["name"]+'.txt','w')
+    if not filename:
+        filename=model["name"]+'.txt'
+    f=io.StringIO()
     f.write("########## NAME\n")
     f.write(f"    {model['name']}\n")
     f.write("########## METADATA\n")
@@ -387,7 +965,7 @@ def export_as_medigit(model, filename=None):
     if "observables" in model:
         for name, value in model["observables"]:
             f.write(f"    {name} = {value}\n")
-    f.close()
+    _write_output(filename, f)
     print(f'Converted {model["name"]} to a medigit model')
 
     #TODO: add optional time-step format
@@ -413,10 +991,9 @@ def export_as_LaTeX(model, filename=None):
             Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a .tex extension.
     
     """
-    if filename:
-        f=open(filename, "w")
-    else:
-        f=open(model["name"]+'.tex','w')
+    if not filename:
+        filename=model["name"]+'.tex'
+    f=io.StringIO()
 
     f.write("\\documentclass[12pt]{article}\n")
     f.write("\\usepackage[utf8]{inputenc}\n")
@@ -617,13 +1194,109 @@ def export_as_LaTeX(model, filename=None):
         f.write("\end{equation}\n")
 
     f.write("\end{document}")
-    f.close()
+    _write_output(filename, f)
     print(f'Converted {model["name"]} to LaTeX equations')
 
+def yaml_model(model):
+    """This function converts a model to a yaml2sbml YamlModel, in memory. The content is the same as written by export_as_yaml. """
+    import yaml2sbml
+    yaml_model = yaml2sbml.YamlModel()
+    yaml_model.set_time("t")
+    for state, eq, ic in model["states"]:
+        yaml_model.add_ode(state, eq, ic)
+    for param, val in model["parameters"]:
+        yaml_model.add_parameter(param, nominal_value=val)
+    for var, val in model.get("variables", []) + model.get("reactions", []):
+        yaml_model.add_assignment(var, val)
+    for obs, val in model.get("observables", []):
+        yaml_model.add_observable(obs, val, 0.0)
+    return yaml_model
+
+def sbml_string(model):
+    """This function converts a model to SBML using libsbml directly, and returns the SBML as a string. 
+
+    The SBML has the same structure as the SBML created by yaml2sbml (a single compartment, one species with a rate rule per state, and parameters with assignment rules for the variables and reactions), but no intermediate files are written. The string can be passed directly to AMICI, e.g. amici.SbmlImporter(sbml, from_file=False). 
+
+    Examples:
+        Compile a model in AMICI without writing the SBML to a file
+            sbml_importer = amici.SbmlImporter(sbml_string(model), from_file=False)
+
+    Args: 
+        model: 
+            An model (typically imported) to be converted
+    Returns: 
+        The SBML (str)
+    """
+    import libsbml
+
+    def math(formula, name):
+        ast = libsbml.parseL3Formula(str(formula))
+        if ast is None:
+            raise RuntimeError(f"Unable to parse the formula of {name}: {formula}")
+        return ast
+
+    def check(status, name):
+        if status != libsbml.LIBSBML_OPERATION_SUCCESS:
+            raise RuntimeError(f"Unable to create {name}. Invalid SBML identifier.")
+
+    document = libsbml.SBMLDocument(3, 1)
+    sbml = document.createModel()
+    sbml.setId(model["name"])
+    sbml.setName(model["name"])
+    compartment = sbml.createCompartment()
+    compartment.setId('Compartment')
+    compartment.setConstant(True)
+    compartment.setSize(1)
+
+    time = sbml.createParameter()
+    time.setId("t")
+    time.setName("t")
+    time.setConstant(False)
+    rule = sbml.createAssignmentRule()
+    rule.setVariable("t")
+    rule.setMath(libsbml.parseL3Formula('time'))
+
+    for state, rhs, ic in model["states"]:
+        species = sbml.createSpecies()
+        check(species.setId(state), state)
+        species.setInitialAmount(float(ic))
+        species.setConstant(False)
+        species.setBoundaryCondition(False)
+        species.setHasOnlySubstanceUnits(False)
+        species.setCompartment('Compartment')
+        rule = sbml.createRateRule()
+        rule.setId('d_dt_' + state)
+        rule.setVariable(state)
+        rule.setMath(math(rhs, state))
+
+    for name, value in model["parameters"]:
+        parameter = sbml.createParameter()
+        check(parameter.setId(name), name)
+        parameter.setName(name)
+        parameter.setConstant(True)
+        parameter.setValue(float(value))
+
+    for name, value in model.get("variables", []) + model.get("reactions", []):
+        parameter = sbml.createParameter()
+        check(parameter.setId(name), name)
+        parameter.setName(name)
+        parameter.setConstant(False)
+        rule = sbml.createAssignmentRule()
+        rule.setVariable(name)
+        rule.setMath(math(value, name))
+
+    document.setConsistencyChecks(libsbml.LIBSBML_CAT_UNITS_CONSISTENCY, False)
+    if document.checkConsistency():
+        for i in range(document.getErrorLog().getNumErrors()):
+            if not document.getErrorLog().getError(i).isWarning():
+                print("Warning, SBML consistency error: " + document.getErrorLog().getError(i).getMessage())
+    return libsbml.writeSBMLToString(document)
+
 def export_as_SBML(model, filename=None, route='yaml'): 
     """This function exports a model to SBML. 
 
-    For SBML conversions, the model must first be converted via either yaml2sbml or Tellurium (te); see type argument.
+    For SBML conversions, the model must first be converted via either yaml2sbml or Tellurium (te); see type argument. Alternatively, the SBML can be created directly with libsbml (see sbml_string). 
+    The intermediate yaml/antimony model is kept in memory, so no temporary files are written. 
     Assumes that all variables named y_* are observables. 
 
     Examples:
@@ -638,78 +1311,219 @@ def export_as_SBML(model, filename=None, route='yaml'):
         filename:
             Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a .xml extension.
         route: 
-            Desired route for the SBML conversion. Available options: {'yaml', 'te'}
+            Desired route for the SBML conversion. Available options: {'yaml', 'te', 'libsbml'}
     
     """
-    import os
     if not filename:
         filename = model["name"]+'.xml'
 
     if route=='yaml':
-        export_as_yaml(model, filename=model["name"]+"_temp.yml")
-        import yaml2sbml
-        yaml2sbml.validate_yaml(yaml_dir=model["name"]+"_temp.yml")
-        yaml2sbml.yaml2sbml(model["name"]+"_temp.yml", filename)  
-        if os.path.exists(model["name"]+"_temp.yml"): os.remove(model["name"]+"_temp.yml")
+        converted = yaml_model(model)
+        converted.validate_model()
+        converted.write_to_sbml(filename, overwrite=True)
 
     elif route=='te':
         from warnings import warn
         warn("Note that there exists a compatibility issue when exporting to SBML using Tellurium and later importing into amici. Both things cannot be done in the same overall function call. Please convert the model first, and then in a new call compile the model in AMICI. See this page for reference: https://github.com/AMICI-dev/AMICI/issues/1483")
-        export_as_antimony(model, filename=model["name"]+"_temp.txt")
         import tellurium as te
-        r = te.loada(model["name"] + '_temp.txt',)
+        r = te.loada(antimony_string(model))
         r.exportToSBML(filename)
-        if os.path.exists(model["name"]+"_temp.txt"): os.remove(model["name"]+"_temp.txt")
+
+    elif route=='libsbml':
+        with open(filename, 'w') as f:
+            f.write(sbml_string(model))
     else:
-        error("Unknown option for how to create the SBML file. Acceptable options are 'yaml' for yaml+yaml2sbml or 'te' for antimony+Tellurium")
+        error("Unknown option for how to create the SBML file. Acceptable options are 'yaml' for yaml+yaml2sbml, 'te' for antimony+Tellurium or 'libsbml'")
         
-def odes2py(in_filename, out_filename=None, type = 'mdt', do_print=False):
+# File extensions used for the default output file names when converting to several types at once
+_EXTENSIONS = {"scipy": ".py", "scipy-batch": ".py", "scipy-ensemble": ".py", "yaml": ".yml", "medigit": ".txt", "mdt": ".txt",
+               "antimony": ".txt", "te": ".txt", "sbml-yaml": ".xml", "sbml-te": ".xml", "sbml": ".xml", "latex": ".tex", "LaTeX": ".tex"}
+
+def export(model, out_filename=None, type='mdt'):
+    """This function exports an (imported) model to the given type. See odes2py for the available types."""
+    if type == "scipy":
+        export_as_scipy(model, out_filename)
+    elif type == "scipy-batch":
+        export_as_scipy(model, out_filename, batch=True)
+    elif type == "scipy-ensemble":
+        export_as_scipy_ensemble(model, out_filename)
+    elif type == "yaml":
+        export_as_yaml(model, out_filename)
+    elif type == "medigit":
+        export_as_medigit(model, out_filename)
+    elif type == "mdt":
+        export_as_medigit(model, out_filename)
+    elif type == "antimony" or type == "te" :
+        export_as_antimony(model, out_filename)
+    elif type == "sbml-yaml":
+        export_as_SBML(model, out_filename)
+    elif type == "sbml-te":
+        export_as_SBML(model, out_filename, route = 'te')
+    elif type == "sbml":
+        export_as_SBML(model, out_filename, route = 'libsbml')
+    elif type == "latex" or type == "LaTeX" :
+        export_as_LaTeX(model, out_filename)
+    else:
+        error(f"Unknown type '{type}'. Available options: {list(_EXTENSIONS)}")
+
+def odes2py(in_filename, out_filename=None, type = 'mdt', do_print=False, max_workers=None, reduce=False):
     """This function can convert an textfile with ODEs in the IQM/SBtoolbox format to another type.
 
     For SBML conversions, the model must first be converted via either yaml2sbml or Tellurium (te); see type argument.
     Assumes that all variables named y_* are observables. 
 
+    If a list of types is given, the model is only imported once, and the exporters are run concurrently in separate processes. 
+
     Examples:
         Converting a model in 'model.txt' to SBML with file name 'model.xml' using YAML: 
             odes2py('model.txt', 'model.xml', 'sbml-yaml')
         Converting a model in 'model.txt' to MeDigiT with default output file name:
             odes2py('model.txt', type = 'medigit')
+        Converting a model in 'model.txt' to several types at once, with default output file names ('<name>_scipy.py', '<name>_sbml_yaml.xml', ...):
+            odes2py('model.txt', type = ['scipy', 'sbml-yaml', 'latex'])
 
     Args: 
         in_filename: 
             path to the model to be converted (including file extension)
         out_filename:
-            Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a suitable extension.
+            Desired file name for the converted model (including file extension). If set to None then the name in the input file will be used, combined with a suitable extension. If type is a list, this should be None or a list with one file name per type (a single file name is accepted for a single type). 
         type: 
-            Desired type for the converted model. Available options: ['scipy', 'medigit' | 'mdt', 'sbml-yaml', 'sbml-te', 'yaml', 'antimony', 'LaTeX'|'latex']
+            Desired type, or list of types, for the converted model. Available options: ['scipy', 'scipy-batch', 'scipy-ensemble', 'medigit' | 'mdt', 'sbml-yaml', 'sbml-te', 'sbml', 'yaml', 'antimony', 'LaTeX'|'latex']
         do_print: 
             Set to True if you want the imported structure to be printed after importing. 
+        max_workers: 
+            Maximum number of processes used when converting to several types. Defaults to one process per type. 
+        reduce: 
+            Set to True to remove constant states and states given by conservation laws before exporting (see reduce_model). 
     Returns: 
         model (dict), containing the keys  ["name", "states", "parameters", "variables", "observables", "reactions", events"]
     
     """
 
     model = import_odes(in_filename, do_print)
+    if reduce:
+        model = reduce_model(model, do_print=do_print)
+
+    if isinstance(type, str):
+        export(model, out_filename, type)
+        return model
+    if isinstance(out_filename, str):
+        out_filename = [out_filename]
+    if out_filename and len(out_filename) != len(type):
+        raise ValueError(f"Got {len(out_filename)} output file names for {len(type)} types, give one file name per type (or None)")
+    if len(type) == 1:
+        export(model, out_filename[0] if out_filename else None, type[0])
+    elif type:
+        from concurrent.futures import ProcessPoolExecutor
+        if not out_filename:
+            out_filename = [model["name"]+"_"+t.replace('-','_')+_EXTENSIONS.get(t, '') for t in type]
+        with ProcessPoolExecutor(max_workers or len(type)) as pool:
+            futures = [pool.submit(export, model, filename, t) for filename, t in zip(out_filename, type)]
+            for future in futures:
+                future.result()
 
-    if type == "scipy":
-        export_as_scipy(model, out_filename)
-    elif type == "yaml":
-        export_as_yaml(model, out_filename)
-    elif type == "medigit":
-        export_as_medigit(model, out_filename)
-    elif type == "mdt":
-        export_as_medigit(model, out_filename)
-    elif type == "antimony" or type == "te" :
-        export_as_antimony(model, out_filename)
-    elif type == "sbml-yaml":
-        export_as_SBML(model, out_filename)
-    elif type == "sbml-te":
-        export_as_SBML(model, out_filename, route = 'te')
-    elif type == "latex" or type == "LaTeX" :
-        export_as_LaTeX(model, out_filename)
+    return model
 
 
-    return model
+def _convert_file(in_filename, out_filenames, types):
+    """Converts one model file to all types, used by convert_batch. Returns the conversion time (s)."""
+    import time
+    tic = time.perf_counter()
+    model = import_odes(in_filename)
+    for filename, type in zip(out_filenames, types):
+        export(model, filename, type)
+    return time.perf_counter()-tic
+
+def convert_batch(inputs, type='mdt', out_dir=None, manifest='odes2py_manifest.json', max_workers=None):
+    """This function converts all model files in a directory (or matching a glob pattern) using a pool of processes. 
+
+    A manifest with the hash of each input file (and of the converter itself) and the corresponding output files is kept, so models that are unchanged since the last conversion are skipped. The conversion time of each file is printed. 
+
+    Examples:
+        Converting all .txt models in the directory 'models' to SBML and MeDigiT:
+            convert_batch('models', ['sbml-yaml', 'mdt'])
+        Converting all models matching a pattern to SciPy, writing the output to 'out':
+            convert_batch('models/M*.txt', 'scipy', 'out')
+
+    Args: 
+        inputs: 
+            A directory (all .txt files in it are converted), a glob pattern or a list of file names
+        type: 
+            Desired type, or list of types, for the converted models. See odes2py for the available options. 
+        out_dir: 
+            Directory for the converted models. If set to None, each model is written next to its input file. Output files are named <input name>_<type>.<ext>, and such files (and the outputs listed in the manifest) are not converted themselves.
+        manifest: 
+            Path to the manifest (json). If set to None, all models are converted. 
+        max_workers: 
+            Maximum number of processes. Defaults to the number of cores. 
+    Returns: 
+        dict with the conversion time (s) of each converted file, and None for skipped files
+    """
+    import glob
+    import hashlib
+    import json
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    types = [type] if isinstance(type, str) else list(type)
+    if isinstance(inputs, str):
+        inputs = sorted(glob.glob(os.path.join(inputs, '*.txt'))) if os.path.isdir(inputs) else sorted(glob.glob(inputs))
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    with open(__file__, 'rb') as f:
+        converter_hash = hashlib.sha256(f.read()).hexdigest()
+    entries = {}
+    if manifest and os.path.exists(manifest):
+        with open(manifest, 'r') as f:
+            entries = json.load(f)
+
+    # Outputs of earlier conversions (listed in the manifest, or named <input name>_<type>.<ext>) are not converted again
+    outputs = {os.path.abspath(o) for entry in entries.values() for o in entry.get("outputs", [])}
+    suffixes = tuple("_"+t.replace('-','_')+_EXTENSIONS.get(t, '') for t in types)
+    skipped = [i for i in inputs if os.path.abspath(i) in outputs or i.endswith(suffixes)]
+    if skipped:
+        print(f"Skipping {len(skipped)} files that are outputs of a conversion")
+    inputs = [i for i in inputs if i not in skipped]
+
+    jobs = {}
+    timings = {}
+    for in_filename in inputs:
+        stem, _ = os.path.splitext(os.path.basename(in_filename))
+        directory = out_dir if out_dir else os.path.dirname(in_filename)
+        out_filenames = [os.path.join(directory, stem+"_"+t.replace('-','_')+_EXTENSIONS.get(t, '')) for t in types]
+        with open(in_filename, 'rb') as f:
+            h = hashlib.sha256(f.read())
+        h.update(converter_hash.encode())
+        h.update(json.dumps(types).encode())
+        key = os.path.abspath(in_filename)
+        entry = {"hash": h.hexdigest(), "outputs": out_filenames}
+        if entries.get(key, {}).get("hash") == entry["hash"] and all(os.path.exists(o) for o in out_filenames):
+            timings[in_filename] = None
+        else:
+            jobs[in_filename] = (out_filenames, entry)
+
+    with ProcessPoolExecutor(max_workers) as pool:
+        futures = {in_filename: pool.submit(_convert_file, in_filename, out_filenames, types) for in_filename, (out_filenames, _) in jobs.items()}
+        for in_filename, future in futures.items():
+            try:
+                timings[in_filename] = future.result()
+                entries[os.path.abspath(in_filename)] = jobs[in_filename][1]
+            except Exception as e:
+                error(f"Failed to convert {in_filename}: {e}")
+                entries.pop(os.path.abspath(in_filename), None)
+
+    if manifest:
+        with open(manifest, 'w') as f:
+            json.dump(entries, f, indent=2)
+
+    print(f"{'Model':<40} {'time (s)':>10}")
+    for in_filename in inputs:
+        if in_filename in timings:
+            elapsed = timings[in_filename]
+            print(f"{in_filename:<40} {'unchanged' if elapsed is None else f'{elapsed:.3f}':>10}")
+    print(f"Converted {len(timings)-list(timings.values()).count(None)} models, {list(timings.values()).count(None)} unchanged")
+    return timings
 
 
 if __name__ == '__main__':
@@ -719,11 +1533,18 @@ if __name__ == '__main__':
         odes2py
         odes2py in_file.txt type
         odes2py in_file.txt type out_file.txt
+        odes2py in_file.txt type1,type2,type3
+        odes2py model_dir type1,type2 [out_dir]           (converts all .txt files in model_dir)
+        odes2py "model_dir/*.txt" type1,type2 [out_dir]   (converts all files matching the pattern)
 
     """
     from pathlib import Path
     
     argv = sys.argv[1:]
+    if argv and (Path(argv[0]).is_dir() or any(c in argv[0] for c in '*?[')):
+        convert_batch(argv[0], argv[1].split(',') if len(argv)>1 else 'mdt', argv[2] if len(argv)>2 else None)
+        sys.exit()
+
     if len(argv)==0:
         fileName=input('Enter model file name: ')
     else:
@@ -731,12 +1552,16 @@ if __name__ == '__main__':
 
     if len(argv)==1:
         type="mdt"
+    elif ',' in argv[1]:
+        type=argv[1].split(',')
     else:
         type=argv[1]
 
-    if len(argv)<3: 
-        out_filename=f"    {Path(fileName).stem}-{type}{Path(fileName).suffix}"
+    if len(argv)>=3:
+        out_filename=argv[2].split(',') if isinstance(type, list) else argv[2]
+    elif isinstance(type, list):
+        out_filename=None
     else:
-        out_filename=argv[2]
+        out_filename=f"{Path(fileName).stem}-{type}{Path(fileName).suffix}"
 
     odes2py(fileName, out_filename, type)
@@ -0,0 +1,121 @@
+""" Append-only storage of the starts of a multistart optimization, so that long runs can be followed while they run, and resumed after a crash.
+
+The store is a JSON lines file. The first line is a header with the settings of the run (the seed and a hash of the
+start points), and each following line is one finished start. Each line is flushed to disk when the start finishes,
+so at most the starts that were running are lost if the job is stopped.
+
+Use cases:
+    python result_store.py starts.jsonl      (prints the progress of a run)
+"""
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+def startpoints_hash(startpoints):
+    """Returns a hash of the start points, used to check that a resumed run uses the same start points."""
+    return hashlib.sha256(np.ascontiguousarray(startpoints, dtype=float).tobytes()).hexdigest()
+
+def file_hash(filename):
+    """Returns a hash of the contents of a file (e.g. the data file), used to check that a resumed run uses the same data."""
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def read_store(filename):
+    """This function reads a store written by open_store and append_start.
+
+    A last line that is incomplete (e.g. if the job was stopped while writing it) is ignored.
+
+    Args:
+        filename:
+            path to the store (.jsonl)
+    Returns:
+        the header (dict) and the finished starts (dict of start index: record)
+    """
+    header = None
+    records = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry.get("type") == "header":
+                header = entry
+            elif entry.get("type") == "start":
+                records[entry["start_id"]] = entry
+    return header, records
+
+def open_store(filename, header, resume=False):
+    """This function opens a store for appending finished starts.
+
+    Args:
+        filename:
+            path to the store (.jsonl)
+        header:
+            dict with the settings of the run, written as the first line of a new store
+        resume:
+            If True, an existing store is appended to. Otherwise, it is overwritten.
+    Returns:
+        the opened file
+    """
+    if resume and os.path.exists(filename):
+        f = open(filename, 'a+')
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(f.tell()-1)
+            if f.read(1) != "\n": # the last line was not finished, start a new line
+                f.write("\n")
+        return f
+    f = open(filename, 'w')
+    _write_line(f, dict(header, type="header"))
+    return f
+
+def _write_line(f, entry):
+    f.write(json.dumps(entry) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+def _to_list(value):
+    return None if value is None else np.asarray(value, dtype=float).tolist()
+
+def append_start(f, start_id, optimizer_result):
+    """This function writes a finished start (x, fval, gradient, number of evaluations and wall time) to an opened store."""
+    r = optimizer_result
+    _write_line(f, {
+        "type": "start",
+        "start_id": int(start_id),
+        "x0": _to_list(r.x0),
+        "x": _to_list(r.x),
+        "fval": None if r.fval is None else float(r.fval),
+        "grad": _to_list(r.grad),
+        "grad_norm": None if r.grad is None else float(np.linalg.norm(r.grad)),
+        "n_fval": r.n_fval,
+        "n_grad": r.n_grad,
+        "time": r.time,
+        "exitflag": r.exitflag,
+        "message": None if r.message is None else str(r.message),
+    })
+
+def record_to_result(record):
+    """Creates a pypesto.OptimizerResult from a stored start."""
+    import pypesto
+    as_array = lambda value: None if value is None else np.array(value)
+    return pypesto.OptimizerResult(id=str(record["start_id"]), x=as_array(record["x"]), fval=record["fval"],
+                                   grad=as_array(record.get("grad")), x0=as_array(record["x0"]), n_fval=record["n_fval"], n_grad=record["n_grad"],
+                                   time=record["time"], exitflag=record["exitflag"], message=record["message"])
+
+def print_progress(filename):
+    """Prints the number of finished starts and the best objective values in a store."""
+    header, records = read_store(filename)
+    fvals = sorted(r["fval"] for r in records.values() if r["fval"] is not None and np.isfinite(r["fval"]))
+    n_starts = header["n_starts"] if header else "?"
+    print(f"{len(records)} of {n_starts} starts finished, {len(records)-len(fvals)} failed")
+    print(f"Best objective values: {fvals[:5]}")
+    if records:
+        print(f"Total optimization time: {sum(r['time'] or 0 for r in records.values()):.1f} s")
+
+if __name__ == '__main__':
+    print_progress(sys.argv[1])
@@ -0,0 +1,30 @@
+import os
+import sys
+
+# The modules are at the top level of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import pytest
+
+def compile_m1(path, **kwargs):
+    """Compiles M1 as in main.py, with the further arguments to sbml2amici in kwargs. The model is built in amici_models/
+    of the repository, so the build is shared with main.py and reused by later test runs."""
+    pytest.importorskip("amici")
+    from model_cache import compile_model
+    from odes2py import odes2py
+    sbml_file = os.path.join(path, "M1.xml")
+    model = odes2py(os.path.join(REPO_DIR, "M1.txt"), sbml_file, 'sbml-yaml')
+    observables = {name: {'name': '', 'formula': formula} for name, formula in model["observables"]}
+    return compile_model(sbml_file, model["name"], observables, cache_dir=os.path.join(REPO_DIR, "amici_models"), **kwargs)
+
+@pytest.fixture(scope="session")
+def m1_module(tmp_path_factory):
+    """The compiled M1 model, without fixed parameters."""
+    return compile_m1(str(tmp_path_factory.mktemp("m1")), constant_parameters=[])
+
+@pytest.fixture(scope="session")
+def m1_data():
+    pytest.importorskip("amici")
+    from calibration import load_data
+    return load_data(os.path.join(REPO_DIR, "data.json"))
@@ -0,0 +1,22 @@
+import os
+
+import benchmark
+import odes2py
+from conftest import REPO_DIR
+
+def test_write_scaled_model(tmp_path):
+    model = odes2py.import_odes(os.path.join(REPO_DIR, "M1.txt"))
+    filename = str(tmp_path / "M1_x3.txt")
+    n_lines = benchmark.write_scaled_model(model, 3, filename)
+    with open(filename) as f:
+        assert sum(1 for _ in f) == n_lines
+    scaled = odes2py.import_odes(filename)
+    assert len(scaled["states"]) == 3*len(model["states"])
+    assert scaled["states"][len(model["states"])][0] == model["states"][0][0] + "_1"
+
+def test_benchmark_import_reaches_the_number_of_lines(tmp_path):
+    timings = benchmark.benchmark_import(os.path.join(REPO_DIR, "M1.txt"), str(tmp_path), 1, 100000)
+    assert list(timings) == ["import_odes [100000 lines]"]
+    scaled_file, = [name for name in os.listdir(tmp_path) if name.startswith("M1_x")]
+    with open(tmp_path / scaled_file) as f:
+        assert sum(1 for _ in f) >= 100000
@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("amici")
+from calibration import create_problem, fixed_parameter_values, setup_model, solver_options, worker_problem
+from conftest import REPO_DIR, compile_m1
+from model_cache import module_location
+
+def test_worker_problem_uses_the_solver_options_of_the_main_problem(m1_module, m1_data):
+    data, edata = m1_data
+    settings = {"rtol": 1e-7, "atol": 1e-13, "linear_solver": "dense", "max_steps": 20000}
+    model, solver = setup_model(m1_module, data, edata, sensitivity_method='adjoint', solver_settings=settings)
+    problem = create_problem(model, solver, edata, cache_size=10)
+    assert solver_options(problem) == ('adjoint', settings)
+
+    worker = worker_problem(m1_module.__name__, module_location(m1_module),
+                            os.path.join(REPO_DIR, "data.json"), problem.lb, problem.ub, {}, *solver_options(problem))
+    assert solver_options(worker) == ('adjoint', settings)
+
+def test_fixed_parameters_are_compiled_as_constants(tmp_path_factory, m1_data):
+    m1_fixed_k4 = compile_m1(str(tmp_path_factory.mktemp("m1_k4")), constant_parameters=["k4"])
+    data, edata = m1_data
+    model, solver = setup_model(m1_fixed_k4, data, edata, sensitivity_method='forward', fixed_parameters={"k4": 1e-5}, solver_settings=None)
+    assert list(model.getParameterIds()) == ["k1", "k2", "kfeed", "k5"]
+    assert list(model.getFixedParameterIds()) == ["k4"]
+    problem = create_problem(model, solver, edata)
+    assert problem.dim == 4 and fixed_parameter_values(problem) == {"k4": 1e-5}
+    fval, grad = problem.objective(np.asarray(model.getParameters()), sensi_orders=(0, 1))
+    assert np.isfinite(fval) and grad.shape == (4,)
+
+    worker = worker_problem(m1_fixed_k4.__name__, module_location(m1_fixed_k4), os.path.join(REPO_DIR, "data.json"),
+                            problem.lb, problem.ub, fixed_parameter_values(problem), *solver_options(problem))
+    assert fixed_parameter_values(worker) == {"k4": 1e-5}
+    np.testing.assert_allclose(worker.objective(np.asarray(model.getParameters())), fval, rtol=1e-6)
@@ -0,0 +1,86 @@
+from multiprocessing import Value
+
+import numpy as np
+import pytest
+
+pytest.importorskip("amici") # early_stopping imports calibration
+pypesto = pytest.importorskip("pypesto")
+from pypesto.C import FVAL
+from pypesto.objective import ObjectiveBase
+
+from early_stopping import (STOPPED, StartStopped, StoppingObjective, converged, distinct_optima, projected_gradient,
+                            stopping_statistics, unobserved_basin_probability)
+
+# A start of Fides that ended in the optimum of M1 (chi2 ~13.3), with k4 at its lower bound
+M1_X = np.array([7.12476407e-01, 4.25219384e+00, 1.18335152e+05, 1.00000002e-06, 2.92897233e-03])
+M1_GRAD = np.array([1.29356375e-05, 3.13528216e-07, -1.92498334e-09, 3.74238481e+00, -6.55486617e-03])
+
+class ConstantObjective(ObjectiveBase):
+    """An objective with a constant value, accepting the arguments that pypesto passes to an AmiciObjective."""
+
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+    def check_mode(self, mode):
+        return True
+
+    def check_sensi_orders(self, sensi_orders, mode):
+        return tuple(sensi_orders) == (0,)
+
+    def call_unprocessed(self, x, sensi_orders, mode, **kwargs):
+        return {FVAL: self.value}
+
+def test_unobserved_basin_probability():
+    assert unobserved_basin_probability(2, 1) == 1.0
+    assert unobserved_basin_probability(10, 1) == pytest.approx(2/90)
+    assert unobserved_basin_probability(100, 4) == pytest.approx(20/9900)
+
+def test_distinct_optima():
+    assert distinct_optima([], 0.01) == 0
+    assert distinct_optima([1.0, 1.005, 1.009, 2.0, 2.5], 0.01) == 3
+
+def test_projected_gradient_ignores_active_bounds():
+    g = projected_gradient(M1_X, M1_GRAD, 1e-6, 1e7)
+    assert g[3] == 0.0
+    np.testing.assert_allclose(g[[0, 1, 2, 4]], (M1_GRAD*M1_X*np.log(10))[[0, 1, 2, 4]])
+    # the gradient points into the bounds, so the bound is not active
+    assert projected_gradient(M1_X, -M1_GRAD, 1e-6, 1e7)[3] != 0.0
+
+def test_converged():
+    optimum = pypesto.OptimizerResult(x=M1_X, grad=M1_GRAD, fval=-45.734)
+    assert np.linalg.norm(M1_GRAD) > 1 # the raw gradient is large at the bound
+    assert converged(optimum, 1e-6, 1e7)
+    plateau = pypesto.OptimizerResult(x=np.full(5, 1e5), grad=np.full(5, 0.02), fval=6e4)
+    assert not converged(plateau, 1e-6, 1e7)
+    assert converged(pypesto.OptimizerResult(x=M1_X, fval=1.0), 1e-6, 1e7) # no gradient
+
+def test_stopping_statistics():
+    problem = pypesto.Problem(pypesto.Objective(fun=lambda x: 0.0), lb=np.full(5, 1e-6), ub=np.full(5, 1e7))
+    result = pypesto.Result(problem)
+    for i, fval in enumerate([-45.734, -45.73, -43.8, -45.7335]):
+        result.optimize_result.append(pypesto.OptimizerResult(id=str(i), x=M1_X, grad=M1_GRAD, fval=fval), sort=False)
+    result.optimize_result.append(pypesto.OptimizerResult(id="4", x=M1_X, grad=M1_GRAD, fval=-50.0, message=f"{STOPPED}: test"), sort=False)
+    result.optimize_result.append(pypesto.OptimizerResult(id="5", x=np.full(5, 1e5), grad=np.full(5, 0.02), fval=6e4), sort=False)
+    stats = stopping_statistics(result)
+    assert stats["n"] == 4
+    assert stats["best"] == -45.734
+    assert stats["hits"] == 3
+    assert stats["minima"] == 2
+    assert stats["p_unobserved"] == pytest.approx(unobserved_basin_probability(4, 2))
+
+def test_stopping_objective_stops_stagnating_start():
+    best, stop = Value('d', 0.0), Value('b', False)
+    objective = StoppingObjective(ConstantObjective(10.0), best, stop, margin=1.0, window=5)
+    for _ in range(5):
+        objective(np.zeros(1))
+    with pytest.raises(StartStopped):
+        objective(np.zeros(1))
+    assert objective.reason.startswith(STOPPED)
+
+def test_stopping_objective_keeps_good_start():
+    best, stop = Value('d', 0.0), Value('b', True)
+    objective = StoppingObjective(ConstantObjective(0.5), best, stop, margin=1.0, window=5)
+    for _ in range(20):
+        objective(np.zeros(1))
+    assert objective.reason is None
@@ -0,0 +1,92 @@
+import json
+
+import numpy as np
+import pytest
+
+amici = pytest.importorskip("amici")
+import evaluation
+from calibration import create_problem, problem_chi2, setup_model
+from evaluation import (REFERENCE_SETTINGS, SENSITIVITY_CACHE, SENSITIVITY_METHODS, SOLVER_SETTINGS_CACHE, apply_solver_settings,
+                        current_solver_settings, select_sensitivity_method, tune_solver_settings)
+
+@pytest.fixture
+def m1(m1_module, m1_data):
+    data, edata = m1_data
+    model, solver = setup_model(m1_module, data, edata, sensitivity_method='forward', solver_settings=None)
+    return model, solver, edata
+
+def fail(*args, **kwargs):
+    raise AssertionError("the cached result should be used")
+
+def test_select_sensitivity_method_is_accurate_and_cached(m1, tmp_path, monkeypatch):
+    model, solver, edata = m1
+    method = select_sensitivity_method(model, solver, edata, cache_dir=str(tmp_path), n_repeats=1)
+    assert method in SENSITIVITY_METHODS
+    with open(tmp_path / SENSITIVITY_CACHE) as f:
+        cached = json.load(f)
+    assert cached["method"] == method and cached["errors"][method] <= 1e-2
+
+    monkeypatch.setattr(evaluation, "finite_difference_gradient", fail)
+    assert select_sensitivity_method(model, solver, edata, cache_dir=str(tmp_path), n_repeats=1) == method
+    solver.setRelativeTolerance(1e-7) # other solver settings, the choice is made again
+    with pytest.raises(AssertionError):
+        select_sensitivity_method(model, solver, edata, cache_dir=str(tmp_path), n_repeats=1)
+
+def test_tune_solver_settings_meets_the_budget_and_is_cached(m1, tmp_path, monkeypatch):
+    model, solver, edata = m1
+    parameters = [model.getParameters()]
+    settings = tune_solver_settings(model, solver, edata, parameters, cache_dir=str(tmp_path), n_repeats=1)
+    with open(tmp_path / SOLVER_SETTINGS_CACHE) as f:
+        candidates = json.load(f)["candidates"]
+    assert any(c["settings"] == settings and c["accurate"] for c in candidates)
+    assert current_solver_settings(solver) != settings # the solver is not modified
+
+    reference, tuned = solver.clone(), solver.clone()
+    apply_solver_settings(reference, REFERENCE_SETTINGS)
+    apply_solver_settings(tuned, settings)
+    expected = evaluation.evaluate_batch(model, reference, edata, parameters, sensitivities=True)
+    res = evaluation.evaluate_batch(model, tuned, edata, parameters, sensitivities=True)
+    np.testing.assert_allclose(res["chi2"], expected["chi2"], rtol=1e-6)
+    np.testing.assert_allclose(res["sllh"], expected["sllh"], rtol=1e-4, atol=1e-4*np.linalg.norm(expected["sllh"]))
+
+    monkeypatch.setattr(evaluation, "evaluate_batch", fail)
+    assert tune_solver_settings(model, solver, edata, parameters, cache_dir=str(tmp_path), n_repeats=1) == settings
+    with pytest.raises(AssertionError): # another budget, the settings are tuned again
+        tune_solver_settings(model, solver, edata, parameters, cache_dir=str(tmp_path), grad_tol=1e-3, n_repeats=1)
+    solver.setSensitivityMethod(SENSITIVITY_METHODS["adjoint"])
+    with pytest.raises(AssertionError): # another sensitivity method
+        tune_solver_settings(model, solver, edata, parameters, cache_dir=str(tmp_path), n_repeats=1)
+
+def test_tune_solver_settings_falls_back_to_the_reference_settings(m1, capsys):
+    model, solver, edata = m1
+    settings = tune_solver_settings(model, solver, edata, [model.getParameters()], chi2_tol=0, grad_tol=0, n_repeats=1)
+    assert settings == REFERENCE_SETTINGS
+    assert "no solver settings meet the accuracy budget" in capsys.readouterr().out
+
+def test_tune_solver_settings_keeps_the_settings_if_the_reference_fails(m1, capsys):
+    model, solver, edata = m1
+    settings = tune_solver_settings(model, solver, edata, [np.full(len(model.getParameters()), np.nan)], n_repeats=1)
+    assert settings == current_solver_settings(solver)
+    assert "The solver settings are not tuned" in capsys.readouterr().out
+
+def test_likelihood_only_simulation_gives_the_same_chi2(m1):
+    model, solver, edata = m1
+    full = evaluation.simulate(model, solver, edata, full=True)
+    lean = evaluation.simulate(model, solver, edata)
+    assert full["x"] is not None and lean["x"] is None
+    assert np.isfinite(full["chi2"]) and not np.isfinite(lean["chi2"])
+    np.testing.assert_allclose(evaluation.rdata_chi2(lean, edata), full["chi2"], rtol=1e-10)
+    np.testing.assert_allclose(lean["sllh"], full["sllh"], rtol=1e-10)
+    assert solver.getReturnDataReportingMode() == amici.RDataReporting.full # restored
+
+def test_lean_problem_matches_the_full_problem(m1):
+    model, solver, edata = m1
+    full = create_problem(model, solver, edata, lean=False)
+    x = np.asarray(model.getParameters()) # in the parameter scale of the model
+    expected_chi2 = evaluation.simulate(model, solver, edata, full=True)["chi2"]
+    for problem in [create_problem(model, solver, edata), create_problem(model, solver, edata, cache_size=10)]:
+        fval, grad = problem.objective(x, sensi_orders=(0, 1))
+        expected_fval, expected_grad = full.objective(x, sensi_orders=(0, 1))
+        np.testing.assert_allclose(fval, expected_fval, rtol=1e-10)
+        np.testing.assert_allclose(grad, expected_grad, rtol=1e-8)
+        np.testing.assert_allclose(problem_chi2(problem, x), expected_chi2, rtol=1e-6)
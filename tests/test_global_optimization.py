@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("amici")
+from global_optimization import BatchCost
+
+def batch_cost(x, cost):
+    """A BatchCost with evaluated parameter vectors, without a model."""
+    batch = BatchCost.__new__(BatchCost)
+    batch.x = [np.asarray(x, dtype=float)]
+    batch.cost = [np.asarray(cost, dtype=float)]
+    return batch
+
+def test_best_distinct_points():
+    batch = batch_cost([[0.0, 0.0], [0.01, 0.0], [1.0, 1.0], [2.0, 2.0], [5.0, 5.0]], [1.0, 0.5, 2.0, 3.0, np.inf])
+    x, cost = batch.best(3, min_distance=0.1)
+    np.testing.assert_array_equal(cost, [0.5, 2.0, 3.0]) # [0, 0] is too close to the better [0.01, 0]
+    np.testing.assert_array_equal(x[0], [0.01, 0.0])
+
+def test_best_tops_up_with_close_points():
+    batch = batch_cost([[0.0, 0.0], [0.01, 0.0], [0.02, 0.0]], [1.0, 0.5, 0.7])
+    x, cost = batch.best(2, min_distance=0.1)
+    np.testing.assert_array_equal(cost, [0.5, 0.7])
+
+def test_best_never_returns_failed_simulations():
+    batch = batch_cost([[0.0], [1.0], [2.0]], [np.inf, 1.0, np.inf])
+    x, cost = batch.best(3)
+    np.testing.assert_array_equal(cost, [1.0])
+    assert batch.n_evaluations == 3
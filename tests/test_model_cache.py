@@ -0,0 +1,38 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("amici")
+import model_cache
+
+def fake_build(cache_dir, key, age):
+    build_dir = model_cache.model_dir("M1", key, str(cache_dir))
+    os.makedirs(build_dir)
+    open(os.path.join(build_dir, model_cache.COMPLETE_MARKER), 'w').close()
+    t = time.time() - age
+    os.utime(build_dir, (t, t))
+    return build_dir
+
+def test_evict_stale_keeps_the_most_recently_used_builds(tmp_path):
+    builds = [fake_build(tmp_path, f"{i:016d}", age=100*i) for i in range(4)]
+    model_cache.evict_stale("M1", str(tmp_path), keep=2)
+    assert [os.path.exists(d) for d in builds] == [True, True, False, False]
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(d) for d in builds[:2]]
+
+def test_evict_stale_skips_builds_in_use(tmp_path):
+    fcntl = pytest.importorskip("fcntl")
+    builds = [fake_build(tmp_path, f"{i:016d}", age=100*i) for i in range(4)]
+    assert model_cache.use_build(builds[3]) # also marks the build as the most recently used
+    with open(os.path.join(builds[2], model_cache.LOCK_FILE), 'a') as f: # as another process using the build
+        fcntl.flock(f, fcntl.LOCK_SH)
+        model_cache.evict_stale("M1", str(tmp_path), keep=0)
+    assert [os.path.exists(d) for d in builds] == [False, False, True, True]
+    model_cache._builds_in_use.pop(os.path.abspath(builds[3])).close()
+
+def test_use_build_requires_a_complete_build(tmp_path):
+    build_dir = os.path.join(tmp_path, "M1_0000000000000000")
+    assert not model_cache.use_build(build_dir)
+    os.makedirs(build_dir)
+    assert not model_cache.use_build(build_dir)
+    assert os.path.abspath(build_dir) not in model_cache._builds_in_use
@@ -0,0 +1,71 @@
+import os
+import shlex
+import shutil
+
+import pytest
+
+import object_cache
+
+needs_gcc = pytest.mark.skipif(shutil.which("gcc") is None, reason="requires gcc")
+
+def write_source(directory, body="int f(int x) { return x + 1; }\n", header="#define ONE 1\n"):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "util.h"), 'w') as f:
+        f.write(header)
+    with open(os.path.join(directory, "f.c"), 'w') as f:
+        f.write('#include "util.h"\n' + body)
+    return os.path.join(directory, "f.c")
+
+def compile_args(source, *flags):
+    directory = os.path.dirname(source)
+    return ["-O2", *flags, "-I", directory, f"-I{directory}", "-MD", "-MF", source + ".d", "-c", source, "-o", source + ".o"]
+
+def test_non_compilations_have_no_key():
+    assert object_cache.object_key("gcc", ["a.o", "b.o", "-o", "lib.so"]) is None
+    assert object_cache.object_key("gcc", ["-c", "a.c", "b.c", "-o", "x.o"]) is None
+
+@needs_gcc
+def test_key_ignores_paths_but_not_code_or_flags(tmp_path):
+    a = write_source(str(tmp_path / "build_a"))
+    b = write_source(str(tmp_path / "build_b"))
+    key = object_cache.object_key("gcc", compile_args(a))
+    assert key == object_cache.object_key("gcc", compile_args(b))
+    assert os.path.exists(a + ".d") # the dependency file is written by the preprocessing
+    assert key != object_cache.object_key("gcc", compile_args(a, "-O0"))
+    changed = write_source(str(tmp_path / "build_c"), header="#define ONE 2\nint g;\n")
+    assert key != object_cache.object_key("gcc", compile_args(changed))
+
+@needs_gcc
+def test_compile_cached_reuses_objects(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    a = write_source(str(tmp_path / "build_a"))
+    b = write_source(str(tmp_path / "build_b"))
+    assert object_cache.compile_cached(cache_dir, "gcc", compile_args(a)) == 0
+    assert object_cache.compile_cached(cache_dir, "gcc", compile_args(b)) == 0
+    assert object_cache.read_log(cache_dir) == (1, 1)
+    with open(a + ".o", 'rb') as fa, open(b + ".o", 'rb') as fb:
+        assert fa.read() == fb.read()
+    assert object_cache.read_log(cache_dir) == (0, 0) # the log is cleared when read
+
+@needs_gcc
+def test_evict_objects(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    for i in range(3):
+        source = write_source(str(tmp_path / f"build_{i}"), body=f"int f(int x) {{ return x + {i}; }}\n")
+        object_cache.compile_cached(cache_dir, "gcc", compile_args(source))
+    object_cache.evict_objects(cache_dir, max_size_mb=0)
+    remaining = [name for _, _, files in os.walk(os.path.join(cache_dir, object_cache.OBJECT_DIR)) for name in files]
+    assert remaining == []
+
+def test_compiler_environment_quotes_paths(monkeypatch, tmp_path):
+    monkeypatch.setattr(object_cache, "_cmake_build", lambda: False)
+    monkeypatch.setenv("CC", "gcc -pthread")
+    monkeypatch.setenv("CXX", "g++")
+    cache_dir = str(tmp_path / "my cache")
+    env = object_cache.compiler_environment(cache_dir, n_jobs=2)
+    assert env["AMICI_PARALLEL_COMPILE"] == "2"
+    assert shlex.split(env["CC"])[2:] == [os.path.abspath(cache_dir), "gcc", "-pthread"]
+    assert shlex.split(env["CXX"])[-1] == "g++"
+    assert object_cache.compiler_environment(cache_dir, n_jobs=2, object_cache=False) == {"AMICI_PARALLEL_COMPILE": "2"}
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+amici = pytest.importorskip("amici")
+pytest.importorskip("pypesto")
+from pypesto.C import FVAL, GRAD
+from pypesto.objective import ObjectiveBase
+
+from evaluation import chi2_offset
+from objective_cache import CachedObjective
+
+class QuadraticObjective(ObjectiveBase):
+    """A negative log-likelihood sum((x-1)^2), with AMICI data but without rdatas, counting its evaluations."""
+
+    def __init__(self, edata):
+        super().__init__(x_names=["a", "b"])
+        self.edatas = [edata]
+        self.n_calls = 0
+
+    def check_mode(self, mode):
+        return True
+
+    def check_sensi_orders(self, sensi_orders, mode):
+        return True
+
+    def call_unprocessed(self, x, sensi_orders, mode, **kwargs):
+        self.n_calls += 1
+        result = {FVAL: float(np.sum((x - 1)**2))}
+        if 1 in sensi_orders:
+            result[GRAD] = 2*(x - 1)
+        return result
+
+@pytest.fixture
+def edata():
+    edata = amici.ExpData(1, 0, 0, [0.0, 1.0, 2.0])
+    edata.setObservedData([1.0, 2.0, 3.0])
+    edata.setObservedDataStdDev([0.5, 0.5, 1.0])
+    return edata
+
+def test_repeated_evaluations_are_cached(edata):
+    objective = CachedObjective(QuadraticObjective(edata), max_size=2)
+    x = np.array([2.0, 3.0])
+    assert objective(x) == 5.0
+    fval, grad = objective(x, sensi_orders=(0, 1)) # the gradient is not cached yet
+    assert objective(x, sensi_orders=(0, 1))[0] == fval
+    assert objective.objective.n_calls == 2
+    assert objective.stats["hits"] == 1
+    objective(x + 1)
+    objective(x + 2) # evicts x
+    assert objective.stats["evictions"] == 1
+
+def test_chi2_from_the_objective_value(edata):
+    objective = CachedObjective(QuadraticObjective(edata))
+    x = np.array([2.0, 3.0])
+    objective(x, sensi_orders=(0, 1))
+    entry = dict(objective.entries[objective.key(x)])
+    assert objective.chi2(x) == pytest.approx(2*5.0 - chi2_offset(edata))
+    assert objective.objective.n_calls == 1 # looked up, and the entry is unchanged
+    assert set(objective.entries[objective.key(x)]) == set(entry)
+    assert objective.chi2(x + 1) == pytest.approx(2*13.0 - chi2_offset(edata)) # simulated and cached
+    assert objective.objective.n_calls == 2
+
+def test_save_and_load(edata, tmp_path):
+    pytest.importorskip("h5py")
+    filename = str(tmp_path / "cache.h5")
+    objective = CachedObjective(QuadraticObjective(edata), filename=filename, model_id="M1_0123")
+    for i in range(3):
+        objective(np.array([i, 2.0*i]), sensi_orders=(0, 1))
+    objective.save()
+
+    loaded = CachedObjective(QuadraticObjective(edata), filename=filename, model_id="M1_0123")
+    assert loaded.stats["size"] == 3
+    assert loaded(np.array([2.0, 4.0]), sensi_orders=(0, 1))[0] == 10.0
+    assert loaded.objective.n_calls == 0
+    np.testing.assert_array_equal(loaded.entries[loaded.key([1.0, 2.0])][GRAD], [0.0, 2.0])
+
+def test_cache_of_another_model_or_data_is_not_loaded(edata, tmp_path):
+    pytest.importorskip("h5py")
+    filename = str(tmp_path / "cache.h5")
+    objective = CachedObjective(QuadraticObjective(edata), filename=filename, model_id="M1_0123")
+    objective(np.array([1.0, 2.0]))
+    objective.save()
+    assert CachedObjective(QuadraticObjective(edata), filename=filename, model_id="M1_4567").stats["size"] == 0
+    other_data = amici.ExpData(edata)
+    other_data.setObservedData([1.0, 2.0, 4.0])
+    assert CachedObjective(QuadraticObjective(other_data), filename=filename, model_id="M1_0123").stats["size"] == 0
+    assert CachedObjective(QuadraticObjective(edata), filename=filename, model_id="M1_0123", digits=6).stats["size"] == 0
@@ -0,0 +1,253 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+import odes2py
+from conftest import REPO_DIR
+
+M1_FILE = os.path.join(REPO_DIR, "M1.txt")
+
+def write_model(path, states, parameters="k1 = 0.5", name="m"):
+    filename = os.path.join(path, f"{name}.txt")
+    with open(filename, 'w') as f:
+        f.write(f"********** MODEL NAME\n{name}\n********** MODEL STATES\n{states}\n********** MODEL PARAMETERS\n{parameters}\n")
+    return filename
+
+def load_module(filename):
+    spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(filename))[0], filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_missing_initial_value_defaults_to_zero(tmp_path):
+    model = odes2py.import_odes(write_model(tmp_path, "d/dt(A) = -k1*A\nd/dt(B) = k1*A\nA(0) = 1"))
+    assert model["states"] == [("A", "-k1*A", 1.0), ("B", "k1*A", 0.0)]
+
+def test_scipy_export_without_initial_values(tmp_path):
+    model = {"name": "m", "states": [("A", "-k1*A"), ("B", "k1*A")], "parameters": [("k1", 0.5)]}
+    filename = str(tmp_path / "m_scipy.py")
+    odes2py.export_as_scipy(model, filename)
+    assert load_module(filename).initial_values == [0.0, 0.0]
+
+def test_scipy_batch_export_without_initial_values(tmp_path):
+    pytest.importorskip("numba")
+    model = {"name": "m", "states": [("A", "-k1*A"), ("B", "k1*A")], "parameters": [("k1", 0.5)]}
+    filename = str(tmp_path / "m_scipy.py")
+    odes2py.export_as_scipy(model, filename, jacobian=False, batch=True, cse=False)
+    out = np.zeros((2, 2))
+    load_module(filename).m_batch(np.array([[1.0, 0.0], [2.0, 1.0]]), 0.0, np.array([[0.5], [1.0]]), out)
+    np.testing.assert_allclose(out, [[-0.5, 0.5], [-2.0, 2.0]])
+
+def test_ensemble_export_without_initial_values(tmp_path):
+    pytest.importorskip("sympy")
+    pytest.importorskip("numba")
+    model = {"name": "m", "states": [("A", "-k1*A"), ("B", "k1*A")], "parameters": [("k1", 0.5)]}
+    filename = str(tmp_path / "m_ensemble.py")
+    odes2py.export_as_scipy_ensemble(model, filename, cse=False)
+    out = np.zeros(2)
+    module = load_module(filename)
+    module.rhs(np.array([1.0, 0.0]), 0.0, np.array([0.5]), out)
+    np.testing.assert_allclose(out, [-0.5, 0.5])
+    np.testing.assert_array_equal(module.initial_values, [0.0, 0.0])
+
+def test_optimize_expressions_folds_constants_and_extracts_common_subexpressions():
+    sympy = pytest.importorskip("sympy")
+    x, y = sympy.symbols("x y")
+    temporaries, exprs = odes2py.optimize_expressions([1.0*x*sympy.exp(x+y) + 2.0, sympy.exp(x+y)*y])
+    cse0 = sympy.Symbol("_cse0")
+    assert temporaries == [("_cse0", sympy.exp(x+y))]
+    assert exprs == [cse0*x + 2, cse0*y]
+    assert not any(expr.atoms(sympy.Float) for expr in exprs)
+
+@pytest.fixture(scope="module")
+def m1_scipy(tmp_path_factory):
+    pytest.importorskip("sympy")
+    pytest.importorskip("numba")
+    path = tmp_path_factory.mktemp("scipy")
+    model = odes2py.import_odes(M1_FILE)
+    odes2py.export_as_scipy(model, str(path / "m1_cse.py"))
+    odes2py.export_as_scipy(model, str(path / "m1_plain.py"), jacobian=False, cse=False)
+    return model, load_module(str(path / "m1_cse.py")), load_module(str(path / "m1_plain.py"))
+
+def test_scipy_export_cse_matches_plain_equations(m1_scipy):
+    model, cse, plain = m1_scipy
+    param = np.array([p[1] for p in model["parameters"]])
+    state = np.array([0.3, 0.7, 0.6, 0.4, 1.0])
+    np.testing.assert_allclose(cse.M1(state, 0.0, param), plain.M1(state, 0.0, param), rtol=1e-12)
+
+def test_scipy_export_jacobian_matches_finite_differences(m1_scipy):
+    model, cse, _ = m1_scipy
+    param = np.array([1.0, 2.0, 3.0, 0.5, 0.2])
+    state = np.array([0.3, 0.7, 0.6, 0.4, 1.0])
+    h = 1e-7
+    fd = np.array([(np.array(cse.M1(state + h*e, 0.0, param)) - np.array(cse.M1(state - h*e, 0.0, param)))/(2*h)
+                   for e in np.eye(len(state))]).T
+    np.testing.assert_allclose(cse.M1_jac(state, 0.0, param), fd, rtol=1e-6, atol=1e-8)
+
+def test_scipy_export_simulate_conserves_totals(m1_scipy):
+    _, cse, _ = m1_scipy
+    sol = cse.simulate([0, 1, 10])
+    assert sol.success
+    np.testing.assert_allclose(sol.y[0] + sol.y[1], 1.0, rtol=1e-6) # R + Rp
+    np.testing.assert_allclose(sol.y[2] + sol.y[3], 1.0, rtol=1e-6) # RS + RSp
+
+def test_reduce_model_m1(tmp_path):
+    pytest.importorskip("sympy")
+    scipy_integrate = pytest.importorskip("scipy.integrate")
+    model = odes2py.import_odes(M1_FILE)
+    reduced = odes2py.reduce_model(model)
+    assert [s[0] for s in reduced["states"]] == ["Rp", "RSp"]
+    assert reduced["variables"][:5] == [("S", "1.0"), ("R_total", "1.0"), ("RS_total", "1.0"), ("R", "R_total - Rp"), ("RS", "RS_total - RSp")]
+    assert reduced["parameters"] == model["parameters"]
+    with_parameters = odes2py.reduce_model(model, constants_as_parameters=True)
+    assert with_parameters["parameters"] == model["parameters"] + [("S", 1.0), ("R_total", 1.0), ("RS_total", 1.0)]
+
+    odes2py.export_as_scipy(model, str(tmp_path / "m1_full.py"), jacobian=False, cse=False)
+    odes2py.export_as_scipy(reduced, str(tmp_path / "m1_reduced.py"), jacobian=False, cse=False)
+    full, small = load_module(str(tmp_path / "m1_full.py")), load_module(str(tmp_path / "m1_reduced.py"))
+    param = np.array([p[1] for p in model["parameters"]])
+    t = np.linspace(0, 10, 21)
+    def simulate(module, model):
+        y0 = [s[2] for s in model["states"]]
+        sol = scipy_integrate.solve_ivp(lambda t, y: module.M1(y, t, param), (0, 10), y0, method="LSODA",
+                                        t_eval=t, rtol=1e-10, atol=1e-12)
+        assert sol.success
+        return sol.y
+    y_full, y_reduced = simulate(full, model), simulate(small, reduced)
+    np.testing.assert_allclose(y_reduced, y_full[[1, 3]], rtol=1e-6, atol=1e-9) # Rp, RSp
+    np.testing.assert_allclose(1.0 - y_reduced, y_full[[0, 2]], rtol=1e-6, atol=1e-9) # R, RS from the conservation laws
+
+def test_reduce_model_without_initial_values():
+    pytest.importorskip("sympy")
+    model = {"name": "m", "states": [("A", "-k1*A"), ("B", "k1*A")], "parameters": [("k1", 0.5)]}
+    reduced = odes2py.reduce_model(model)
+    assert reduced["states"] == [("B", "k1*A")]
+    assert reduced["variables"] == [("A_total", "0.0"), ("A", "A_total - B")]
+
+def test_scipy_batch_export_matches_single_rhs(m1_scipy, tmp_path):
+    model, cse, _ = m1_scipy
+    odes2py.export_as_scipy(model, str(tmp_path / "m1_batch.py"), jacobian=False, batch=True)
+    batch = load_module(str(tmp_path / "m1_batch.py"))
+    rng = np.random.default_rng(0)
+    states, params = rng.uniform(0, 1, (8, 5)), 10**rng.uniform(-2, 2, (8, 5))
+    out = np.full((8, 5), np.nan)
+    batch.M1_batch(states, 0.0, params, out)
+    np.testing.assert_allclose(out, [cse.M1(state, 0.0, param) for state, param in zip(states, params)], rtol=1e-12)
+
+def test_ensemble_export_matches_solve_ivp(m1_scipy, tmp_path):
+    scipy_integrate = pytest.importorskip("scipy.integrate")
+    model, cse, _ = m1_scipy
+    odes2py.export_as_scipy_ensemble(model, str(tmp_path / "m1_ensemble.py"))
+    ensemble = load_module(str(tmp_path / "m1_ensemble.py"))
+    assert ensemble.observable_names == ["y_sim"]
+    t = np.linspace(0, 10, 11)
+    params = np.array([p[1] for p in model["parameters"]]) * np.array([[1.0], [0.5], [2.0]])
+    y, status = ensemble.simulate_ensemble(t, params, rtol=1e-8, atol=1e-10)
+    assert y.shape == (3, len(t), 1) and np.all(status == 0)
+    for param, y_sim in zip(params, y):
+        sol = scipy_integrate.solve_ivp(lambda t, x: cse.M1(x, t, param), (0, 10), ensemble.initial_values, method="LSODA",
+                                        t_eval=t, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(y_sim[:, 0], sol.y[1], rtol=1e-5, atol=1e-8) # y_sim = Rp
+
+    y, status = ensemble.simulate_ensemble(t, params[:1], max_steps=1)
+    assert status[0] != 0 and np.all(np.isnan(y))
+
+def sbml_content(filename):
+    libsbml = pytest.importorskip("libsbml")
+    model = libsbml.readSBMLFromFile(filename).getModel()
+    species = [(s.getId(), s.getInitialConcentration() if s.isSetInitialConcentration() else s.getInitialAmount()) for s in model.getListOfSpecies()]
+    parameters = sorted((p.getId(), p.getValue() if p.isSetValue() else None) for p in model.getListOfParameters())
+    rules = sorted((r.getVariable(), r.getTypeCode(), libsbml.formulaToL3String(r.getMath())) for r in model.getListOfRules())
+    return species, parameters, rules
+
+def test_sbml_string_matches_the_yaml_route(tmp_path):
+    pytest.importorskip("libsbml")
+    pytest.importorskip("yaml2sbml")
+    model = odes2py.import_odes(M1_FILE)
+    (tmp_path / "libsbml").mkdir()
+    odes2py.export_as_SBML(model, str(tmp_path / "libsbml" / "m1.xml"), route='libsbml')
+    assert os.listdir(tmp_path / "libsbml") == ["m1.xml"] # no intermediate files
+    with open(tmp_path / "libsbml" / "m1.xml") as f:
+        assert f.read() == odes2py.sbml_string(model)
+    odes2py.export_as_SBML(model, str(tmp_path / "m1_yaml.xml"), route='yaml')
+    assert sbml_content(str(tmp_path / "libsbml" / "m1.xml")) == sbml_content(str(tmp_path / "m1_yaml.xml"))
+
+def test_import_m1():
+    model = odes2py.import_odes(M1_FILE)
+    assert model["name"] == "M1"
+    assert [s[0] for s in model["states"]] == ["R", "Rp", "RS", "RSp", "S"]
+    assert [s[2] for s in model["states"]] == [1.0, 0.0, 1.0, 0.0, 1.0]
+    assert model["states"][0][1] == "r3+r2-r1"
+    assert dict(model["parameters"]) == {"k1": 1.0, "k2": 0.0001, "kfeed": 1e6, "k4": 1.0, "k5": 0.01}
+    assert model["observables"] == [("y_sim", "Rp")]
+    assert dict(model["reactions"])["r3"] == "Rp*RSp*kfeed"
+
+def test_import_irregular_lines(tmp_path):
+    states = "d/dt(A)=-k1*A % a comment\n\nD/DT(B) = k1*A\nA(0)=2\n  B(0) = 0.5"
+    model = odes2py.import_odes(write_model(tmp_path, states, "k1=0.5\n% skipped\nk2 = 1e-3"))
+    assert model["states"] == [("A", "-k1*A", 2.0), ("B", "k1*A", 0.5)]
+    assert model["parameters"] == [("k1", 0.5), ("k2", 1e-3)]
+
+def test_medigit_round_trip(tmp_path):
+    model = odes2py.import_odes(M1_FILE)
+    filename = str(tmp_path / "M1_mdt.txt")
+    odes2py.export_as_medigit(model, filename)
+    with open(filename) as f:
+        text = f.read()
+    for state, rhs, ic in model["states"]:
+        assert f"d/dt({state}) = {rhs}" in text
+        assert f"{state}(0) = {ic}" in text
+
+@pytest.mark.parametrize("eq, terms", [
+    ("a+b-c", [("+", "a"), ("+", "b"), ("-", "c")]),
+    ("-a*(b-c)+d", [("-", "a*(b-c)"), ("+", "d")]),
+    ("1e-5*k-2.5E+3*x", [("+", "1e-5*k"), ("-", "2.5E+3*x")]),
+    ("k1e-5", [("+", "k1e"), ("-", "5")]), # k1e is a name, not a number
+    (".5e-2+x", [("+", ".5e-2"), ("+", "x")]),
+])
+def test_split_terms(eq, terms):
+    assert odes2py._split_terms(eq) == terms
+
+def test_split_terms_long_expression():
+    eq = "+".join(f"k{i}*x{i}-1e-3*y{i}" for i in range(20000))
+    assert len(odes2py._split_terms(eq)) == 40000
+
+def test_antimony_pairs_fluxes():
+    text = odes2py.antimony_string(odes2py.import_odes(M1_FILE))
+    for reaction in ["R -> Rp; R*S*k1", "Rp -> R; Rp*RSp*kfeed", "RS -> RSp; RS*Rp*k5", "RSp -> RS; RSp*k4"]:
+        assert reaction in text
+
+def test_odes2py_single_file_name_for_list_of_types(tmp_path):
+    out = str(tmp_path / "out.yml")
+    odes2py.odes2py(M1_FILE, out, ["yaml"])
+    assert os.path.exists(out)
+
+def test_odes2py_checks_number_of_file_names(tmp_path):
+    with pytest.raises(ValueError):
+        odes2py.odes2py(M1_FILE, str(tmp_path / "out.yml"), ["yaml", "mdt"])
+
+def test_odes2py_several_types(tmp_path):
+    out = [str(tmp_path / "out.yml"), str(tmp_path / "out_mdt.txt")]
+    odes2py.odes2py(M1_FILE, out, ["yaml", "mdt"], max_workers=1)
+    assert all(os.path.exists(o) for o in out)
+
+def test_convert_batch_skips_unchanged_models_and_outputs(tmp_path):
+    models = tmp_path / "models"
+    models.mkdir()
+    with open(M1_FILE) as f:
+        (models / "M1.txt").write_text(f.read())
+    manifest = str(tmp_path / "manifest.json")
+    for _ in range(3):
+        timings = odes2py.convert_batch(str(models), 'mdt', manifest=manifest, max_workers=1)
+        assert list(timings) == [str(models / "M1.txt")]
+    assert sorted(os.listdir(models)) == ["M1.txt", "M1_mdt.txt"]
+    assert timings[str(models / "M1.txt")] is None # unchanged since the first run
+
+def test_convert_batch_without_manifest_skips_outputs(tmp_path):
+    with open(M1_FILE) as f:
+        (tmp_path / "M1.txt").write_text(f.read())
+    for _ in range(2):
+        odes2py.convert_batch(str(tmp_path), 'mdt', manifest=None, max_workers=1)
+    assert sorted(os.listdir(tmp_path)) == ["M1.txt", "M1_mdt.txt"]
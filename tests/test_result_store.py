@@ -0,0 +1,105 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import result_store
+
+def optimizer_result(start_id, fval):
+    return SimpleNamespace(x0=np.zeros(2), x=np.array([1.0, fval]), fval=fval, grad=np.array([0.1, -0.2]), n_fval=10,
+                           n_grad=10, time=0.5, exitflag=0, message="converged", id=str(start_id))
+
+def write_store(filename, fvals, header=None):
+    f = result_store.open_store(filename, header or {"n_starts": 3, "seed": 1})
+    for start_id, fval in enumerate(fvals):
+        result_store.append_start(f, start_id, optimizer_result(start_id, fval))
+    f.close()
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / "starts.jsonl")
+    write_store(filename, [3.0, 1.0])
+    header, records = result_store.read_store(filename)
+    assert header["n_starts"] == 3 and header["seed"] == 1
+    assert sorted(records) == [0, 1]
+    assert records[1]["fval"] == 1.0
+    assert records[1]["grad"] == [0.1, -0.2]
+    assert records[1]["grad_norm"] == pytest.approx(np.sqrt(0.05))
+
+def test_incomplete_last_line_is_ignored_and_resumed(tmp_path):
+    filename = str(tmp_path / "starts.jsonl")
+    write_store(filename, [3.0, 1.0])
+    with open(filename, 'a') as f:
+        f.write('{"type": "start", "start_id": 2, "x0"') # the job stopped while writing
+    f = result_store.open_store(filename, {"n_starts": 3, "seed": 1}, resume=True)
+    result_store.append_start(f, 2, optimizer_result(2, 2.0))
+    f.close()
+    header, records = result_store.read_store(filename)
+    assert header["seed"] == 1
+    assert sorted(records) == [0, 1, 2]
+
+def test_without_resume_the_store_is_overwritten(tmp_path):
+    filename = str(tmp_path / "starts.jsonl")
+    write_store(filename, [3.0, 1.0])
+    result_store.open_store(filename, {"n_starts": 3, "seed": 2}).close()
+    header, records = result_store.read_store(filename)
+    assert header["seed"] == 2 and records == {}
+
+def test_record_to_result(tmp_path):
+    pytest.importorskip("pypesto")
+    filename = str(tmp_path / "starts.jsonl")
+    write_store(filename, [3.0])
+    _, records = result_store.read_store(filename)
+    result = result_store.record_to_result(records[0])
+    assert result.id == "0" and result.fval == 3.0
+    np.testing.assert_array_equal(result.grad, [0.1, -0.2])
+
+def test_startpoints_hash():
+    startpoints = np.arange(6.0).reshape(3, 2)
+    assert result_store.startpoints_hash(startpoints) == result_store.startpoints_hash(startpoints.copy())
+    assert result_store.startpoints_hash(startpoints) != result_store.startpoints_hash(startpoints + 1e-12)
+
+def test_start_run_resumes_with_the_remaining_starts(tmp_path):
+    pytest.importorskip("amici")
+    pypesto = pytest.importorskip("pypesto")
+    from calibration import start_run
+    problem = pypesto.Problem(pypesto.Objective(fun=lambda x: float(np.sum(x**2))), lb=[1e-3, 1e-3], ub=[10, 10])
+    filename = str(tmp_path / "starts.jsonl")
+    startpoints, tasks, result, f = start_run(problem, 3, seed=0, store=filename)
+    for start_id, x0 in tasks[:2]:
+        result_store.append_start(f, start_id, optimizer_result(start_id, float(start_id)))
+    f.close()
+    resumed, tasks, result, f = start_run(problem, 3, store=filename, resume=True) # the seed is read from the store
+    f.close()
+    np.testing.assert_array_equal(resumed, startpoints)
+    assert [start_id for start_id, _ in tasks] == [2]
+    assert len(result.optimize_result) == 2
+
+def test_start_run_starts_a_new_run_for_another_model_or_data(tmp_path):
+    pytest.importorskip("amici")
+    pypesto = pytest.importorskip("pypesto")
+    from calibration import start_run
+    problem = pypesto.Problem(pypesto.Objective(fun=lambda x: float(np.sum(x**2))), lb=[1e-3, 1e-3], ub=[10, 10])
+    filename = str(tmp_path / "starts.jsonl")
+    fingerprint = {"model_id": "M1_a", "data_hash": "1"}
+    startpoints, tasks, result, f = start_run(problem, 3, seed=0, store=filename, fingerprint=fingerprint)
+    result_store.append_start(f, 0, optimizer_result(0, 1.0))
+    f.close()
+    for kwargs in [{"fingerprint": {"model_id": "M1_b", "data_hash": "1"}}, {"fingerprint": {"model_id": "M1_a", "data_hash": "2"}},
+                   {"startpoints": startpoints + 1}]:
+        _, tasks, result, f = start_run(problem, 3, seed=0, store=filename, resume=True, **kwargs)
+        f.close()
+        assert len(tasks) == 3 and len(result.optimize_result) == 0
+        assert os.path.exists(filename + ".old")
+        header, records = result_store.read_store(filename)
+        assert records == {}
+        # write the original run back
+        startpoints, tasks, result, f = start_run(problem, 3, seed=0, store=filename, fingerprint=fingerprint)
+        result_store.append_start(f, 0, optimizer_result(0, 1.0))
+        f.close()
+    _, tasks, result, f = start_run(problem, 3, seed=0, store=filename, resume=True, fingerprint=fingerprint)
+    f.close()
+    assert len(tasks) == 2 and len(result.optimize_result) == 1
+    _, tasks, result, f = start_run(problem, 4, store=filename, resume=True, fingerprint=fingerprint) # other number of starts
+    f.close()
+    assert len(tasks) == 4 and len(result.optimize_result) == 0
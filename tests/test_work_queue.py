@@ -0,0 +1,83 @@
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("amici") # work_queue imports calibration
+from work_queue import DirectoryBroker, LocalBroker
+
+@pytest.fixture(params=["local", "directory"])
+def broker(request, tmp_path):
+    broker = LocalBroker() if request.param == "local" else DirectoryBroker(str(tmp_path / "queue"))
+    broker.reset()
+    return broker
+
+def test_each_task_is_claimed_once(broker):
+    for i in range(3):
+        broker.put(f"{i:06d}", (i, [float(i)]))
+    claimed = [broker.claim(worker) for worker in ["a", "b", "c", "d"]]
+    assert [c[0] for c in claimed[:3]] == ["000000", "000001", "000002"]
+    assert claimed[1][1] == (1, [1.0])
+    assert claimed[3] is None
+
+def test_stale_tasks_are_requeued(broker):
+    broker.put("000000", (0, [0.0]))
+    broker.put("000001", (1, [1.0]))
+    broker.claim("a")
+    broker.claim("b")
+    time.sleep(0.2)
+    broker.heartbeat("000001", "b")
+    assert broker.requeue_stale(0.1) == ["000000"]
+    assert broker.claim("c")[0] == "000000"
+
+def test_late_result_of_a_requeued_task_is_ignored(broker):
+    broker.put("000000", (0, [0.0]))
+    broker.claim("a")
+    assert broker.requeue_stale(-1) == ["000000"]
+    broker.claim("b")
+    assert broker.complete("000000", "b", "result of b")
+    assert not broker.complete("000000", "a", "result of a")
+    assert broker.collect() == {"000000": "result of b"}
+    assert broker.collect() == {}
+
+def test_completed_task_is_not_run_again(broker):
+    broker.put("000000", (0, [0.0]))
+    broker.claim("a")
+    broker.requeue_stale(-1) # requeued, but the original worker still finishes it
+    assert broker.complete("000000", "a", "result of a")
+    assert broker.claim("b") is None
+
+def test_job_and_stop(broker):
+    assert broker.job() is None
+    broker.publish_job({"model_name": "M1"})
+    assert broker.job() == {"model_name": "M1"}
+    assert not broker.stopped()
+    broker.stop()
+    assert broker.stopped()
+
+def test_claimed_task_is_not_stale(tmp_path):
+    broker = DirectoryBroker(str(tmp_path / "queue"))
+    broker.reset()
+    broker.put("000000", (0, [0.0]))
+    pending = os.path.join(broker.dirs["pending"], "000000.pkl")
+    os.utime(pending, (0, 0)) # a task that waited a long time in the queue
+    broker.claim("a")
+    assert broker.requeue_stale(60) == []
+
+def test_claim_after_reset(tmp_path):
+    broker = DirectoryBroker(str(tmp_path / "queue"))
+    broker.reset()
+    broker.put("000000", (0, [0.0]))
+    shutil.rmtree(broker.path)
+    assert broker.claim("a") is None
+
+def test_only_one_result_is_accepted(tmp_path):
+    broker = DirectoryBroker(str(tmp_path / "queue"))
+    broker.reset()
+    with ThreadPoolExecutor(8) as pool:
+        accepted = list(pool.map(lambda worker: broker.complete("000000", worker, f"result of {worker}"), range(8)))
+    assert sum(accepted) == 1
+    assert broker.collect() == {"000000": f"result of {accepted.index(True)}"}
+    assert os.listdir(broker.dirs["done"]) == ["000000.pkl"]
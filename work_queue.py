@@ -0,0 +1,381 @@
+""" Distributed multistart optimization using a work queue.
+
+The scheduler (distributed_minimize) splits the multistart into one task per start and publishes the tasks on a broker.
+Worker processes, on any node that can reach the broker, pull the tasks, run the optimizations and publish the results.
+While a worker runs a task, it sends heartbeats, and tasks of workers that have stopped sending heartbeats (e.g. a
+node that crashed) are put back in the queue by the scheduler. The results are aggregated into one pypesto Result.
+
+The default broker is a shared directory (DirectoryBroker), which works on any shared file system (e.g. NFS) without a
+server. LocalBroker keeps the queue in memory, for running the workers as threads in one process (e.g. in tests).
+Another broker (e.g. Redis) can be used by implementing the same methods.
+
+Use cases:
+    python work_queue.py worker queue_dir      (starts a worker, on any node with access to queue_dir)
+"""
+import os
+import pickle
+import shutil
+import socket
+import sys
+import threading
+import time
+import uuid
+
+import numpy as np
+import pypesto
+
+from calibration import fixed_parameter_values, run_fingerprint, solver_options, start_run, worker_problem
+from model_cache import module_location
+import result_store
+
+class DirectoryBroker:
+    """A work queue in a shared directory.
+
+    Tasks are files in pending/. A worker claims a task by renaming it to running/ (renames are atomic, so each task is
+    claimed by one worker only), sends heartbeats by updating the modification time of the claimed file, and writes the
+    result to done/. Only the first result of a task is kept, so a task that was requeued and run twice gives one result.
+    The job (the settings shared by all tasks) is stored in job.pkl.
+
+    Args:
+        path:
+            the queue directory, on a file system shared by the scheduler and the workers
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dirs = {name: os.path.join(path, name) for name in ["pending", "running", "done"]}
+        self.collected = set()
+
+    def reset(self):
+        """Removes all tasks and results from the queue."""
+        shutil.rmtree(self.path, ignore_errors=True)
+        for d in self.dirs.values():
+            os.makedirs(d, exist_ok=True)
+
+    def _write(self, filename, obj):
+        tmp = f"{filename}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(obj, f)
+        os.replace(tmp, filename) # the file appears complete, or not at all
+
+    def _read(self, filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    def publish_job(self, job):
+        self._write(os.path.join(self.path, "job.pkl"), job)
+
+    def job(self):
+        filename = os.path.join(self.path, "job.pkl")
+        return self._read(filename) if os.path.exists(filename) else None
+
+    def put(self, task_id, task):
+        self._write(os.path.join(self.dirs["pending"], f"{task_id}.pkl"), task)
+
+    def claim(self, worker_id):
+        """Claims a pending task. Returns (task_id, task), or None if no task is pending."""
+        try:
+            names = sorted(os.listdir(self.dirs["pending"]))
+        except FileNotFoundError: # the queue was reset
+            return None
+        for name in names:
+            if not name.endswith(".pkl"):
+                continue
+            task_id = name[:-4]
+            pending = os.path.join(self.dirs["pending"], name)
+            running = os.path.join(self.dirs["running"], f"{task_id}@{worker_id}")
+            try:
+                os.utime(pending) # the rename keeps the time, so set it first or the task may look stale in running/
+                os.rename(pending, running)
+                return task_id, self._read(running)
+            except FileNotFoundError: # claimed by another worker, or the queue was reset
+                continue
+        return None
+
+    def heartbeat(self, task_id, worker_id):
+        try:
+            os.utime(os.path.join(self.dirs["running"], f"{task_id}@{worker_id}"))
+        except FileNotFoundError: # requeued by the scheduler
+            pass
+
+    def complete(self, task_id, worker_id, result):
+        """Stores the result of a task. Returns False (and ignores the result) if the task was already completed by another worker."""
+        done = os.path.join(self.dirs["done"], f"{task_id}.pkl")
+        tmp = f"{done}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(result, f)
+        try:
+            os.link(tmp, done) # fails if the result exists, so of two workers finishing the same task only one is kept
+            accepted = True
+        except FileExistsError:
+            accepted = False
+        finally:
+            os.remove(tmp)
+        for leftover in [os.path.join(self.dirs["running"], f"{task_id}@{worker_id}"), # a requeued copy is not run again
+                         os.path.join(self.dirs["pending"], f"{task_id}.pkl")]:
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+        return accepted
+
+    def requeue_stale(self, timeout):
+        """Puts the tasks without a heartbeat for timeout seconds back in the queue. Returns the requeued task ids."""
+        requeued = []
+        now = time.time()
+        for name in os.listdir(self.dirs["running"]):
+            running = os.path.join(self.dirs["running"], name)
+            task_id = name.split("@")[0]
+            try:
+                if now - os.path.getmtime(running) > timeout:
+                    os.rename(running, os.path.join(self.dirs["pending"], f"{task_id}.pkl"))
+                    requeued.append(task_id)
+            except FileNotFoundError: # completed in the meantime
+                pass
+        return requeued
+
+    def collect(self):
+        """Returns the results (dict of task_id: result) that were completed since the last call."""
+        results = {}
+        for name in sorted(os.listdir(self.dirs["done"])):
+            task_id = name[:-4]
+            if name.endswith(".pkl") and task_id not in self.collected:
+                results[task_id] = self._read(os.path.join(self.dirs["done"], name))
+                self.collected.add(task_id)
+        return results
+
+    def stop(self):
+        """Tells the workers to exit when they are idle."""
+        open(os.path.join(self.path, "STOP"), 'w').close()
+
+    def stopped(self):
+        return os.path.exists(os.path.join(self.path, "STOP"))
+
+class LocalBroker:
+    """A work queue in memory, with the same methods as DirectoryBroker, for workers running as threads in this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._job = None
+        self.pending = {}
+        self.running = {} # task_id: (worker_id, task, time of the last heartbeat)
+        self.done = {}
+        self.collected = set()
+        self._stopped = False
+
+    def publish_job(self, job):
+        self._job = job
+
+    def job(self):
+        return self._job
+
+    def put(self, task_id, task):
+        with self.lock:
+            self.pending[task_id] = task
+
+    def claim(self, worker_id):
+        with self.lock:
+            if not self.pending:
+                return None
+            task_id = min(self.pending)
+            task = self.pending.pop(task_id)
+            self.running[task_id] = (worker_id, task, time.time())
+            return task_id, task
+
+    def heartbeat(self, task_id, worker_id):
+        with self.lock:
+            if self.running.get(task_id, (None,))[0] == worker_id:
+                self.running[task_id] = (worker_id, self.running[task_id][1], time.time())
+
+    def complete(self, task_id, worker_id, result):
+        with self.lock:
+            accepted = task_id not in self.done
+            if accepted:
+                self.done[task_id] = result
+            if self.running.get(task_id, (None,))[0] == worker_id:
+                del self.running[task_id]
+            self.pending.pop(task_id, None)
+            return accepted
+
+    def requeue_stale(self, timeout):
+        with self.lock:
+            now = time.time()
+            requeued = [task_id for task_id, (_, _, beat) in self.running.items() if now - beat > timeout]
+            for task_id in requeued:
+                self.pending[task_id] = self.running.pop(task_id)[1]
+            return requeued
+
+    def collect(self):
+        with self.lock:
+            results = {task_id: result for task_id, result in self.done.items() if task_id not in self.collected}
+            self.collected.update(results)
+            return results
+
+    def stop(self):
+        self._stopped = True
+
+    def stopped(self):
+        return self._stopped
+
+def _heartbeats(broker, task_id, worker_id, interval, finished):
+    while not finished.wait(interval):
+        broker.heartbeat(task_id, worker_id)
+
+def run_worker(broker, worker_id=None, heartbeat_interval=10, poll_interval=1, idle_timeout=None):
+    """This function runs a worker, which runs the tasks in the queue until the scheduler stops the queue.
+
+    The worker sets up its problem once, from the compiled model module and the data given in the job of the queue,
+    before it claims its first task, so that the setup does not delay the heartbeats. A result of a task that was
+    requeued and completed by another worker in the meantime is ignored.
+
+    Args:
+        broker:
+            The broker (e.g. DirectoryBroker) or the path to a queue directory
+        worker_id:
+            Name of the worker, defaults to <host name>-<process id>
+        heartbeat_interval:
+            Time (s) between the heartbeats sent while running a task
+        poll_interval:
+            Time (s) between checks for new tasks when the queue is empty
+        idle_timeout:
+            If given, the worker also exits after being idle for this time (s)
+    Returns:
+        the number of tasks run by the worker
+    """
+    if isinstance(broker, str):
+        broker = DirectoryBroker(broker)
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    while broker.job() is None and not broker.stopped():
+        time.sleep(poll_interval)
+    job = broker.job()
+    if job is None:
+        return 0
+    problem = worker_problem(job["model_name"], job["model_path"], job["data_file"], job["lb"], job["ub"], job["fixed_parameters"],
+                             job["sensitivity_method"], job["solver_settings"])
+    n_tasks = 0
+    idle_since = time.time()
+    opts = pypesto.optimize.OptimizeOptions(allow_failed_starts=True)
+    while not broker.stopped():
+        claimed = broker.claim(worker_id)
+        if claimed is None:
+            if idle_timeout is not None and time.time()-idle_since > idle_timeout:
+                break
+            time.sleep(poll_interval)
+            continue
+        task_id, (start_id, x0) = claimed
+        finished = threading.Event()
+        beats = threading.Thread(target=_heartbeats, args=(broker, task_id, worker_id, heartbeat_interval, finished), daemon=True)
+        beats.start()
+        try:
+            result = job["optimizer"].minimize(problem, x0, str(start_id), optimize_options=opts)
+        finally:
+            finished.set()
+            beats.join()
+        if not broker.complete(task_id, worker_id, result):
+            print(f"Task {task_id} was already completed by another worker, the result is ignored")
+        n_tasks += 1
+        idle_since = time.time()
+    return n_tasks
+
+def distributed_minimize(problem, optimizer, n_starts, model_module, data_file="data.json", broker="multistart_queue",
+                         startpoints=None, seed=None, timeout=60, poll_interval=1, n_local_workers=0, store=None, resume=False):
+    """This function runs a multistart optimization with the starts distributed to workers through a work queue.
+
+    The tasks (one per start) are published on the broker, and the workers are started separately, on any node that
+    can reach the broker (python work_queue.py worker <queue_dir>). Workers can be added or removed while the
+    optimization runs. Tasks of workers without a heartbeat for timeout seconds are put back in the queue. The function
+    returns when all starts are finished, and then tells the workers to exit. With a store and resume, only the starts
+    that are not in the store are published, as in calibration.parallel_minimize.
+
+    Examples:
+        Run 300 starts with the workers on other nodes sharing the directory 'multistart_queue'
+            result = distributed_minimize(problem, optimize.FidesOptimizer(), 300, model_module)
+        Run 300 starts with 4 workers on this node as well
+            result = distributed_minimize(problem, optimize.FidesOptimizer(), 300, model_module, n_local_workers=4)
+
+    Args:
+        problem:
+            The pypesto problem, used for the bounds and start points, and stored in the result
+        optimizer:
+            The pypesto optimizer to use for each start
+        n_starts:
+            Number of starts
+        model_module:
+            The compiled AMICI model module (e.g. from model_cache.compile_model). The build directory must be
+            reachable by the workers (e.g. on the shared file system).
+        data_file:
+            path to the experimental data, loaded by each worker
+        broker:
+            The broker (e.g. DirectoryBroker or LocalBroker), or the path to a queue directory on a shared file system
+        startpoints:
+            Optional array (n_starts, n_par) of start points. If None, start points are sampled uniformly within the bounds
+        seed:
+            Seed for the sampling of start points
+        timeout:
+            Time (s) without a heartbeat after which a task is put back in the queue
+        poll_interval:
+            Time (s) between checks for results
+        n_local_workers:
+            Number of workers to start on this node (as processes, or as threads with a LocalBroker)
+        store:
+            Optional path to a JSON lines file where the finished starts are written (see result_store.py)
+        resume:
+            Set to True to continue the run in store
+    Returns:
+        pypesto.Result, with all starts merged into result.optimize_result
+    """
+    if isinstance(broker, str):
+        broker = DirectoryBroker(broker)
+    startpoints, tasks, result, f = start_run(problem, n_starts, startpoints, seed, store, resume,
+                                              run_fingerprint(model_module, data_file))
+
+    sensitivity_method, solver_settings = solver_options(problem)
+    broker.reset()
+    broker.publish_job({"model_name": model_module.__name__, "model_path": module_location(model_module),
+                        "data_file": os.path.abspath(data_file), "lb": problem.lb, "ub": problem.ub,
+                        "fixed_parameters": fixed_parameter_values(problem), "sensitivity_method": sensitivity_method,
+                        "solver_settings": solver_settings, "optimizer": optimizer})
+    for start_id, x0 in tasks:
+        broker.put(f"{start_id:06d}", (start_id, np.asarray(x0)))
+
+    workers = []
+    for _ in range(n_local_workers if tasks else 0):
+        if isinstance(broker, LocalBroker):
+            workers.append(threading.Thread(target=run_worker, args=(broker,), kwargs={"poll_interval": poll_interval}, daemon=True))
+        else:
+            import multiprocessing
+            workers.append(multiprocessing.Process(target=run_worker, args=(broker.path,), kwargs={"poll_interval": poll_interval}))
+        workers[-1].start()
+
+    finished = set()
+    try:
+        while len(finished) < len(tasks):
+            for task_id, optimizer_result in broker.collect().items():
+                if task_id in finished: # a requeued task that was also finished by the original worker
+                    continue
+                finished.add(task_id)
+                result.optimize_result.append(optimizer_result, sort=False)
+                if f:
+                    result_store.append_start(f, optimizer_result.id, optimizer_result)
+            for task_id in broker.requeue_stale(timeout):
+                print(f"Task {task_id} has no heartbeat for {timeout} s, and is put back in the queue")
+            if len(finished) < len(tasks):
+                time.sleep(poll_interval)
+    finally:
+        broker.stop()
+        for worker in workers:
+            worker.join()
+        if f:
+            f.close()
+    result.optimize_result.sort()
+    return result
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != "worker":
+        print("Usage: python work_queue.py worker <queue_dir>")
+        sys.exit(1)
+    n_tasks = run_worker(sys.argv[2])
+    print(f"Worker finished after {n_tasks} tasks")